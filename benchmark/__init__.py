@@ -0,0 +1,6 @@
+"""Benchmarks for the GIMP plug-in and the headless engine.
+
+The plug-in is run against gimpstub, a stand-in for gimpfu that keeps
+the pixels in NumPy arrays and records every PDB call, so it can be
+measured without GIMP.  See run.py for the command line.
+"""
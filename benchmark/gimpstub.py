@@ -0,0 +1,465 @@
+"""Recording stand-in for the gimpfu module of GIMP.
+
+Only the parts of gimp and the PDB that the plug-in uses are there.
+Layers keep their pixels in NumPy arrays, selections are lists of
+rectangles, and text layers are empty, which is enough to run every
+procedure of the plug-in outside of GIMP.
+
+Every PDB call is counted by name, and every pixel that goes through a
+pixel region is counted as moved.  Call install before boxwrap is
+imported.
+"""
+
+import collections
+import sys
+import tempfile
+import types
+
+import numpy
+
+
+# Constants of gimpfu with the values of GIMP 2.10
+RGB, GRAY, INDEXED = 0, 1, 2
+RGB_IMAGE, RGBA_IMAGE = 0, 1
+NORMAL_MODE = 0
+FOREGROUND_FILL, BACKGROUND_FILL, WHITE_FILL, TRANSPARENT_FILL = 0, 1, 2, 3
+CHANNEL_OP_ADD, CHANNEL_OP_SUBTRACT, CHANNEL_OP_REPLACE = 0, 1, 2
+CLIP_TO_BOTTOM_LAYER = 2
+PIXELS = 0
+VECTORS_STROKE_TYPE_BEZIER = 0
+FALSE, TRUE = 0, 1
+(PF_INT, PF_FLOAT, PF_STRING, PF_TOGGLE, PF_IMAGE, PF_DRAWABLE,
+ PF_ADJUSTMENT, PF_OPTION, PF_FILE, PF_DIRNAME) = range(10)
+
+
+class Recorder:
+    """Counts the PDB calls and the pixels moved through pixel regions."""
+
+    def __init__(self):
+        # type: () -> None
+        self.calls = collections.Counter()  # type: Dict[str, int]
+        self.pixels = 0    # type: int
+        self.messages = []  # type: List[str]
+
+    def reset(self):
+        # type: () -> None
+        self.calls.clear()
+        self.pixels = 0
+        self.messages = []
+
+
+recorder = Recorder()  # type: Recorder
+
+
+class Parasite:
+    """Named data attached to an image."""
+
+    def __init__(self, name, flags, data):
+        # type: (str, int, str) -> None
+        self.name = name
+        self.flags = flags
+        self.data = data
+
+
+class Vectors:
+    """A path made of strokes, each a list of control points."""
+
+    def __init__(self, image, name):
+        # type: (Image, str) -> None
+        self.image = image
+        self.name = name
+        self.strokes = []  # type: List[List[float]]
+
+    def bounds(self):
+        # type: () -> List[Tuple[int, int, int, int]]
+        """Returns the bounding rectangle of every stroke."""
+
+        rectangles = []  # type: List[Tuple[int, int, int, int]]
+        for points in self.strokes:
+            xs, ys = points[0::2], points[1::2]
+            left, top = int(round(min(xs))), int(round(min(ys)))
+            rectangles.append((left, top, int(round(max(xs))) - left,
+                               int(round(max(ys))) - top))
+        return rectangles
+
+
+class Channel:
+    """A selection saved as a channel."""
+
+    def __init__(self, image):
+        # type: (Image) -> None
+        self.image = image
+        self.rectangles = list(image.selection)
+
+    def bounds(self):
+        # type: () -> List[Tuple[int, int, int, int]]
+        return list(self.rectangles)
+
+
+class Layer:
+    """A layer with 8 bit RGB or RGBA pixels."""
+
+    def __init__(self, image, name, width, height, kind=RGB_IMAGE,
+                 opacity=100, mode=NORMAL_MODE):
+        # type: (Image, str, int, int, int, float, int) -> None
+        self.image = image
+        self.name = name
+        self.width = width
+        self.height = height
+        self.offsets = (0, 0)  # type: Tuple[int, int]
+        self.pixels = numpy.zeros((height, width,
+                                   4 if kind == RGBA_IMAGE else 3),
+                                  dtype=numpy.uint8)
+
+    @property
+    def bpp(self):
+        # type: () -> int
+        return self.pixels.shape[2]
+
+    def fill(self, fill_type):
+        # type: (int) -> None
+        _fill(self, [(0, 0, self.width, self.height)], fill_type)
+
+    def get_pixel_rgn(self, x, y, width, height, dirty=False, shadow=False):
+        # type: (int, int, int, int, bool, bool) -> PixelRgn
+        return PixelRgn(self)
+
+    def flush(self):
+        # type: () -> None
+        pass
+
+    def merge_shadow(self, undo=False):
+        # type: (bool) -> None
+        # Pixel regions always write to the layer itself
+        pass
+
+    def update(self, x, y, width, height):
+        # type: (int, int, int, int) -> None
+        pass
+
+    def copy(self, image):
+        # type: (Image) -> Layer
+        layer = Layer(image, self.name, self.width, self.height)
+        layer.pixels = self.pixels.copy()
+        layer.offsets = self.offsets
+        return layer
+
+
+class PixelRgn:
+    """Reads and writes rectangles of a layer as raw bytes."""
+
+    def __init__(self, layer):
+        # type: (Layer) -> None
+        self.layer = layer
+        self.bpp = layer.bpp  # type: int
+
+    def __getitem__(self, key):
+        # type: (Tuple[slice, slice]) -> bytes
+        xs, ys = key
+        data = self.layer.pixels[ys, xs]
+        recorder.pixels += data.shape[0] * data.shape[1]
+        return data.tobytes()
+
+    def __setitem__(self, key, data):
+        # type: (Tuple[slice, slice], bytes) -> None
+        xs, ys = key
+        target = self.layer.pixels[ys, xs]
+        target[...] = numpy.frombuffer(data, dtype=numpy.uint8).reshape(
+            target.shape)
+        recorder.pixels += target.shape[0] * target.shape[1]
+
+
+class Image:
+    """An image with layers, paths, guides, and parasites."""
+
+    _next_id = 1  # type: int
+    images = []   # type: List[Image]
+
+    def __init__(self, width, height, kind=RGB):
+        # type: (int, int, int) -> None
+        self.ID = Image._next_id
+        Image._next_id += 1
+        self.width = width
+        self.height = height
+        self.name = "Untitled"  # type: str
+        self.filename = None    # type: Optional[str]
+        self.resolution = (72.0, 72.0)  # type: Tuple[float, float]
+        self.layers = []   # type: List[Layer]
+        self.vectors = []  # type: List[Vectors]
+        self.guides = []   # type: List[Tuple[str, int]]
+        self.parasites = {}  # type: Dict[str, Parasite]
+        self.selection = []  # type: List[Tuple[int, int, int, int]]
+        Image.images.append(self)
+
+    def disable_undo(self):
+        # type: () -> None
+        pass
+
+    def enable_undo(self):
+        # type: () -> None
+        pass
+
+    def add_layer(self, layer, position=0):
+        # type: (Layer, int) -> None
+        self.layers.insert(position, layer)
+
+    def add_vguide(self, x):
+        # type: (int) -> None
+        self.guides.append(("v", x))
+
+    def add_hguide(self, y):
+        # type: (int) -> None
+        self.guides.append(("h", y))
+
+    def attach_new_parasite(self, name, flags, data):
+        # type: (str, int, str) -> None
+        self.parasites[name] = Parasite(name, flags, data)
+
+    def parasite_find(self, name):
+        # type: (str) -> Optional[Parasite]
+        return self.parasites.get(name)
+
+
+def _fill(layer, rectangles, fill_type):
+    # type: (Layer, List[Tuple[int, int, int, int]], int) -> None
+    """Fills rectangles of a layer with the foreground color (black) or
+    white."""
+
+    color = {FOREGROUND_FILL: 0, BACKGROUND_FILL: 255,
+             WHITE_FILL: 255}.get(fill_type)  # type: Optional[int]
+    for x, y, width, height in rectangles:
+        # Negative ends would count from the other side of the layer
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = max(x + width, 0), max(y + height, 0)
+        area = layer.pixels[y0:y1, x0:x1]
+        if color is None:
+            area[...] = 0
+        else:
+            area[..., :3] = color
+            if layer.bpp == 4:
+                area[..., 3] = 255
+
+
+def _composite(below, layer):
+    # type: (numpy.ndarray, Layer) -> None
+    """Draws a layer over RGB or RGBA pixels at the offsets of the
+    layer."""
+
+    x, y = layer.offsets
+    height, width = below.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + layer.width, width), min(y + layer.height, height)
+    if x0 >= x1 or y0 >= y1:
+        return
+    source = layer.pixels[y0 - y:y1 - y, x0 - x:x1 - x]
+    target = below[y0:y1, x0:x1]
+    if layer.bpp == 3:
+        target[..., :3] = source
+        return
+    alpha = source[..., 3:].astype(numpy.uint16)
+    target[..., :3] = (source[..., :3] * alpha +
+                       target[..., :3] * (255 - alpha) + 127) // 255
+
+
+class _Pdb:
+    """The procedural database.  Calls to procedures that are not
+    implemented here are only counted."""
+
+    def __getattr__(self, name):
+        # type: (str) -> Callable[..., Any]
+        procedure = _PROCEDURES.get(name)
+
+        def call(*args):
+            recorder.calls[name] += 1
+            if procedure is not None:
+                return procedure(*args)
+            return None
+        return call
+
+
+def _duplicate(image):
+    # type: (Image) -> Image
+    copy = Image(image.width, image.height)
+    copy.resolution = image.resolution
+    copy.layers = [layer.copy(copy) for layer in image.layers]
+    for vectors in image.vectors:
+        duplicate = Vectors(copy, vectors.name)
+        duplicate.strokes = [list(points) for points in vectors.strokes]
+        copy.vectors.append(duplicate)
+    copy.guides = list(image.guides)
+    return copy
+
+
+def _flatten(image):
+    # type: (Image) -> Layer
+    layer = Layer(image, "Background", image.width, image.height)
+    layer.pixels[...] = 255
+    for above in reversed(image.layers):
+        _composite(layer.pixels, above)
+    image.layers = [layer]
+    return layer
+
+
+def _delete(image):
+    # type: (Image) -> None
+    Image.images.remove(image)
+
+
+def _scale(image, width, height):
+    # type: (Image, int, int) -> None
+    for layer in image.layers:
+        rows = numpy.arange(height) * layer.height // height
+        columns = numpy.arange(width) * layer.width // width
+        layer.pixels = layer.pixels[rows][:, columns]
+        layer.width, layer.height = width, height
+    image.width, image.height = width, height
+
+
+def _by_name(items, name):
+    # type: (List[Any], str) -> Any
+    for item in items:
+        if item.name == name:
+            return item
+    return None
+
+
+def _select_rectangle(image, operation, x, y, width, height):
+    # type: (Image, int, int, int, int, int) -> None
+    if operation == CHANNEL_OP_REPLACE:
+        image.selection = []
+    image.selection.append((int(x), int(y), int(width), int(height)))
+
+
+def _select_item(image, operation, vectors):
+    # type: (Image, int, Vectors) -> None
+    if operation == CHANNEL_OP_REPLACE:
+        image.selection = []
+    image.selection.extend(vectors.bounds())
+
+
+def _edit_fill(layer, fill_type):
+    # type: (Layer, int) -> None
+    _fill(layer, layer.image.selection or
+          [(0, 0, layer.width, layer.height)], fill_type)
+
+
+def _insert_vectors(image, vectors, parent, position):
+    # type: (Image, Vectors, Any, int) -> None
+    image.vectors.insert(position, vectors)
+
+
+def _new_stroke(vectors, kind, count, points, closed):
+    # type: (Vectors, int, int, List[float], int) -> int
+    vectors.strokes.append(list(points))
+    return len(vectors.strokes)
+
+
+def _text_layer(image, text, font, size, unit):
+    # type: (Image, str, str, float, int) -> Layer
+    lines = text.split("\n")
+    return Layer(image, text, max(1, int(max(len(l) for l in lines) *
+                                         size * 0.6)),
+                 max(1, int(len(lines) * size * 1.2)), RGBA_IMAGE)
+
+
+def _translate(layer, dx, dy):
+    # type: (Layer, int, int) -> None
+    layer.offsets = (layer.offsets[0] + dx, layer.offsets[1] + dy)
+
+
+def _merge_down(image, layer, merge_type):
+    # type: (Image, Layer, int) -> Layer
+    index = image.layers.index(layer)  # type: int
+    below = image.layers[index + 1]
+    _composite(below.pixels, layer)
+    del image.layers[index]
+    return below
+
+
+def _load(path, raw_path):
+    # type: (str, str) -> Image
+    from PIL import Image as PillowImage
+
+    pixels = numpy.asarray(PillowImage.open(path).convert("RGBA"))
+    image = Image(pixels.shape[1], pixels.shape[0])
+    image.filename = path
+    layer = Layer(image, "Background", image.width, image.height,
+                  RGBA_IMAGE)
+    layer.pixels = pixels.copy()
+    image.add_layer(layer, 0)
+    return image
+
+
+def _set_resolution(image, x, y):
+    # type: (Image, float, float) -> None
+    image.resolution = (x, y)
+
+
+_PROCEDURES = {
+    "gimp_image_duplicate": _duplicate,
+    "gimp_image_flatten": _flatten,
+    "gimp_image_delete": _delete,
+    "gimp_image_scale": _scale,
+    "gimp_image_set_resolution": _set_resolution,
+    "gimp_image_get_layer_by_name":
+        lambda image, name: _by_name(image.layers, name),
+    "gimp_image_get_vectors_by_name":
+        lambda image, name: _by_name(image.vectors, name),
+    "gimp_image_select_rectangle": _select_rectangle,
+    "gimp_image_select_item": _select_item,
+    "gimp_selection_save": Channel,
+    "gimp_selection_none":
+        lambda image: setattr(image, "selection", []),
+    "gimp_edit_fill": _edit_fill,
+    "gimp_vectors_new": Vectors,
+    "gimp_image_insert_vectors": _insert_vectors,
+    "gimp_vectors_stroke_new_from_points": _new_stroke,
+    "gimp_text_layer_new": _text_layer,
+    "gimp_drawable_offsets": lambda layer: layer.offsets,
+    "gimp_drawable_mask_bounds":
+        lambda layer: (TRUE, 0, 0, layer.width, layer.height),
+    "gimp_layer_translate": _translate,
+    "gimp_image_merge_down": _merge_down,
+    "gimp_file_load": _load,
+}  # type: Dict[str, Callable[..., Any]]
+
+
+def install(directory=None):
+    # type: (Optional[str]) -> types.ModuleType
+    """Puts the stub into sys.modules as gimpfu and returns it.  The
+    directory is the GIMP profile, a new temporary one by default."""
+
+    gimp = types.ModuleType("gimp")
+    gimp.Image = Image
+    gimp.Layer = Layer
+    gimp.PixelRgn = PixelRgn
+    gimp.Vectors = Vectors
+    gimp.Channel = Channel
+    gimp.Display = lambda image: None
+    gimp.message = recorder.messages.append
+    gimp.context_push = lambda: None
+    gimp.context_pop = lambda: None
+    gimp.displays_flush = lambda: None
+    gimp.image_list = lambda: list(Image.images)
+    gimp.directory = directory or tempfile.mkdtemp(prefix="gimpstub-")
+
+    gimpfu = types.ModuleType("gimpfu")
+    for name, value in globals().items():
+        if name.isupper() and isinstance(value, int):
+            setattr(gimpfu, name, value)
+    gimpfu.gimp = gimp
+    gimpfu.pdb = _Pdb()
+    gimpfu.procedures = []  # type: List[Tuple[Any, ...]]
+    gimpfu.register = lambda *args: gimpfu.procedures.append(args)
+    gimpfu.main = lambda: None
+
+    sys.modules["gimp"] = gimp
+    sys.modules["gimpfu"] = gimpfu
+    return gimpfu
+
+
+def close_all():
+    # type: () -> None
+    """Deletes all images, like closing GIMP."""
+
+    del Image.images[:]
@@ -0,0 +1,454 @@
+"""Benchmarks the plug-in and the headless engine over a sweep of box
+sizes, material settings, and resolutions.
+
+The plug-in runs against a recording stub of gimpfu, see gimpstub.  For
+every box and stage the wall time, the peak memory of Python and NumPy
+allocations, the number of PDB calls, and the number of pixels moved are
+reported.  For the GIMP stages the pixels are those that go through
+pixel regions, for the engine stages those that the render plan copies.
+
+The results can be stored as a baseline.  Later runs are compared to
+it, and a stage that got slower or bigger than the threshold allows, or
+that makes more PDB calls or moves more pixels than before, is a
+regression and makes the tool exit with status 1.
+
+Usage: python -m benchmark.run [--quick] [--save-baseline] [...]
+"""
+
+import argparse
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 cannot measure the memory of a stage
+    tracemalloc = None
+
+from benchmark import gimpstub
+
+gimpfu = gimpstub.install()
+from boxwrap_plugin import procedures  # noqa: E402  (needs the stub)
+from boxwrap_engine import plan, render, stream  # noqa: E402
+from boxwrap_engine.layout import DEFAULTS, WrapLayout  # noqa: E402
+
+
+# Box sizes in mm, from the smallest to the largest the dialogs allow
+BOXES = [(10, 10, 10), (75, 104, 100), (250, 150, 100),
+         (500, 500, 500)]  # type: List[Tuple[float, float, float]]
+
+# Resolutions in dpi
+RESOLUTIONS = [50, 150, 300]  # type: List[float]
+
+# The limits of the other dialog settings, each tried on the default box
+VARIANTS = [("thickness", 0.5), ("thickness", 6.0),
+            ("flap_size", 1.0), ("flap_size", 20.0),
+            ("inside_size", 1.0), ("inside_size", 50.0)]
+
+# Resolution of the variants of the default box
+VARIANT_DPI = 150  # type: float
+
+# Templates larger than this many megapixels are skipped by default
+MAX_MEGAPIXELS = 30.0  # type: float
+
+# Allowed slowdown and growth of memory before it counts as regression
+THRESHOLD = 0.25  # type: float
+
+# Differences below these are noise
+MIN_SECONDS = 0.01  # type: float
+MIN_MEGABYTES = 1.0  # type: float
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "baseline.json")  # type: str
+
+_clock = getattr(time, "perf_counter", time.time)
+
+# Temporary folders made by this run, removed after each stage
+_folders = []  # type: List[str]
+
+
+class Case:
+    """One box with all settings of the wraps dialog."""
+
+    def __init__(self, width, height, depth, dpi, **settings):
+        # type: (float, float, float, float, **float) -> None
+        self.box = (width, height, depth)  # type: Tuple[float, ...]
+        self.dpi = dpi                     # type: float
+        self.settings = dict(DEFAULTS, **settings)  # type: Dict[str, float]
+        self.parameters = list(self.box) + [
+            self.settings[key] for key in
+            ("thickness", "flap_size", "inside_size", "crop_mark_size",
+             "crop_mark_distance")]  # type: List[float]
+        self.layout = WrapLayout.from_mm(*self.parameters, dpi=dpi)
+        self.name = "%gx%gx%g-t%g-f%g-i%g@%g" % (
+            tuple(self.box) + (self.settings["thickness"],
+                               self.settings["flap_size"],
+                               self.settings["inside_size"], dpi))
+
+    def megapixels(self):
+        # type: () -> float
+        return self.layout.src_width * self.layout.src_height / 1e6
+
+
+def cases(quick=False):
+    # type: (bool) -> List[Case]
+    """Returns the sweep, or only the default box at two resolutions."""
+
+    if quick:
+        return [Case(75, 104, 100, dpi) for dpi in (50, 150)]
+    sweep = [Case(w, h, d, dpi) for w, h, d in BOXES for dpi in RESOLUTIONS]
+    sweep.extend(Case(75, 104, 100, VARIANT_DPI, **{key: value})
+                 for key, value in VARIANTS)
+    return sweep
+
+
+def template_pixels(layout):
+    # type: (WrapLayout) -> numpy.ndarray
+    """Returns an RGBA template with a pattern on the faces and
+    transparent corners."""
+
+    height, width = layout.src_height, layout.src_width
+    ys = numpy.arange(height, dtype=numpy.uint8)[:, None]
+    xs = numpy.arange(width, dtype=numpy.uint8)[None, :]
+    pixels = numpy.empty((height, width, 4), dtype=numpy.uint8)
+    pixels[..., 0] = xs * 3 + ys
+    pixels[..., 1] = xs ^ ys
+    pixels[..., 2] = ys * 5
+    pixels[..., 3] = 0
+    x, y = layout.src_xs, layout.src_ys
+    pixels[y[1]:y[3], :, 3] = 255
+    pixels[:, x[1]:x[2], 3] = 255
+    return pixels
+
+
+def template_image(layout):
+    # type: (WrapLayout) -> gimpstub.Image
+    """Returns a template image in the stub."""
+
+    image = gimpstub.Image(layout.src_width, layout.src_height)
+    image.name = "benchmark.xcf"
+    layer = gimpstub.Layer(image, "Template", layout.src_width,
+                           layout.src_height, gimpstub.RGBA_IMAGE)
+    layer.pixels = template_pixels(layout)
+    image.add_layer(layer, 0)
+    return image
+
+
+def new_profile():
+    # type: () -> None
+    """Starts with an empty GIMP profile, so the cache is cold."""
+
+    gimpfu.gimp.directory = temporary_folder()
+
+
+def temporary_folder():
+    # type: () -> str
+    """Returns a new temporary folder that is removed after the stage."""
+
+    folder = tempfile.mkdtemp(prefix="boxwrap-benchmark-")  # type: str
+    _folders.append(folder)
+    return folder
+
+
+def plan_pixels(layout):
+    # type: (WrapLayout) -> int
+    """Returns the number of pixels that the plans of both wraps copy."""
+
+    return sum(copy.src_width * copy.src_height
+               for operations in plan.compile_plans(layout)
+               for copy in operations)
+
+
+# Each stage prepares everything that is not measured and returns the
+# function to measure and the number of pixels it moves, or None if the
+# stub counts them.
+
+def stage_register(case):
+    def run():
+        # What GIMP does at every start, the procedures stay unloaded
+        sys.modules.pop("boxwrap", None)
+        importlib.import_module("boxwrap")
+    return run, None
+
+
+def stage_create_template(case):
+    return lambda: procedures.create_template(*case.box,
+                                              resolution=case.dpi), None
+
+
+def _create_wraps(case, image):
+    return lambda: procedures.create_wraps(image, *case.parameters,
+                                           resolution=case.dpi)
+
+
+def stage_create_wraps(case):
+    new_profile()
+    return _create_wraps(case, template_image(case.layout)), None
+
+
+def stage_update_wraps(case):
+    new_profile()
+    image = template_image(case.layout)
+    _create_wraps(case, image)()
+    # Paint over the front face
+    x, y = case.layout.src_xs, case.layout.src_ys
+    image.layers[0].pixels[y[1]:y[3], x[1]:x[2], :3] //= 2
+    return _create_wraps(case, image), None
+
+
+def stage_cached_wraps(case):
+    new_profile()
+    image = template_image(case.layout)
+    # The cache is off unless it is asked for
+    os.environ[procedures.CACHE_VARIABLE] = "1024"
+    _create_wraps(case, image)()
+    gimpstub.close_all()
+    gimpstub.Image.images.append(image)
+    create = _create_wraps(case, image)
+
+    def run():
+        try:
+            create()
+        finally:
+            del os.environ[procedures.CACHE_VARIABLE]
+    return run, None
+
+
+def stage_create_wraps_pdb(case):
+    new_profile()
+    image = template_image(case.layout)
+
+    def run():
+        engine, procedures.render = procedures.render, None
+        try:
+            _create_wraps(case, image)()
+        finally:
+            procedures.render = engine
+    return run, None
+
+
+def stage_marks(case):
+    def run():
+        overlay = procedures.create_overlay(case.layout, True)
+        gimpfu.pdb.gimp_image_delete(overlay)
+    return run, None
+
+
+def stage_copy_and_rotate_rectangle(case):
+    image = template_image(case.layout)
+    flat_image, src_layer = procedures.flatten_copy(image)
+    overlay = procedures.create_overlay(case.layout, False)
+    dst_layer = overlay.layers[0]
+    operations = plan.compile_plans(case.layout)[0]
+
+    def run():
+        for copy in operations:
+            procedures.copy_and_rotate_rectangle(
+                src_layer if copy.source == plan.TEMPLATE else dst_layer,
+                copy.src_x, copy.src_y, copy.src_width, copy.src_height,
+                dst_layer, copy.dst_x, copy.dst_y,
+                procedures.Corner.TOP_LEFT, copy.angle)
+    return run, None
+
+
+def stage_engine_render(case):
+    pixels = template_pixels(case.layout)
+    return (lambda: render.render_wraps(pixels, case.layout),
+            plan_pixels(case.layout))
+
+
+def stage_engine_stream(case):
+    pixels = template_pixels(case.layout)
+    directory = temporary_folder()
+    return (lambda: stream.render_wraps_to_files(
+        pixels, case.layout, os.path.join(directory, "top.png"),
+        os.path.join(directory, "bottom.png"), level=1),
+        plan_pixels(case.layout))
+
+
+STAGES = [
+    ("register", stage_register),
+    ("create_template", stage_create_template),
+    ("create_wraps", stage_create_wraps),
+    ("update_wraps", stage_update_wraps),
+    ("cached_wraps", stage_cached_wraps),
+    ("create_wraps_pdb", stage_create_wraps_pdb),
+    ("marks", stage_marks),
+    ("copy_and_rotate_rectangle", stage_copy_and_rotate_rectangle),
+    ("engine_render", stage_engine_render),
+    ("engine_stream", stage_engine_stream),
+]  # type: List[Tuple[str, Callable[[Case], Tuple]]]
+
+
+def _clean_up():
+    # type: () -> None
+    """Forgets all images and removes the temporary files of a stage."""
+
+    gimpstub.close_all()
+    while _folders:
+        shutil.rmtree(_folders.pop(), ignore_errors=True)
+
+
+def measure(case,      # type: Case
+            stage,     # type: Callable[[Case], Tuple]
+            repeat=3   # type: int
+            ):
+    # type: (...) -> Dict[str, Any]
+    """Runs a stage once to count and trace it and then repeat times to
+    time it.  Returns the best time."""
+
+    run, pixels = stage(case)
+    gimpstub.recorder.reset()
+    peak = None  # type: Optional[float]
+    if tracemalloc is not None:
+        tracemalloc.start()
+        start_memory = tracemalloc.get_traced_memory()[0]  # type: int
+    start = _clock()  # type: float
+    run()
+    seconds = _clock() - start  # type: float
+    if tracemalloc is not None:
+        peak = (tracemalloc.get_traced_memory()[1] - start_memory) / 1e6
+        tracemalloc.stop()
+    result = {
+        "seconds": seconds,
+        "peak_mb": peak,
+        "pdb_calls": sum(gimpstub.recorder.calls.values()),
+        "pixels": gimpstub.recorder.pixels if pixels is None else pixels,
+        "messages": list(gimpstub.recorder.messages),
+    }  # type: Dict[str, Any]
+    _clean_up()
+
+    # Tracing slows everything down, so the times come from other runs
+    times = []  # type: List[float]
+    for _ in range(repeat):
+        run, _ = stage(case)
+        start = _clock()
+        run()
+        times.append(_clock() - start)
+        _clean_up()
+    if times:
+        result["seconds"] = min(times)
+    return result
+
+
+def compare(result,    # type: Dict[str, Any]
+            baseline,  # type: Optional[Dict[str, Any]]
+            threshold  # type: float
+            ):
+    # type: (...) -> List[str]
+    """Returns what got worse compared to the baseline."""
+
+    if baseline is None:
+        return []
+    worse = []  # type: List[str]
+    if result["seconds"] > baseline["seconds"] * (1 + threshold) and \
+       result["seconds"] - baseline["seconds"] > MIN_SECONDS:
+        worse.append("time %+.0f%%" % (
+            100 * (result["seconds"] / baseline["seconds"] - 1)))
+    if result["peak_mb"] is not None and \
+       baseline.get("peak_mb") is not None and \
+       result["peak_mb"] > baseline["peak_mb"] * (1 + threshold) and \
+       result["peak_mb"] - baseline["peak_mb"] > MIN_MEGABYTES:
+        worse.append("memory %+.0f%%" % (
+            100 * (result["peak_mb"] / max(baseline["peak_mb"], 1e-6) - 1)))
+    for key in ("pdb_calls", "pixels"):
+        # These do not depend on the machine, so any growth counts
+        if result[key] > baseline[key]:
+            worse.append("%s %d > %d" % (key, result[key], baseline[key]))
+    return worse
+
+
+def main(argv=None):
+    # type: (Optional[List[str]]) -> int
+    """Runs the benchmarks."""
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the plug-in and the engine.")
+    parser.add_argument("--quick", action="store_true",
+                        help="only the default box at 50 and 150 dpi")
+    parser.add_argument("--stages", default=None, metavar="NAME,...",
+                        help="only these stages (%s)"
+                        % ", ".join(name for name, _ in STAGES))
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timed runs per stage, the best counts "
+                        "(default: %(default)d)")
+    parser.add_argument("--max-megapixels", type=float,
+                        default=MAX_MEGAPIXELS,
+                        help="skip larger templates (default: %(default)g)")
+    parser.add_argument("--baseline", default=BASELINE,
+                        help="baseline file (default: benchmark/"
+                        "baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="allowed slowdown, 0.25 is 25%% "
+                        "(default: %(default)g)")
+    parser.add_argument("--json", metavar="FILE", default=None,
+                        help="also write all results to this file")
+    args = parser.parse_args(argv)
+
+    stages = STAGES  # type: List[Tuple[str, Callable[[Case], Tuple]]]
+    if args.stages:
+        names = args.stages.split(",")  # type: List[str]
+        stages = [stage for stage in STAGES if stage[0] in names]
+
+    baseline = {}  # type: Dict[str, Dict[str, Dict[str, Any]]]
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}  # type: Dict[str, Dict[str, Dict[str, Any]]]
+    regressions = 0  # type: int
+    sys.stdout.write("%-32s %-26s %9s %9s %9s %12s\n"
+                     % ("box", "stage", "seconds", "peak MB", "PDB calls",
+                        "pixels"))
+    for case in cases(args.quick):
+        if case.megapixels() > args.max_megapixels:
+            sys.stdout.write("%-32s skipped, %.0f megapixels\n"
+                             % (case.name, case.megapixels()))
+            continue
+        results[case.name] = {}
+        for name, stage in stages:
+            result = measure(case, stage, args.repeat)
+            results[case.name][name] = result
+            worse = compare(result, baseline.get(case.name, {}).get(name),
+                            args.threshold)
+            regressions += bool(worse)
+            sys.stdout.write("%-32s %-26s %9.3f %9s %9d %12d%s\n" % (
+                case.name, name, result["seconds"],
+                "-" if result["peak_mb"] is None
+                else "%.1f" % result["peak_mb"],
+                result["pdb_calls"], result["pixels"],
+                "  REGRESSION: " + ", ".join(worse) if worse else ""))
+            for message in result["messages"]:
+                sys.stdout.write("    GIMP message: %s\n" % message)
+            sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.save_baseline:
+        for stages_of_case in results.values():
+            for result in stages_of_case.values():
+                del result["messages"]
+                result["seconds"] = round(result["seconds"], 6)
+                if result["peak_mb"] is not None:
+                    result["peak_mb"] = round(result["peak_mb"], 3)
+        with open(args.baseline, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+        sys.stdout.write("Saved the baseline to %s\n" % args.baseline)
+    elif regressions:
+        sys.stdout.write("%d regressions\n" % regressions)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,5 @@
+"""Render engine for the printable box wraps.
+
+The modules in this package do not depend on GIMP.  They are used by the
+GIMP plugin in boxwrap_plugin and can also be used on their own.
+"""
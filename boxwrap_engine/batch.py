@@ -0,0 +1,529 @@
+"""Command line tool that renders the wraps for many boxes at once.
+
+The boxes are listed in a CSV or JSON manifest.  Each entry names a
+template image and the same dimensions that are entered in the "Create
+wraps from template..." dialog:
+
+    template,width,height,depth,thickness,flap_size,inside_size
+    catan.png,75,104,100,2,10,15
+
+The columns name, crop_mark_size, crop_mark_distance and dpi, the
+resolution of the template, are optional.
+All jobs are rendered on a pool of worker processes.  Failing jobs do not
+stop the batch but are reported in the summary.
+
+Usage: python -m boxwrap_engine.batch MANIFEST [-o DIRECTORY] [-j JOBS]
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy
+
+from boxwrap_engine import bleed, cache, colour, imagefile, incremental, \
+    marks, plan, preview, render, stream, writers
+from boxwrap_engine.layout import DEFAULTS, DPI, PARAMETERS, WrapLayout
+from boxwrap_engine.preview import PREVIEW_DPI
+
+
+# Options for all jobs of a batch and their defaults
+OPTIONS = {
+    "format": "png",
+    "preview": None,
+    "band_height": None,
+    "svg_marks": False,
+    "incremental": False,
+    "cache": None,
+    "cache_size": cache.CACHE_SIZE,
+    "level": 6,
+    "encode_threads": 1,
+    "cmyk": None,
+    "rgb_profile": None,
+    "intent": "perceptual",
+    "cmyk_luts": colour.LUT_DIRECTORY,
+    "bleed": 0.0,
+    "bleed_mode": bleed.MODES[0],
+}  # type: Dict[str, Any]
+
+# The options that change the wrap files, an incremental run renders
+# from scratch when one of them differs from the last run
+OUTPUT_OPTIONS = ("format", "level", "cmyk", "rgb_profile",
+                  "intent")  # type: Tuple[str, ...]
+
+
+class ManifestError(ValueError):
+    """Raised when the manifest cannot be understood."""
+
+
+def read_manifest(path):
+    # type: (str) -> List[Dict[str, Any]]
+    """Reads the jobs from a CSV or JSON manifest.
+
+    Template paths are relative to the directory of the manifest.
+    Raises a ManifestError if two jobs have the same name, since they
+    would write the same files.
+    """
+
+    with open(path) as manifest:
+        if path.lower().endswith(".json"):
+            entries = json.load(manifest)
+            if isinstance(entries, dict):
+                entries = entries.get("jobs", [])
+        else:
+            entries = list(csv.DictReader(manifest))
+
+    base = os.path.dirname(os.path.abspath(path))  # type: str
+    jobs = []  # type: List[Dict[str, Any]]
+    numbers = {}  # type: Dict[str, int]
+    for number, entry in enumerate(entries, 1):
+        job = make_job(entry, base, number)  # type: Dict[str, Any]
+        # The wraps of both jobs would overwrite each other, also on file
+        # systems that ignore the case
+        other = numbers.setdefault(job["name"].lower(), number)  # type: int
+        if other != number:
+            raise ManifestError("Jobs %d and %d are both named %r, give "
+                                "them different names"
+                                % (other, number, job["name"]))
+        jobs.append(job)
+    return jobs
+
+
+def make_job(entry,   # type: Dict[str, Any]
+             base,    # type: str
+             number   # type: int
+             ):
+    # type: (...) -> Dict[str, Any]
+    """Turns one manifest entry into a job with all dimensions in mm."""
+
+    if not entry.get("template"):
+        raise ManifestError("Job %d has no template" % number)
+    template = os.path.join(base, entry["template"])  # type: str
+
+    job = {
+        "name": entry.get("name") or
+        os.path.splitext(os.path.basename(template))[0],
+        "template": template,
+    }  # type: Dict[str, Any]
+    for key in PARAMETERS:  # type: str
+        value = entry.get(key)
+        if value in (None, ""):
+            if key not in DEFAULTS:
+                raise ManifestError("Job %d has no %s" % (number, key))
+            value = DEFAULTS[key]
+        try:
+            job[key] = float(value)
+        except ValueError:
+            raise ManifestError("Job %d has an invalid %s: %r"
+                                % (number, key, value))
+    try:
+        job["dpi"] = float(entry.get("dpi") or DPI)
+    except ValueError:
+        raise ManifestError("Job %d has an invalid dpi: %r"
+                            % (number, entry["dpi"]))
+    return job
+
+
+def _read_region(template):
+    # type: (numpy.ndarray) -> Callable[[int, int, int, int], bytes]
+    """Returns a function that reads a rectangle of a template as
+    bytes."""
+
+    def read(x, y, width, height):
+        # type: (int, int, int, int) -> bytes
+        return numpy.ascontiguousarray(
+            template[y:y + height, x:x + width]).tobytes()
+    return read
+
+
+def _read_state(path):
+    # type: (str) -> Optional[Dict[str, Any]]
+    """Reads the state of the previous run or returns None."""
+
+    try:
+        with open(path) as state_file:
+            return incremental.load_state(state_file.read())
+    except IOError:
+        return None
+
+
+def update_wraps(template,   # type: numpy.ndarray
+                 layout,     # type: WrapLayout
+                 changed,    # type: List[Tuple[int, int, int, int]]
+                 paths,      # type: List[str]
+                 level=6,    # type: int
+                 threads=1   # type: Optional[int]
+                 ):
+    # type: (...) -> bool
+    """Draws the parts of existing wrap files that depend on the changed
+    rectangles of the template again.
+
+    Returns False if the files do not fit the layout and have to be
+    rendered from scratch.
+    """
+
+    wraps = []  # type: List[numpy.ndarray]
+    for path in paths:
+        pixels = numpy.array(imagefile.load_template(path))
+        if pixels.shape != (layout.dst_height, layout.dst_width, 3):
+            return False
+        wraps.append(pixels)
+
+    updated = []  # type: List[Tuple[str, numpy.ndarray]]
+    for operations, pixels, path in zip(plan.compile_plans(layout), wraps,
+                                        paths):
+        dirty = incremental.dirty_operations(operations, changed)
+        if not dirty:
+            continue
+        stream.update_wrap(template, layout, operations, pixels,
+                           [plan.destination_rectangle(operations[index])
+                            for index in dirty])
+        updated.append((path, pixels))
+    if updated:
+        writers.write_images([path for path, _ in updated],
+                             [pixels for _, pixels in updated], level,
+                             layout.dpi, threads)
+    return True
+
+
+def render_cached(template,    # type: numpy.ndarray
+                  layout,      # type: WrapLayout
+                  wrap_cache   # type: cache.WrapCache
+                  ):
+    # type: (...) -> List[numpy.ndarray]
+    """Renders the top and the bottom wrap or reads them from the cache
+    if the same template was rendered with the same layout before."""
+
+    layout.check_template_size(template.shape[1], template.shape[0])
+    template = render.flatten(template)
+    key = cache.wrap_key(template, layout)  # type: str
+    data = wrap_cache.get(key)  # type: Optional[List[memoryview]]
+    if data is not None:
+        return [numpy.frombuffer(pixels, dtype=numpy.uint8).reshape(
+            layout.dst_height, layout.dst_width, 3) for pixels in data]
+
+    wraps = render.render_wraps(template, layout)
+    wrap_cache.put(key, [pixels.tobytes() for pixels in wraps])
+    return list(wraps)
+
+
+def run_job(job,          # type: Dict[str, Any]
+            directory,    # type: str
+            options=None  # type: Optional[Dict[str, Any]]
+            ):
+    # type: (...) -> Dict[str, Any]
+    """Renders and saves the wraps of one job.
+
+    Never raises.  Errors are part of the returned result.
+    """
+
+    options = dict(OPTIONS, **(options or {}))
+
+    result = {
+        "name": job["name"],
+        "template": job["template"],
+        "outputs": [],
+        "timings": {},
+        "error": None,
+    }  # type: Dict[str, Any]
+    start = time.time()  # type: float
+
+    try:
+        layout = WrapLayout.from_mm(
+            *[job[key] for key in PARAMETERS],
+            dpi=job.get("dpi", DPI), bleed_mm=options["bleed"],
+            bleed_mode=options["bleed_mode"])  # type: WrapLayout
+
+        if options["cmyk"]:
+            # The lookup table is shared by all jobs of the process
+            convert = colour.CmykConverter(
+                options["cmyk"], options["rgb_profile"], options["intent"],
+                options["cmyk_luts"])  # type: Optional[CmykConverter]
+        else:
+            convert = None
+        template = imagefile.load_template(
+            job["template"], (layout.src_width, layout.src_height))
+        loaded = time.time()  # type: float
+        result["timings"]["load"] = loaded - start
+
+        suffix = "_preview" if options["preview"] else ""  # type: str
+        if options["format"] == "pdf":
+            # Both wraps are pages of the same document
+            paths = [os.path.join(directory, "%s%s.pdf"
+                                  % (job["name"], suffix))]
+        else:
+            paths = [os.path.join(directory, "%s_%s%s.%s"
+                                  % (job["name"], part, suffix,
+                                     options["format"]))
+                     for part in ("top", "bottom")]  # type: List[str]
+        state_path = os.path.join(directory, "%s_state.json"
+                                  % job["name"])  # type: str
+        changed = None  # type: Optional[List[Tuple[int, int, int, int]]]
+        output = dict((key, options[key])
+                      for key in OUTPUT_OPTIONS)  # type: Dict[str, Any]
+        if options["incremental"] and not options["preview"]:
+            layout.check_template_size(template.shape[1],
+                                       template.shape[0])
+            hashes = incremental.hash_regions(layout, _read_region(template))
+            if all(os.path.exists(path) for path in paths):
+                changed = incremental.changed_regions(
+                    layout, _read_state(state_path), hashes, output)
+            result["changed"] = None if changed is None else len(changed)
+
+        if changed is not None and (not changed or (
+                not options["band_height"] and options["format"] != "pdf"
+                # The bleed and the CMYK conversion need whole wraps
+                and convert is None and not layout.bleed
+                and update_wraps(template, layout, changed, paths,
+                                 options["level"],
+                                 options["encode_threads"]))):
+            # The wraps on disk are up to date now
+            rendered = time.time()  # type: float
+        elif options["format"] == "pdf":
+            # The PDF is always written band by band, so rendering and
+            # saving happen at the same time
+            if options["preview"]:
+                preview_layout = layout.at_resolution(options["preview"])
+                stream.render_wraps_to_pdf(
+                    preview.downsample_template(template, layout,
+                                                preview_layout),
+                    preview_layout, paths[0], level=options["level"])
+            else:
+                stream.render_wraps_to_pdf(
+                    template, layout, paths[0],
+                    options["band_height"] or stream.BAND_HEIGHT,
+                    options["level"])
+            rendered = time.time()
+        elif options["preview"]:
+            wraps = preview.render_preview(template, layout,
+                                           options["preview"])
+            rendered = time.time()
+            writers.write_images(paths, wraps, options["level"],
+                                 options["preview"],
+                                 options["encode_threads"], convert)
+        elif options["band_height"]:
+            # Rendering and saving happen at the same time, so it all
+            # counts as rendering
+            stream.render_wraps_to_files(template, layout, paths[0],
+                                         paths[1], options["band_height"],
+                                         options["level"],
+                                         options["encode_threads"], convert)
+            rendered = time.time()
+        elif options["cache"]:
+            wrap_cache = cache.WrapCache(options["cache"],
+                                         options["cache_size"])
+            wraps = render_cached(template, layout, wrap_cache)
+            rendered = time.time()
+            result["cache"] = dict(
+                (key, getattr(wrap_cache, key))
+                for key in ("hits", "misses", "evictions"))
+            writers.write_images(paths, wraps, options["level"], layout.dpi,
+                                 options["encode_threads"], convert)
+        else:
+            wraps = render.render_wraps(template, layout)
+            rendered = time.time()
+            writers.write_images(paths, wraps, options["level"], layout.dpi,
+                                 options["encode_threads"], convert)
+        result["timings"]["render"] = rendered - loaded
+        result["outputs"].extend(paths)
+        if options["incremental"] and not options["preview"]:
+            with open(state_path, "w") as state_file:
+                state_file.write(incremental.dump_state(
+                    incremental.make_state(layout, hashes, output)))
+        elif not options["preview"] and os.path.exists(state_path):
+            # The state no longer describes the wraps on disk
+            os.remove(state_path)
+
+        if options["svg_marks"]:
+            path = os.path.join(directory, "%s_marks.svg" % job["name"])
+            with open(path, "w") as output:
+                output.write(marks.marks_svg(layout))
+            result["outputs"].append(path)
+        result["timings"]["save"] = time.time() - rendered
+    except Exception as error:
+        result["error"] = "%s: %s" % (type(error).__name__, error)
+
+    result["timings"]["total"] = time.time() - start
+    return result
+
+
+def _run_job(arguments):
+    # type: (Tuple[Dict[str, Any], str, Dict[str, Any]]) -> Dict[str, Any]
+    """Unpacks the arguments for run_job in a worker process."""
+
+    return run_job(*arguments)
+
+
+def run_batch(jobs,            # type: List[Dict[str, Any]]
+              directory,       # type: str
+              processes=None,  # type: Optional[int]
+              options=None     # type: Optional[Dict[str, Any]]
+              ):
+    # type: (...) -> Dict[str, Any]
+    """Renders all jobs on a process pool and returns a summary."""
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    start = time.time()  # type: float
+    arguments = [(job, directory, options) for job in jobs]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_run_job, arguments, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    failures = [r for r in results if r["error"] is not None]
+    summary = {
+        "jobs": len(results),
+        "succeeded": len(results) - len(failures),
+        "failed": len(failures),
+        "seconds": time.time() - start,
+        "results": results,
+    }  # type: Dict[str, Any]
+
+    options = dict(OPTIONS, **(options or {}))
+    if options["cache"]:
+        # The workers had their own cache objects, so add up their counts
+        statistics = cache.WrapCache(options["cache"],
+                                     options["cache_size"]).statistics()
+        for key in ("hits", "misses", "evictions"):
+            statistics[key] = sum(r.get("cache", {}).get(key, 0)
+                                  for r in results)
+        lookups = statistics["hits"] + statistics["misses"]  # type: int
+        statistics["hit_rate"] = \
+            float(statistics["hits"]) / lookups if lookups else 0.0
+        summary["cache"] = statistics
+    return summary
+
+
+def main(argv=None):
+    # type: (Optional[List[str]]) -> int
+    """Runs the command line tool."""
+
+    parser = argparse.ArgumentParser(
+        description="Render the box wraps for all templates in a manifest.")
+    parser.add_argument("manifest",
+                        help="CSV or JSON file that lists the boxes")
+    parser.add_argument("-o", "--output", default="wraps",
+                        help="directory for the wraps and the summary")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of worker processes "
+                        "(default: number of cores)")
+    parser.add_argument("-f", "--format", choices=("png", "tif", "pdf"),
+                        default=OPTIONS["format"],
+                        help="file format of the wraps")
+    parser.add_argument("--preview", type=float, metavar="DPI",
+                        nargs="?", const=PREVIEW_DPI, default=None,
+                        help="only render quick previews at this "
+                        "resolution (default: %g dpi)" % PREVIEW_DPI)
+    parser.add_argument("--band-height", type=int, default=None,
+                        help="render and write the wraps in bands of this "
+                        "many rows to save memory")
+    parser.add_argument("--level", type=int, choices=range(10),
+                        default=OPTIONS["level"], metavar="0-9",
+                        help="compression level, lower is faster and "
+                        "larger (default: %(default)d)")
+    parser.add_argument("--encode-threads", type=int, metavar="N",
+                        nargs="?", const=None, default=1,
+                        help="compress the bands of both wraps at the same "
+                        "time on this many threads per job (default: 1, "
+                        "without N: one per core)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only draw the parts of the wraps again that "
+                        "depend on faces that changed since the last run")
+    parser.add_argument("--cache", metavar="DIRECTORY", default=None,
+                        help="reuse wraps that were rendered before from "
+                        "this cache directory")
+    parser.add_argument("--cache-size", type=float, metavar="MB",
+                        default=cache.CACHE_SIZE / (1024 * 1024),
+                        help="size limit of the cache (default: %(default)g"
+                        " MB)")
+    parser.add_argument("--svg-marks", action="store_true",
+                        help="also write the marks for cutting and folding "
+                        "as SVG vector graphics")
+    parser.add_argument("--bleed", type=float, metavar="MM", default=0.0,
+                        help="extend the picture beyond the outer edges "
+                        "by this much, at most the distance of the crop "
+                        "marks")
+    parser.add_argument("--bleed-mode", choices=bleed.MODES,
+                        default=OPTIONS["bleed_mode"],
+                        help="how the bleed is filled (default: "
+                        "%(default)s)")
+    parser.add_argument("--cmyk", metavar="PROFILE", default=None,
+                        help="write CMYK TIFF files for the printer with "
+                        "this ICC profile")
+    parser.add_argument("--rgb-profile", metavar="PROFILE", default=None,
+                        help="ICC profile of the templates (default: sRGB)")
+    parser.add_argument("--intent", choices=sorted(colour.INTENTS),
+                        default=OPTIONS["intent"],
+                        help="rendering intent of the CMYK conversion "
+                        "(default: %(default)s)")
+    parser.add_argument("--cmyk-luts", metavar="DIRECTORY",
+                        default=OPTIONS["cmyk_luts"],
+                        help="directory for the lookup tables of the CMYK "
+                        "conversion (default: %(default)s)")
+    args = parser.parse_args(argv)
+    if args.cmyk and args.format != "tif":
+        parser.error("--cmyk needs -f tif")
+
+    try:
+        jobs = read_manifest(args.manifest)
+        if args.cmyk:
+            # Builds the lookup table once before the workers start
+            colour.CmykConverter(args.cmyk, args.rgb_profile, args.intent,
+                                 args.cmyk_luts)
+    except (IOError, ValueError) as error:
+        sys.stderr.write("%s\n" % error)
+        return 2
+
+    options = {
+        "format": args.format,
+        "preview": args.preview,
+        "band_height": args.band_height,
+        "svg_marks": args.svg_marks,
+        "incremental": args.incremental,
+        "cache": args.cache,
+        "cache_size": int(args.cache_size * 1024 * 1024),
+        "level": args.level,
+        "encode_threads": args.encode_threads,
+        "cmyk": args.cmyk,
+        "rgb_profile": args.rgb_profile,
+        "intent": args.intent,
+        "cmyk_luts": args.cmyk_luts,
+        "bleed": args.bleed,
+        "bleed_mode": args.bleed_mode,
+    }  # type: Dict[str, Any]
+    summary = run_batch(jobs, args.output, args.jobs, options)
+    with open(os.path.join(args.output, "summary.json"), "w") as output:
+        json.dump(summary, output, indent=2)
+
+    for result in summary["results"]:
+        if result["error"] is None:
+            sys.stdout.write("ok      %-30s %6.2fs\n"
+                             % (result["name"], result["timings"]["total"]))
+        else:
+            sys.stdout.write("FAILED  %-30s %s\n"
+                             % (result["name"], result["error"]))
+    sys.stdout.write("%d of %d jobs succeeded in %.2fs\n"
+                     % (summary["succeeded"], summary["jobs"],
+                        summary["seconds"]))
+    if "cache" in summary:
+        sys.stdout.write("Cache: %d hits, %d misses, %d evictions, "
+                         "%.1f of %.1f MB used\n"
+                         % (summary["cache"]["hits"],
+                            summary["cache"]["misses"],
+                            summary["cache"]["evictions"],
+                            summary["cache"]["size"] / (1024.0 * 1024.0),
+                            summary["cache"]["max_size"]
+                            / (1024.0 * 1024.0)))
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,359 @@
+"""Print bleed around the outer edges of a wrap.
+
+The faces and the flaps of a wrap cover a cross shaped area.  With a
+bleed the picture is extended beyond its outer edges, so that a cut
+that is slightly off does not leave a white edge.  The bleed is filled
+from the pixels of the wrap next to each edge in one of three ways:
+
+    mirror   reflects the picture at the edge
+    stretch  repeats the pixels on the edge
+    copy     repeats the strip next to the edge as it is
+
+Every part of the bleed is a Fill: a rectangle whose pixel (dst_x + i,
+dst_y + j) comes from the wrap pixel (src_x + step_x * i, src_y +
+step_y * j), where a step is 1, -1 for mirrored, or 0 for repeated
+pixels.  Fills are run with array slicing, so no pixel is moved on its
+own and no intermediate images are needed.
+
+Usage: python -m boxwrap_engine.bleed [--layouts N] to check that the
+bleed never covers a mark in any of the renderers
+"""
+
+import argparse
+import collections
+import sys
+
+import numpy
+
+from boxwrap_engine import plan
+
+
+# How the bleed is filled, the first one is the default
+MODES = ("mirror", "stretch", "copy")  # type: Tuple[str, ...]
+
+Fill = collections.namedtuple(
+    "Fill", ("dst_x", "dst_y", "width", "height", "src_x", "src_y",
+             "step_x", "step_y"))
+
+
+def _beyond(edge,    # type: int
+            inward,  # type: int
+            size,    # type: int
+            mode     # type: str
+            ):
+    # type: (...) -> Tuple[int, int, int]
+    """Returns where the bleed beyond an edge starts, and its first
+    source position and step, along the axis across the edge.
+
+    inward is 1 if the picture starts at the edge and -1 if it ends
+    there.
+    """
+
+    if inward > 0:
+        start = edge - size  # type: int
+        if mode == "stretch":
+            return start, edge, 0
+        if mode == "mirror":
+            return start, edge + size - 1, -1
+        return start, edge, 1
+    if mode == "stretch":
+        return edge, edge - 1, 0
+    if mode == "mirror":
+        return edge, edge - 1, -1
+    return edge, edge - size, 1
+
+
+def _cells(rectangles  # type: List[Tuple[int, int, int, int]]
+           ):
+    # type: (...) -> Tuple[List[int], List[int], numpy.ndarray]
+    """Splits the union of rectangles into a grid of cells at all of
+    their edges.
+
+    Returns the x and the y positions of the grid lines and which cells
+    are covered.  Cell (row, column) lies between the lines row - 1 and
+    row, and column - 1 and column, so the outermost rows and columns
+    stand for everything outside of the grid and are never covered.
+    """
+
+    xs = sorted(set([r[0] for r in rectangles] +
+                    [r[0] + r[2] for r in rectangles]))  # type: List[int]
+    ys = sorted(set([r[1] for r in rectangles] +
+                    [r[1] + r[3] for r in rectangles]))  # type: List[int]
+    covered = numpy.zeros((len(ys) + 1, len(xs) + 1), dtype=bool)
+    for x, y, width, height in rectangles:
+        covered[ys.index(y) + 1:ys.index(y + height) + 1,
+                xs.index(x) + 1:xs.index(x + width) + 1] = True
+    return xs, ys, covered
+
+
+def _covers(rectangle,  # type: Tuple[int, int, int, int]
+            xs,         # type: List[int]
+            ys,         # type: List[int]
+            covered     # type: numpy.ndarray
+            ):
+    # type: (...) -> Optional[bool]
+    """Returns True if the cells cover all of a rectangle, False if they
+    cover none of it, and None if they cover a part."""
+
+    x, y, width, height = rectangle
+    columns = numpy.searchsorted(xs, [x, x + width], side="right")
+    rows = numpy.searchsorted(ys, [y, y + height], side="right")
+    if x + width in xs:
+        columns[1] -= 1
+    if y + height in ys:
+        rows[1] -= 1
+    cells = covered[rows[0]:rows[1] + 1, columns[0]:columns[1] + 1]
+    if cells.all():
+        return True
+    if not cells.any():
+        return False
+    return None
+
+
+def _merge(fills):
+    # type: (List[Fill]) -> List[Fill]
+    """Merges fills that continue each other along an edge."""
+
+    merged = []  # type: List[Fill]
+    for fill in sorted(fills, key=lambda f: (f.dst_y, f.dst_x)):
+        last = merged[-1] if merged else None  # type: Optional[Fill]
+        if last is not None and last.step_x == fill.step_x == 1 and \
+           (last.dst_y, last.height, last.src_y, last.step_y) == \
+           (fill.dst_y, fill.height, fill.src_y, fill.step_y) and \
+           last.dst_x + last.width == fill.dst_x and \
+           last.src_x + last.width == fill.src_x:
+            merged[-1] = last._replace(width=last.width + fill.width)
+            continue
+        for index, other in enumerate(merged):
+            if other.step_y == fill.step_y == 1 and \
+               (other.dst_x, other.width, other.src_x, other.step_x) == \
+               (fill.dst_x, fill.width, fill.src_x, fill.step_x) and \
+               other.dst_y + other.height == fill.dst_y and \
+               other.src_y + other.height == fill.src_y:
+                merged[index] = other._replace(height=other.height +
+                                               fill.height)
+                break
+        else:
+            merged.append(fill)
+    return merged
+
+
+def source_rectangle(fill):
+    # type: (Fill) -> Tuple[int, int, int, int]
+    """Returns the rectangle of the wrap that a fill reads."""
+
+    def span(start, step, length):
+        # type: (int, int, int) -> Tuple[int, int]
+        end = start + step * (length - 1)  # type: int
+        return min(start, end), abs(end - start) + 1
+
+    x, width = span(fill.src_x, fill.step_x, fill.width)
+    y, height = span(fill.src_y, fill.step_y, fill.height)
+    return x, y, width, height
+
+
+def bleed_fills(layout,      # type: WrapLayout
+                operations   # type: List[Copy]
+                ):
+    # type: (...) -> List[Fill]
+    """Returns the fills of the bleed of one wrap, or an empty list if
+    the layout has no bleed.
+
+    The edges are those of the area that the render plan covers.  The
+    sides come first and the outer corners last, and where the sides of
+    an inner corner overlap either one may win.  Raises a ValueError if
+    the bleed does not fit around the picture.
+    """
+
+    size = layout.bleed  # type: int
+    if not size:
+        return []
+    mode = layout.bleed_mode  # type: str
+    if mode not in MODES:
+        raise ValueError("The bleed mode must be one of %s"
+                         % ", ".join(MODES))
+    rectangles = [plan.destination_rectangle(copy) for copy in operations]
+    xs, ys, covered = _cells(rectangles)
+
+    sides = []    # type: List[Fill]
+    corners = []  # type: List[Fill]
+    for row in range(1, len(ys)):
+        for column in range(1, len(xs)):
+            if not covered[row, column]:
+                continue
+            left, right = xs[column - 1], xs[column]  # type: int, int
+            top, bottom = ys[row - 1], ys[row]        # type: int, int
+            # The edges of the cell, the direction into it, and the
+            # neighbour beyond them
+            horizontal = ((left, 1, column - 1), (right, -1, column + 1))
+            vertical = ((top, 1, row - 1), (bottom, -1, row + 1))
+            for edge, inward, neighbour in horizontal:
+                if not covered[row, neighbour]:
+                    dst_x, src_x, step_x = _beyond(edge, inward, size, mode)
+                    sides.append(Fill(dst_x, top, size, bottom - top,
+                                      src_x, top, step_x, 1))
+            for edge, inward, neighbour in vertical:
+                if not covered[neighbour, column]:
+                    dst_y, src_y, step_y = _beyond(edge, inward, size, mode)
+                    sides.append(Fill(left, dst_y, right - left, size,
+                                      left, src_y, 1, step_y))
+            for x_edge, x_inward, x_neighbour in horizontal:
+                for y_edge, y_inward, y_neighbour in vertical:
+                    if covered[row, x_neighbour] or \
+                       covered[y_neighbour, column] or \
+                       covered[y_neighbour, x_neighbour]:
+                        continue
+                    dst_x, src_x, step_x = _beyond(x_edge, x_inward, size,
+                                                   mode)
+                    dst_y, src_y, step_y = _beyond(y_edge, y_inward, size,
+                                                   mode)
+                    corners.append(Fill(dst_x, dst_y, size, size, src_x,
+                                        src_y, step_x, step_y))
+
+    fills = _merge(sides) + corners
+    for fill in fills:
+        destination = (fill.dst_x, fill.dst_y, fill.width, fill.height)
+        if not plan.contains((0, 0, layout.dst_width, layout.dst_height),
+                             destination) or \
+           _covers(destination, xs, ys, covered) is not False or \
+           not _covers(source_rectangle(fill), xs, ys, covered):
+            raise ValueError("A bleed of %dpx does not fit around this "
+                             "wrap" % size)
+    return fills
+
+
+def _slice(start,  # type: int
+           step,   # type: int
+           length  # type: int
+           ):
+    # type: (...) -> slice
+    """Returns the slice that reads length positions from start with a
+    step of 1, -1, or 0, where 0 reads the first position only."""
+
+    if step == 0:
+        return slice(start, start + 1)
+    stop = start + step * length  # type: int
+    return slice(start, stop if stop >= 0 else None, step)
+
+
+def fill_pixels(source,  # type: numpy.ndarray
+                fill,    # type: Fill
+                x=0,     # type: int
+                y=0      # type: int
+                ):
+    # type: (...) -> numpy.ndarray
+    """Returns the pixels of a fill as a read-only view of the source,
+    an array that holds the wrap from x, y on."""
+
+    pixels = source[_slice(fill.src_y - y, fill.step_y, fill.height),
+                    _slice(fill.src_x - x, fill.step_x, fill.width)]
+    return numpy.broadcast_to(pixels, (fill.height, fill.width) +
+                              source.shape[2:])
+
+
+def apply_fills(pixels,  # type: numpy.ndarray
+                fills    # type: List[Fill]
+                ):
+    # type: (...) -> None
+    """Fills the bleed of a whole wrap in place.  The wrap may also be a
+    lookup table of the same size."""
+
+    for fill in fills:
+        pixels[fill.dst_y:fill.dst_y + fill.height,
+               fill.dst_x:fill.dst_x + fill.width] = \
+            fill_pixels(pixels, fill)
+
+
+def clip_fill(fill,  # type: Fill
+              area   # type: Tuple[int, int, int, int]
+              ):
+    # type: (...) -> Optional[Fill]
+    """Returns the part of a fill inside an area, or None if there is
+    nothing left."""
+
+    left = max(fill.dst_x, area[0])  # type: int
+    top = max(fill.dst_y, area[1])   # type: int
+    right = min(fill.dst_x + fill.width, area[0] + area[2])   # type: int
+    bottom = min(fill.dst_y + fill.height, area[1] + area[3])  # type: int
+    if left >= right or top >= bottom:
+        return None
+    return Fill(left, top, right - left, bottom - top,
+                fill.src_x + fill.step_x * (left - fill.dst_x),
+                fill.src_y + fill.step_y * (top - fill.dst_y),
+                fill.step_x, fill.step_y)
+
+
+def _covered_marks(layout,  # type: WrapLayout
+                   wrap     # type: numpy.ndarray
+                   ):
+    # type: (...) -> List[Tuple[int, int, int, int]]
+    """Returns the marks of a wrap that are not black."""
+
+    from boxwrap_engine import marks
+    from boxwrap_engine.layout import clip_rectangle
+    covered = []  # type: List[Tuple[int, int, int, int]]
+    for rectangle in marks.mark_rectangles(layout):
+        x, y, width, height = clip_rectangle(
+            *rectangle, bounds_width=wrap.shape[1],
+            bounds_height=wrap.shape[0])
+        if wrap[y:y + height, x:x + width].any():
+            covered.append(rectangle)
+    return covered
+
+
+def main(argv=None):
+    # type: (Optional[List[str]]) -> int
+    """Renders random layouts with a bleed in every mode with all
+    renderers and reports the marks that are not black."""
+
+    from boxwrap_engine import marks, plan as plans, render, stream, sweep
+    from boxwrap_engine.layout import WrapLayout
+
+    parser = argparse.ArgumentParser(
+        description="Check that the bleed never covers a mark.")
+    parser.add_argument("--layouts", type=int, default=200,
+                        help="number of random layouts (default: "
+                        "%(default)d)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the random layouts")
+    args = parser.parse_args(argv)
+
+    random = numpy.random.RandomState(args.seed)
+    checked = failed = 0  # type: int
+    while checked < args.layouts:
+        dimensions = [int(size) for size in random.randint(1, 20, 8)]
+        dimensions[:3] = [size + 5 for size in dimensions[:3]]
+        try:
+            layout = WrapLayout(*dimensions, bleed=random.randint(
+                1, dimensions[7] + 1), bleed_mode=MODES[checked % 3])
+        except ValueError:
+            # The bleed does not fit
+            continue
+        checked += 1
+        # Template pixels are never black, so covered marks show up
+        template = random.randint(1, 256, (layout.src_height,
+                                           layout.src_width, 3)).astype(
+                                               numpy.uint8)
+        wraps = list(render.render_wraps(template, layout))
+        for variant in sweep.sweep(template, [sweep.Variant(
+                0, 0, 0, layout)]):
+            wraps.extend(variant[1:])
+        for operations in plans.compile_plans(layout):
+            marks_last = marks.drawn_last(layout, operations)
+            wraps.append(stream.render_region(
+                template, layout, operations, not marks_last, marks_last,
+                0, 0, layout.dst_width, layout.dst_height))
+        for wrap in wraps:
+            covered = _covered_marks(layout, wrap)
+            if covered:
+                failed += 1
+                sys.stdout.write("%s in %s mode covers the marks %s\n"
+                                 % (layout.key(), layout.bleed_mode,
+                                    covered))
+                break
+    sys.stdout.write("%d of %d layouts cover marks\n" % (failed, checked))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
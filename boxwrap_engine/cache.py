@@ -0,0 +1,250 @@
+"""Content addressed cache for finished wraps on the local disk.
+
+A rendered pair of wraps is stored under a hash of the flattened
+template pixels and of the layout, so rendering the same template with
+the same dimensions again just reads the wraps back.  The cache has a
+size limit.  When it is full the entries that were used least recently
+are removed first.
+
+The pixels are stored as raw RGB bytes, so the GIMP plugin and the
+headless engine can share a cache.
+
+Usage: python -m boxwrap_engine.cache DIRECTORY [--clear]
+"""
+
+import hashlib
+import os
+import struct
+import sys
+import zlib
+
+
+# Changes whenever the same template and layout may render differently
+CACHE_VERSION = 1  # type: int
+
+# Size limit of a cache in bytes unless another one is asked for
+CACHE_SIZE = 1024 * 1024 * 1024  # type: int
+
+_MAGIC = b"BOXWRAP1"   # type: bytes
+_SUFFIX = ".wraps"     # type: str
+_CHUNK_SIZE = 1 << 22  # type: int
+
+
+def wrap_key(pixels,  # type: Union[bytes, numpy.ndarray]
+             layout   # type: WrapLayout
+             ):
+    # type: (...) -> str
+    """Returns the cache key for a template given as its flattened RGB
+    pixels and the layout of the wraps."""
+
+    digest = hashlib.sha256()
+    digest.update(("%d %r %r\n" % (CACHE_VERSION, layout.key(), layout.dpi))
+                  .encode("ascii"))
+    digest.update(pixels)
+    return digest.hexdigest()
+
+
+class WrapCache:
+    """Stores the top and the bottom wrap for a key in one file per
+    entry.
+
+    The modification time of an entry file is the time it was last used.
+    Several processes may share a cache directory.
+    """
+
+    def __init__(self,
+                 directory,            # type: str
+                 max_size=CACHE_SIZE   # type: int
+                 ):
+        # type: (...) -> None
+        self.directory = directory  # type: str
+        self.max_size = max_size    # type: int
+        self.hits = 0               # type: int
+        self.misses = 0             # type: int
+        self.evictions = 0          # type: int
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process may have created it in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        # The limit may be lower than when the entries were stored
+        self.evict()
+
+    def _path(self, key):
+        # type: (str) -> str
+        """Returns the file name of an entry."""
+
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def get(self, key):
+        # type: (str) -> Optional[List[memoryview]]
+        """Returns the raw RGB pixels of the top and the bottom wrap, or
+        None if they are not in the cache.  Both are views of one
+        buffer, so the wraps are not copied."""
+
+        path = self._path(key)  # type: str
+        try:
+            with open(path, "rb") as entry:
+                data = zlib.decompress(entry.read())  # type: bytes
+            os.utime(path, None)
+        except (IOError, OSError, zlib.error):
+            self.misses += 1
+            return None
+
+        if not data.startswith(_MAGIC):
+            self.misses += 1
+            return None
+        offset = len(_MAGIC)  # type: int
+        top_size, bottom_size = struct.unpack_from(">QQ", data, offset)
+        offset += 16
+        if len(data) != offset + top_size + bottom_size:
+            self.misses += 1
+            return None
+        self.hits += 1
+        view = memoryview(data)
+        return [view[offset:offset + top_size], view[offset + top_size:]]
+
+    def put(self,
+            key,    # type: str
+            wraps   # type: List[bytes]
+            ):
+        # type: (...) -> None
+        """Stores the raw RGB pixels of the top and the bottom wrap and
+        makes room for them if the cache is full.  An entry larger than
+        the whole cache is not stored at all."""
+
+        top, bottom = wraps
+        path = self._path(key)  # type: str
+        temporary = "%s.%d.tmp" % (path, os.getpid())  # type: str
+        compressor = zlib.compressobj(1)
+        size = 0  # type: int
+        try:
+            with open(temporary, "wb") as entry:
+                for data in _pieces(top, bottom):
+                    data = compressor.compress(data)
+                    size += len(data)
+                    if size > self.max_size:
+                        break
+                    entry.write(data)
+                else:
+                    data = compressor.flush()
+                    size += len(data)
+                    entry.write(data)
+            if size > self.max_size:
+                # It would be evicted right away
+                _remove(temporary)
+                return
+            try:
+                os.rename(temporary, path)
+            except OSError:
+                # Windows does not replace existing files
+                _remove(path)
+                os.rename(temporary, path)
+        except BaseException:
+            _remove(temporary)
+            raise
+        self.evict()
+
+    def entries(self):
+        # type: () -> List[Tuple[float, int, str]]
+        """Returns (last use, size, path) of all entries, least recently
+        used first."""
+
+        entries = []  # type: List[Tuple[float, int, str]]
+        for name in os.listdir(self.directory):
+            if not name.endswith(_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)  # type: str
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        # type: () -> None
+        """Removes the least recently used entries until the cache fits
+        into its size limit."""
+
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)  # type: int
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            if _remove(path):
+                self.evictions += 1
+            size -= entry_size
+
+    def clear(self):
+        # type: () -> None
+        """Removes all entries."""
+
+        for _, _, path in self.entries():
+            _remove(path)
+
+    def statistics(self):
+        # type: () -> Dict[str, Any]
+        """Returns the hits, misses, and evictions of this cache object
+        and the number and the total size of the entries on disk."""
+
+        entries = self.entries()
+        lookups = self.hits + self.misses  # type: int
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "size": sum(entry[1] for entry in entries),
+            "max_size": self.max_size,
+        }
+
+
+def _pieces(top,    # type: bytes
+            bottom  # type: bytes
+            ):
+    # type: (...) -> Iterator[bytes]
+    """Yields the header and the pixels of an entry in chunks."""
+
+    yield _MAGIC + struct.pack(">QQ", len(top), len(bottom))
+    for pixels in (top, bottom):
+        for start in range(0, len(pixels), _CHUNK_SIZE):
+            yield pixels[start:start + _CHUNK_SIZE]
+
+
+def _remove(path):
+    # type: (str) -> bool
+    """Removes a file that another process may have removed already."""
+
+    try:
+        os.remove(path)
+    except OSError:
+        return False
+    return True
+
+
+def main(argv=None):
+    # type: (Optional[List[str]]) -> int
+    """Shows how full a cache is or clears it."""
+
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) not in (1, 2) or argv[1:] not in ([], ["--clear"]):
+        sys.stderr.write(__doc__.split("Usage: ")[-1])
+        return 2
+
+    cache = WrapCache(argv[0])  # type: WrapCache
+    if argv[1:]:
+        cache.clear()
+    statistics = cache.statistics()
+    sys.stdout.write("%d entries, %.1f MB\n"
+                     % (statistics["entries"],
+                        statistics["size"] / (1024.0 * 1024.0)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
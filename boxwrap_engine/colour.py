@@ -0,0 +1,344 @@
+"""Conversion of the wraps to CMYK with an ICC profile.
+
+Converting every pixel with littleCMS is slow for large wraps.  Instead
+the conversion is sampled once on a grid of RGB colours, 52 steps of 5
+per channel, and the wraps are converted by tetrahedral interpolation in
+that lookup table with NumPy.  The table only depends on the two
+profiles and the rendering intent, so it is kept in memory for all jobs
+of a process and stored in a directory for later runs, by default in
+the cache folder of the user.
+
+Usage: python -m boxwrap_engine.colour CMYK_PROFILE [--rgb-profile ICC]
+       [--intent INTENT] to build the table and compare it to littleCMS
+"""
+
+import argparse
+import hashlib
+import io
+import os
+import sys
+
+import numpy
+from PIL import Image, ImageCms
+
+
+# Distance between two grid points in 8 bit channel values.  It divides
+# 255, so that the grid points are exact channel values.
+GRID_STEP = 5  # type: int
+GRID = 255 // GRID_STEP + 1  # type: int
+
+# The rendering intents of ICC profiles
+INTENTS = {
+    "perceptual": ImageCms.Intent.PERCEPTUAL,
+    "relative": ImageCms.Intent.RELATIVE_COLORIMETRIC,
+    "saturation": ImageCms.Intent.SATURATION,
+    "absolute": ImageCms.Intent.ABSOLUTE_COLORIMETRIC,
+}  # type: Dict[str, int]
+
+
+def _cache_directory():
+    # type: () -> str
+    """Returns the folder of the current user for cached files."""
+
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or \
+            os.path.join(os.path.expanduser("~"), "AppData", "Local")
+    elif sys.platform == "darwin":
+        base = os.path.join(os.path.expanduser("~"), "Library", "Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or \
+            os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "boxwrap")
+
+
+# Where lookup tables are stored unless another directory is given.  It
+# belongs to the user, so no one else can put tables there.
+LUT_DIRECTORY = os.path.join(_cache_directory(), "luts")  # type: str
+
+# Lookup tables of this process by key
+_luts = {}  # type: Dict[str, numpy.ndarray]
+
+# For every channel value, the grid cell below it and the position in
+# the cell from 0 to GRID_STEP.  255 is the end of the last cell.
+_CELLS = numpy.minimum(numpy.arange(256) // GRID_STEP,
+                       GRID - 2).astype(numpy.intp)  # type: numpy.ndarray
+_POSITIONS = (numpy.arange(256) -
+              _CELLS * GRID_STEP)  # type: numpy.ndarray
+
+
+class ColourError(ValueError):
+    """Raised when a profile cannot be used for the conversion."""
+
+
+def _read_profile(path):
+    # type: (Optional[str]) -> bytes
+    """Returns the data of an ICC profile, or of sRGB for None."""
+
+    if path is None:
+        return ImageCms.ImageCmsProfile(
+            ImageCms.createProfile("sRGB")).tobytes()
+    with open(path, "rb") as profile:
+        return profile.read()
+
+
+def lut_key(source,  # type: bytes
+            target,  # type: bytes
+            intent   # type: str
+            ):
+    # type: (...) -> str
+    """Returns a key that identifies the lookup table of a conversion."""
+
+    digest = hashlib.sha1()
+    for data in (source, target, intent.encode("ascii"),
+                 str(GRID_STEP).encode("ascii")):
+        digest.update(hashlib.sha1(data).digest())
+    return digest.hexdigest()
+
+
+def build_lut(source,  # type: bytes
+              target,  # type: bytes
+              intent,  # type: str
+              mode     # type: str
+              ):
+    # type: (...) -> numpy.ndarray
+    """Converts the grid colours from the source RGB profile to the
+    target profile with littleCMS.  Returns an array of shape (GRID,
+    GRID, GRID, channels) indexed by red, green, and blue."""
+
+    try:
+        transform = ImageCms.buildTransform(
+            ImageCms.ImageCmsProfile(io.BytesIO(source)),
+            ImageCms.ImageCmsProfile(io.BytesIO(target)),
+            "RGB", mode, INTENTS[intent])
+    except (ImageCms.PyCMSError, OSError) as error:
+        raise ColourError("Cannot convert with these profiles: %s" % error)
+    values = numpy.arange(GRID, dtype=numpy.uint8) * GRID_STEP
+    grid = numpy.empty((GRID, GRID, GRID, 3), dtype=numpy.uint8)
+    grid[..., 0] = values[:, None, None]
+    grid[..., 1] = values[None, :, None]
+    grid[..., 2] = values[None, None, :]
+    image = Image.fromarray(grid.reshape(GRID * GRID, GRID, 3))
+    converted = numpy.asarray(ImageCms.applyTransform(image, transform))
+    return converted.reshape(GRID, GRID, GRID, -1)
+
+
+def load_lut(source,                 # type: bytes
+             target,                 # type: bytes
+             intent="perceptual",    # type: str
+             mode="CMYK",            # type: str
+             directory=LUT_DIRECTORY  # type: Optional[str]
+             ):
+    # type: (...) -> numpy.ndarray
+    """Returns the lookup table of a conversion from memory, from the
+    directory, or by building it and storing it in both.
+
+    A stored table that cannot be read or does not have the shape of a
+    table for the mode is built again and replaced.
+    """
+
+    key = lut_key(source, target, intent)  # type: str
+    lut = _luts.get(key)
+    if lut is not None:
+        return lut
+    path = directory and os.path.join(directory, "%s.npy" % key)
+    if path and os.path.exists(path):
+        lut = _read_lut(path, mode)
+    if lut is None:
+        lut = build_lut(source, target, intent, mode)
+        if path:
+            _write_lut(path, lut)
+    _luts[key] = lut
+    return lut
+
+
+def _read_lut(path,  # type: str
+              mode   # type: str
+              ):
+    # type: (...) -> Optional[numpy.ndarray]
+    """Reads a stored lookup table, or returns None if the file is
+    damaged or holds a table of another kind."""
+
+    try:
+        lut = numpy.load(path, allow_pickle=False)
+    except (IOError, OSError, ValueError, EOFError):
+        return None
+    if not isinstance(lut, numpy.ndarray) or lut.dtype != numpy.uint8 or \
+       lut.shape != (GRID, GRID, GRID, Image.getmodebands(mode)):
+        return None
+    return lut
+
+
+def _write_lut(path,  # type: str
+               lut    # type: numpy.ndarray
+               ):
+    # type: (...) -> None
+    """Stores a lookup table so that other processes never read a half
+    written file."""
+
+    directory = os.path.dirname(path)  # type: str
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temporary = "%s.%d.tmp" % (path, os.getpid())  # type: str
+    try:
+        with open(temporary, "wb") as output:
+            numpy.save(output, lut)
+        try:
+            os.rename(temporary, path)
+        except OSError:
+            # Windows does not replace existing files, such as a damaged
+            # table
+            os.remove(path)
+            os.rename(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def pack_lut(lut):
+    # type: (numpy.ndarray) -> numpy.ndarray
+    """Packs up to four channels of every grid point of a lookup table
+    into the 16 bit lanes of one 64 bit integer.
+
+    A weighted sum of four grid points with weights that add up to
+    GRID_STEP stays below 2 ** 16 in every lane, so the channels of a
+    colour are interpolated all at once.
+    """
+
+    table = lut.reshape(-1, lut.shape[-1]).astype(numpy.uint64)
+    packed = numpy.zeros(len(table), dtype=numpy.uint64)
+    for channel in range(table.shape[1]):
+        packed |= table[:, channel] << numpy.uint64(16 * channel)
+    return packed
+
+
+def interpolate(packed,      # type: numpy.ndarray
+                pixels,      # type: numpy.ndarray
+                channels=4   # type: int
+                ):
+    # type: (...) -> numpy.ndarray
+    """Converts RGB pixels of shape (..., 3) through a packed lookup
+    table by tetrahedral interpolation.
+
+    Each grid cell is split into six tetrahedra along its diagonal from
+    black to white.  The tetrahedron of a colour steps from the black
+    corner along the axis where the colour is furthest into the cell,
+    then along the next one, to the white corner.
+    """
+
+    shape = pixels.shape[:-1]  # type: Tuple[int, ...]
+    pixels = pixels.reshape(-1, 3)
+    red, green, blue = pixels[:, 0], pixels[:, 1], pixels[:, 2]
+    base = (_CELLS[red] * (GRID * GRID) + _CELLS[green] * GRID +
+            _CELLS[blue])  # type: numpy.ndarray
+    r, g, b = _POSITIONS[red], _POSITIONS[green], _POSITIONS[blue]
+    largest = numpy.maximum(numpy.maximum(r, g), b)
+    smallest = numpy.minimum(numpy.minimum(r, g), b)
+    middle = r + g + b - largest - smallest
+
+    # With equal positions the corners in between have no weight, so it
+    # does not matter which axis comes first
+    first = base + numpy.where(r == largest, GRID * GRID,
+                               numpy.where(g == largest, GRID, 1))
+    last = base + (GRID * GRID + GRID + 1)
+    second = last - numpy.where(b == smallest, 1,
+                                numpy.where(g == smallest, GRID,
+                                            GRID * GRID))
+
+    result = packed[base] * (GRID_STEP - largest).astype(numpy.uint64)
+    result += packed[first] * (largest - middle).astype(numpy.uint64)
+    result += packed[second] * (middle - smallest).astype(numpy.uint64)
+    result += packed[last] * smallest.astype(numpy.uint64)
+
+    converted = numpy.empty((len(pixels), channels), dtype=numpy.uint8)
+    for channel in range(channels):
+        lane = (result >> numpy.uint64(16 * channel)) & numpy.uint64(0xffff)
+        # Round to the nearest channel value
+        converted[:, channel] = (lane + GRID_STEP // 2) // GRID_STEP
+    return converted.reshape(shape + (channels,))
+
+
+class CmykConverter:
+    """Converts bands of RGB pixels to CMYK with a cached lookup
+    table."""
+
+    # Pixels converted at a time, small enough to stay in the caches
+    CHUNK = 1 << 16  # type: int
+
+    def __init__(self,
+                 cmyk_profile,              # type: str
+                 rgb_profile=None,          # type: Optional[str]
+                 intent="perceptual",       # type: str
+                 directory=LUT_DIRECTORY    # type: Optional[str]
+                 ):
+        # type: (...) -> None
+        if intent not in INTENTS:
+            raise ColourError("The rendering intent must be one of %s"
+                              % ", ".join(sorted(INTENTS)))
+        self.profile = _read_profile(cmyk_profile)  # type: bytes
+        try:
+            space = ImageCms.ImageCmsProfile(
+                io.BytesIO(self.profile)).profile.xcolor_space.strip()
+        except (ImageCms.PyCMSError, OSError) as error:
+            raise ColourError("%s is not an ICC profile: %s"
+                              % (cmyk_profile, error))
+        if space != "CMYK":
+            raise ColourError("%s is a %s profile, not a CMYK one"
+                              % (cmyk_profile, space))
+        self.lut = pack_lut(load_lut(
+            _read_profile(rgb_profile), self.profile, intent, "CMYK",
+            directory))  # type: numpy.ndarray
+
+    def __call__(self, band):
+        # type: (numpy.ndarray) -> numpy.ndarray
+        """Returns the CMYK pixels of a band of RGB pixels."""
+
+        rows, width = band.shape[:2]
+        pixels = band.reshape(-1, 3)
+        converted = numpy.empty((rows * width, 4), dtype=numpy.uint8)
+        for start in range(0, len(pixels), self.CHUNK):
+            converted[start:start + self.CHUNK] = interpolate(
+                self.lut, pixels[start:start + self.CHUNK])
+        return converted.reshape(rows, width, 4)
+
+
+def main(argv=None):
+    # type: (Optional[List[str]]) -> int
+    """Builds the lookup table of a CMYK profile and reports how far it
+    is from converting every colour with littleCMS."""
+
+    parser = argparse.ArgumentParser(
+        description="Build the lookup table for converting wraps to CMYK "
+        "and check its accuracy.")
+    parser.add_argument("profile", help="ICC profile of the printer")
+    parser.add_argument("--rgb-profile", default=None,
+                        help="ICC profile of the wraps (default: sRGB)")
+    parser.add_argument("--intent", choices=sorted(INTENTS),
+                        default="perceptual", help="rendering intent")
+    parser.add_argument("--directory", default=LUT_DIRECTORY,
+                        help="directory of the lookup tables (default: "
+                        "%(default)s)")
+    args = parser.parse_args(argv)
+
+    try:
+        converter = CmykConverter(args.profile, args.rgb_profile,
+                                  args.intent, args.directory)
+    except (IOError, ValueError) as error:
+        sys.stderr.write("%s\n" % error)
+        return 2
+    colours = numpy.random.RandomState(0).randint(
+        0, 256, (1000, 1000, 3)).astype(numpy.uint8)
+    exact = numpy.asarray(ImageCms.applyTransform(
+        Image.fromarray(colours), ImageCms.buildTransform(
+            ImageCms.ImageCmsProfile(io.BytesIO(_read_profile(
+                args.rgb_profile))),
+            ImageCms.ImageCmsProfile(io.BytesIO(converter.profile)),
+            "RGB", "CMYK", INTENTS[args.intent])))
+    error = numpy.abs(converter(colours).astype(int) - exact)
+    sys.stdout.write("Largest difference %d, mean %.3f of 255\n"
+                     % (error.max(), error.mean()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,43 @@
+"""Reading templates from and writing wraps to image files.
+
+Files are decoded and encoded with Pillow, which is only needed when the
+engine is used outside of GIMP.  Uncompressed templates are memory
+mapped instead of decoded.
+"""
+
+import numpy
+from PIL import Image
+
+from boxwrap_engine import mapped
+from boxwrap_engine.layout import DPI
+
+
+def load_template(path,       # type: str
+                  size=None   # type: Optional[Tuple[int, int]]
+                  ):
+    # type: (...) -> numpy.ndarray
+    """Reads a template image as an array of shape (height, width,
+    channels).
+
+    Uncompressed TIFF, PPM/PAM, and raw files are only mapped into
+    memory, so their pixels are read when they are used.  Raw files need
+    the size (width, height) of the template.
+    """
+
+    template = mapped.open_template(path, size)
+    if template is not None:
+        return template
+    image = Image.open(path)
+    if image.mode not in ("L", "LA", "RGB", "RGBA"):
+        image = image.convert("RGBA")
+    return numpy.asarray(image)
+
+
+def save_wrap(path,     # type: str
+              pixels,   # type: numpy.ndarray
+              dpi=DPI   # type: float
+              ):
+    # type: (...) -> None
+    """Writes a wrap image.  The format is chosen by the file name."""
+
+    Image.fromarray(pixels).save(path, dpi=(dpi, dpi))
@@ -0,0 +1,435 @@
+"""Gang imposition of many wraps onto print sheets.
+
+Every wrap is a rectangle that already includes the margin with the
+crop marks, see wrap_coordinates.  The wraps of all boxes in a manifest
+are packed onto as few sheets as possible with the MaxRects algorithm
+(best short side fit), and turned by 90 degrees where that fits better.
+The sheets are then rendered band by band straight from the templates,
+so neither a whole sheet nor a whole wrap is ever in memory.
+
+Usage: python -m boxwrap_engine.impose MANIFEST [-o DIRECTORY]
+       [--sheet SIZE] [--pack-only]
+"""
+
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+
+import numpy
+
+from boxwrap_engine import batch, bleed, imagefile, marks, plan, stream, \
+    writers
+from boxwrap_engine.layout import WrapLayout, mm_to_px, px_to_mm
+
+
+# Sheet sizes (width, height) in mm
+SHEET_SIZES = collections.OrderedDict([
+    ("SRA3", (320.0, 450.0)),
+    ("A3+", (329.0, 483.0)),
+    ("A3", (297.0, 420.0)),
+    ("SRA2", (450.0, 640.0)),
+    ("A4", (210.0, 297.0)),
+    ("Tabloid", (279.4, 431.8)),
+    ("Letter", (215.9, 279.4)),
+])  # type: Dict[str, Tuple[float, float]]
+
+# Space between the wraps and the edge of the sheet the printer cannot
+# print on, in mm
+GAP = 2.0     # type: float
+MARGIN = 5.0  # type: float
+
+# A wrap to place, the top or bottom wrap of a job, with its size in px
+Item = collections.namedtuple("Item", ("job", "part", "width", "height"))
+
+# Where an item ends up.  A rotated item is turned clockwise and takes
+# the height of the item as its width on the sheet.
+Placement = collections.namedtuple(
+    "Placement", ("item", "sheet", "x", "y", "rotated"))
+
+
+class SheetError(ValueError):
+    """Raised when a wrap is larger than the sheet."""
+
+
+class _Bin:
+    """The free space of one sheet as a list of maximal free
+    rectangles."""
+
+    def __init__(self,
+                 width,   # type: int
+                 height   # type: int
+                 ):
+        # type: (...) -> None
+        self.free = [(0, 0, width, height)]  # type: List[Tuple[int, ...]]
+        self.used = 0  # type: int
+
+    def find(self,
+             width,   # type: int
+             height,  # type: int
+             rotate   # type: bool
+             ):
+        # type: (...) -> Optional[Tuple[Tuple[int, int], int, int, bool]]
+        """Returns the score, the position, and the rotation of the best
+        free spot for a rectangle, or None if it fits nowhere.  Lower
+        scores are better."""
+
+        best = None
+        for x, y, free_width, free_height in self.free:
+            for w, h, rotated in ((width, height, False),
+                                  (height, width, True))[:1 + rotate]:
+                if w <= free_width and h <= free_height:
+                    left_x, left_y = free_width - w, free_height - h
+                    score = (min(left_x, left_y), max(left_x, left_y))
+                    if best is None or score < best[0]:
+                        best = (score, x, y, rotated)
+        return best
+
+    def place(self,
+              x,       # type: int
+              y,       # type: int
+              width,   # type: int
+              height   # type: int
+              ):
+        # type: (...) -> None
+        """Takes a rectangle out of the free space."""
+
+        self.used += width * height
+        placed = (x, y, width, height)
+        free = []  # type: List[Tuple[int, ...]]
+        for rectangle in self.free:
+            if not plan.intersects(rectangle, placed):
+                free.append(rectangle)
+                continue
+            fx, fy, fw, fh = rectangle
+            # Keep the maximal parts of the free rectangle around it
+            if x > fx:
+                free.append((fx, fy, x - fx, fh))
+            if x + width < fx + fw:
+                free.append((x + width, fy, fx + fw - x - width, fh))
+            if y > fy:
+                free.append((fx, fy, fw, y - fy))
+            if y + height < fy + fh:
+                free.append((fx, y + height, fw, fy + fh - y - height))
+        # Free rectangles inside other free rectangles are redundant
+        self.free = [a for i, a in enumerate(free)
+                     if not any(plan.contains(b, a) and (a != b or j < i)
+                                for j, b in enumerate(free) if j != i)]
+
+
+def pack(items,        # type: List[Item]
+         sheet_width,  # type: int
+         sheet_height,  # type: int
+         gap=0,        # type: int
+         rotate=True   # type: bool
+         ):
+    # type: (...) -> Tuple[int, List[Placement]]
+    """Packs rectangles onto as few sheets as possible.
+
+    The sizes are in px and the sheet size is the printable area.  Gap
+    is the space between two rectangles.  Returns the number of sheets
+    and the placements, sorted by sheet and position.  Raises a
+    SheetError if an item does not fit onto a sheet at all.
+    """
+
+    bins = []        # type: List[_Bin]
+    placements = []  # type: List[Placement]
+    # Large items first, they are the hardest to fit
+    for item in sorted(items, key=lambda i: (max(i.width, i.height),
+                                             i.width * i.height),
+                       reverse=True):
+        # Every item takes the gap to its right and below, and so does
+        # the sheet, so that there is no gap at its edges
+        width, height = item.width + gap, item.height + gap
+        best = None
+        for index, sheet in enumerate(bins):
+            found = sheet.find(width, height, rotate)
+            if found is not None and (best is None or found[0] < best[0]):
+                best = found + (index,)
+        if best is None:
+            bins.append(_Bin(sheet_width + gap, sheet_height + gap))
+            found = bins[-1].find(width, height, rotate)
+            if found is None:
+                raise SheetError(
+                    "The %s wrap of %s (%dx%dpx) does not fit onto the "
+                    "sheet (%dx%dpx)" % (item.part, item.job["name"],
+                                         item.width, item.height,
+                                         sheet_width, sheet_height))
+            best = found + (len(bins) - 1,)
+        _, x, y, rotated, index = best
+        if rotated:
+            width, height = height, width
+        bins[index].place(x, y, width, height)
+        placements.append(Placement(item, index, x, y, rotated))
+    placements.sort(key=lambda p: (p.sheet, p.y, p.x))
+    return len(bins), placements
+
+
+def placed_size(placement):
+    # type: (Placement) -> Tuple[int, int]
+    """Returns the width and the height of a placement on the sheet."""
+
+    if placement.rotated:
+        return placement.item.height, placement.item.width
+    return placement.item.width, placement.item.height
+
+
+def wrap_items(jobs):
+    # type: (List[Dict[str, Any]]) -> List[Item]
+    """Returns the top and the bottom wrap of every job as items.  The
+    layout of each job is stored in the job as "layout"."""
+
+    items = []  # type: List[Item]
+    for job in jobs:
+        if "layout" not in job:
+            job["layout"] = WrapLayout.from_mm(
+                job["width"], job["height"], job["depth"],
+                job["thickness"], job["flap_size"], job["inside_size"],
+                job["crop_mark_size"], job["crop_mark_distance"],
+                job["dpi"])
+        layout = job["layout"]  # type: WrapLayout
+        items.extend(Item(job, part, layout.dst_width, layout.dst_height)
+                     for part in ("top", "bottom"))
+    return items
+
+
+def render_sheet(path,           # type: str
+                 placements,     # type: List[Placement]
+                 width,          # type: int
+                 height,         # type: int
+                 margin,         # type: int
+                 dpi,            # type: float
+                 level=6,        # type: int
+                 threads=1,      # type: Optional[int]
+                 band_height=stream.BAND_HEIGHT  # type: int
+                 ):
+    # type: (...) -> None
+    """Renders the wraps placed on one sheet of the given size in px into
+    a PNG or TIFF file, band by band.
+
+    Raises a TemplateSizeError if a template does not fit its box.
+    """
+
+    templates = {}  # type: Dict[str, numpy.ndarray]
+    plans = {}  # type: Dict[Tuple[int, str], Tuple[List[Copy], bool, List[Fill]]]
+    for placement in placements:
+        job = placement.item.job  # type: Dict[str, Any]
+        layout = job["layout"]    # type: WrapLayout
+        if job["template"] not in templates:
+            template = imagefile.load_template(
+                job["template"], (layout.src_width, layout.src_height))
+            layout.check_template_size(template.shape[1], template.shape[0])
+            templates[job["template"]] = template
+        key = (id(job), placement.item.part)
+        if key not in plans:
+            operations = plan.compile_plan(
+                layout, layout.copy_definitions_top
+                if placement.item.part == "top"
+                else layout.copy_definitions_bottom)
+            plans[key] = (operations, marks.drawn_last(layout, operations),
+                          bleed.bleed_fills(layout, operations))
+
+    pool = writers.open_pool(threads)
+    try:
+        with writers.open_writer(path, width, height, level, dpi, pool,
+                                 threads=writers.pool_size(
+                                     threads)) as writer:
+            for y in range(0, height, band_height):
+                rows = min(band_height, height - y)  # type: int
+                band = numpy.empty((rows, width, 3), dtype=numpy.uint8)
+                band[...] = 255
+                for placement in placements:
+                    left = margin + placement.x  # type: int
+                    top = margin + placement.y   # type: int
+                    placed_width, placed_height = placed_size(placement)
+                    start = max(y, top) - top         # type: int
+                    end = min(y + rows, top + placed_height) - top
+                    if start >= end:
+                        continue
+                    job = placement.item.job
+                    layout = job["layout"]
+                    operations, marks_last, fills = plans[(id(job),
+                                                    placement.item.part)]
+                    if placement.rotated:
+                        # The rows of the turned wrap are its columns
+                        pixels = numpy.rot90(stream.render_region(
+                            templates[job["template"]], layout, operations,
+                            not marks_last, marks_last,
+                            start, 0, end - start, layout.dst_height,
+                            fills), -1)
+                    else:
+                        pixels = stream.render_region(
+                            templates[job["template"]], layout, operations,
+                            not marks_last, marks_last,
+                            0, start, layout.dst_width, end - start,
+                            fills)
+                    band[top + start - y:top + end - y,
+                         left:left + placed_width] = pixels
+                writer.write(band)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def impose(jobs,              # type: List[Dict[str, Any]]
+           sheet_size,        # type: Tuple[float, float]
+           margin=MARGIN,     # type: float
+           gap=GAP,           # type: float
+           rotate=True        # type: bool
+           ):
+    # type: (...) -> Dict[str, Any]
+    """Packs the wraps of all jobs onto sheets of the given size in mm.
+
+    Returns the sheet size in px, the placements, and the utilisation.
+    All jobs must have the same resolution.
+    """
+
+    resolutions = set(job["dpi"] for job in jobs)  # type: Set[float]
+    if len(resolutions) > 1:
+        raise SheetError("All boxes on a sheet need the same resolution, "
+                         "not %s dpi" % ", ".join(
+                             "%g" % dpi for dpi in sorted(resolutions)))
+    dpi = resolutions.pop() if resolutions else 300.0  # type: float
+    width = mm_to_px(sheet_size[0], dpi)  # type: int
+    height = mm_to_px(sheet_size[1], dpi)  # type: int
+    margin_px = mm_to_px(margin, dpi)     # type: int
+    printable = (width - 2 * margin_px, height - 2 * margin_px)
+
+    items = wrap_items(jobs)
+    start = time.time()  # type: float
+    count, placements = pack(items, printable[0], printable[1],
+                             mm_to_px(gap, dpi), rotate)
+    seconds = time.time() - start  # type: float
+
+    used = [0] * count  # type: List[int]
+    for placement in placements:
+        used[placement.sheet] += placement.item.width * placement.item.height
+    area = float(width * height)  # type: float
+    return {
+        "dpi": dpi,
+        "sheet": (width, height),
+        "margin": margin_px,
+        "sheets": count,
+        "placements": placements,
+        "utilisation": [u / area for u in used],
+        "total_utilisation": sum(used) / (area * count) if count else 0.0,
+        "packing_seconds": seconds,
+    }
+
+
+def _parse_size(text):
+    # type: (str) -> Tuple[float, float]
+    """Reads a sheet size, either a name or WIDTHxHEIGHT in mm."""
+
+    for name, size in SHEET_SIZES.items():
+        if name.lower() == text.lower():
+            return size
+    try:
+        width, height = text.lower().split("x")
+        return float(width), float(height)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "%r is neither WIDTHxHEIGHT in mm nor one of %s"
+            % (text, ", ".join(SHEET_SIZES)))
+
+
+def main(argv=None):
+    # type: (Optional[List[str]]) -> int
+    """Runs the command line tool."""
+
+    parser = argparse.ArgumentParser(
+        description="Pack the wraps of all boxes in a manifest onto print "
+        "sheets and render the sheets.")
+    parser.add_argument("manifest",
+                        help="CSV or JSON file that lists the boxes")
+    parser.add_argument("-o", "--output", default="sheets",
+                        help="directory for the sheets and the report")
+    parser.add_argument("--sheet", type=_parse_size, default="SRA3",
+                        metavar="SIZE",
+                        help="%s, or WIDTHxHEIGHT in mm (default: SRA3)"
+                        % ", ".join(SHEET_SIZES))
+    parser.add_argument("--margin", type=float, default=MARGIN,
+                        help="unprintable border of the sheet in mm "
+                        "(default: %(default)g)")
+    parser.add_argument("--gap", type=float, default=GAP,
+                        help="space between the wraps in mm "
+                        "(default: %(default)g)")
+    parser.add_argument("--no-rotate", action="store_true",
+                        help="never turn wraps by 90 degrees")
+    parser.add_argument("-f", "--format", choices=("png", "tif"),
+                        default="png", help="file format of the sheets")
+    parser.add_argument("--level", type=int, choices=range(10), default=6,
+                        metavar="0-9", help="compression level "
+                        "(default: %(default)d)")
+    parser.add_argument("--pack-only", action="store_true",
+                        help="only report the packing, render nothing")
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = batch.read_manifest(args.manifest)
+        result = impose(jobs, args.sheet, args.margin, args.gap,
+                        not args.no_rotate)
+    except (IOError, ValueError) as error:
+        sys.stderr.write("%s\n" % error)
+        return 2
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    width, height = result["sheet"]
+    report = {
+        "sheet_mm": list(args.sheet),
+        "dpi": result["dpi"],
+        "sheets": result["sheets"],
+        "wraps": len(result["placements"]),
+        "utilisation": result["utilisation"],
+        "total_utilisation": result["total_utilisation"],
+        "packing_seconds": result["packing_seconds"],
+        "placements": [{
+            "name": p.item.job["name"],
+            "part": p.item.part,
+            "sheet": p.sheet + 1,
+            "x_mm": px_to_mm(result["margin"] + p.x, result["dpi"]),
+            "y_mm": px_to_mm(result["margin"] + p.y, result["dpi"]),
+            "rotated": p.rotated,
+        } for p in result["placements"]],
+        "outputs": [],
+    }  # type: Dict[str, Any]
+
+    status = 0  # type: int
+    start = time.time()  # type: float
+    if not args.pack_only:
+        for sheet in range(result["sheets"]):
+            path = os.path.join(args.output, "sheet_%03d.%s"
+                                % (sheet + 1, args.format))  # type: str
+            try:
+                render_sheet(path, [p for p in result["placements"]
+                                    if p.sheet == sheet],
+                             width, height, result["margin"],
+                             result["dpi"], args.level)
+            except Exception as error:
+                sys.stderr.write("Sheet %d: %s: %s\n"
+                                 % (sheet + 1, type(error).__name__, error))
+                status = 1
+                continue
+            report["outputs"].append(path)
+    report["render_seconds"] = time.time() - start
+    with open(os.path.join(args.output, "imposition.json"), "w") as output:
+        json.dump(report, output, indent=2)
+
+    for sheet, utilisation in enumerate(result["utilisation"]):
+        sys.stdout.write("sheet %3d  %2d wraps  %5.1f%% used\n" % (
+            sheet + 1, sum(1 for p in result["placements"]
+                           if p.sheet == sheet), 100 * utilisation))
+    sys.stdout.write("%d wraps on %d sheets, %.1f%% used, packed in "
+                     "%.3fs\n" % (len(result["placements"]),
+                                  result["sheets"],
+                                  100 * result["total_utilisation"],
+                                  result["packing_seconds"]))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
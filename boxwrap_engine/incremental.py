@@ -0,0 +1,146 @@
+"""Incremental updates of wraps after only some faces of a template
+changed.
+
+The template is split along the coordinates of template_coordinates into
+a grid of regions: the TOP and the BOTTOM face, the upper and the lower
+half of each side face, and the empty corners.  A content hash of every
+region is stored together with the wraps.  When the template is rendered
+again only the regions whose hash changed are followed through the
+render plan, and only the parts of the wraps that depend on them are
+drawn again.
+
+Nothing in here needs NumPy, so the GIMP plugin can use it on its own.
+"""
+
+import hashlib
+import json
+
+from boxwrap_engine import plan
+
+
+# Names of the grid cells of the template, row by row
+REGION_NAMES = (
+    ("top left corner", "top", "top right corner", "top far right corner"),
+    ("left upper", "front upper", "right upper", "back upper"),
+    ("left lower", "front lower", "right lower", "back lower"),
+    ("bottom left corner", "bottom", "bottom right corner",
+     "bottom far right corner"),
+)  # type: Tuple[Tuple[str, ...], ...]
+
+
+def template_regions(layout):
+    # type: (WrapLayout) -> List[Tuple[str, Tuple[int, int, int, int]]]
+    """Returns the names and rectangles (x, y, width, height) of the
+    regions of the template.  Together they cover the whole template."""
+
+    xs, ys = layout.src_xs, layout.src_ys
+    regions = []  # type: List[Tuple[str, Tuple[int, int, int, int]]]
+    for row, names in enumerate(REGION_NAMES):
+        for column, name in enumerate(names):
+            regions.append((name, (xs[column], ys[row],
+                                   xs[column + 1] - xs[column],
+                                   ys[row + 1] - ys[row])))
+    return regions
+
+
+def hash_regions(layout,  # type: WrapLayout
+                 read     # type: Callable[[int, int, int, int], bytes]
+                 ):
+    # type: (...) -> Dict[str, str]
+    """Returns a content hash for every region of the template.
+
+    read(x, y, width, height) must return the pixels of a rectangle of
+    the template as bytes.
+    """
+
+    return dict((name, hashlib.sha1(read(*rectangle)).hexdigest())
+                for name, rectangle in template_regions(layout))
+
+
+def make_state(layout,      # type: WrapLayout
+               hashes,      # type: Dict[str, str]
+               output=None  # type: Optional[Dict[str, Any]]
+               ):
+    # type: (...) -> Dict[str, Any]
+    """Returns what has to be stored with the wraps to update them
+    later.  output holds the options that the wrap files were written
+    with, if there are any."""
+
+    return {"layout": list(layout.key()), "dpi": layout.dpi,
+            "output": output, "regions": hashes}
+
+
+def dump_state(state):
+    # type: (Dict[str, Any]) -> str
+    """Serializes a state for a file or a GIMP parasite."""
+
+    return json.dumps(state, sort_keys=True)
+
+
+def load_state(data):
+    # type: (Union[str, bytes]) -> Optional[Dict[str, Any]]
+    """Reads a serialized state.  Returns None if it cannot be read."""
+
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    try:
+        state = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(state, dict) or \
+       not isinstance(state.get("regions"), dict):
+        return None
+    return state
+
+
+def changed_regions(layout,      # type: WrapLayout
+                    state,       # type: Optional[Dict[str, Any]]
+                    hashes,      # type: Dict[str, str]
+                    output=None  # type: Optional[Dict[str, Any]]
+                    ):
+    # type: (...) -> Optional[List[Tuple[int, int, int, int]]]
+    """Returns the rectangles of the regions that differ from the stored
+    state, or None if the state belongs to another layout or the wraps
+    are to be written with other output options, and the wraps have to
+    be rendered from scratch."""
+
+    if state is None or state.get("layout") != list(layout.key()) or \
+       state.get("dpi") != layout.dpi or state.get("output") != output:
+        return None
+    old = state["regions"]  # type: Dict[str, str]
+    return [rectangle for name, rectangle in template_regions(layout)
+            if old.get(name) != hashes[name]]
+
+
+def dirty_operations(operations,  # type: List[Copy]
+                     changed      # type: List[Tuple[int, int, int, int]]
+                     ):
+    # type: (...) -> List[int]
+    """Returns the indices of the operations of a render plan that have
+    to run again after the given rectangles of the template changed.
+
+    An operation is dirty if it copies from a changed part of the
+    template, if it copies from a part of the wrap that a dirty operation
+    wrote to, or if it draws over a dirty operation.  As long as none of
+    the dirty operations copies from the wrap, running them again in
+    order on the old wrap gives the same result as running the whole
+    plan.  Otherwise only rendering their destinations from scratch
+    does.
+    """
+
+    dirty = []    # type: List[int]
+    written = []  # type: List[Tuple[int, int, int, int]]
+    for index, copy in enumerate(operations):
+        source = (copy.src_x, copy.src_y, copy.src_width, copy.src_height)
+        destination = plan.destination_rectangle(copy)
+        if copy.source == plan.TEMPLATE:
+            reads_changes = any(plan.intersects(source, rectangle)
+                                for rectangle in changed)  # type: bool
+        else:
+            reads_changes = any(plan.intersects(source, rectangle)
+                                for rectangle in written)
+        if reads_changes or any(plan.intersects(destination, rectangle)
+                                for rectangle in written):
+            dirty.append(index)
+            written.append(destination)
+    return dirty
@@ -0,0 +1,175 @@
+"""Opt-in timing of the stages of a procedure.
+
+A Profiler adds up the wall time, the number of calls, and the number of
+pixels of every named stage:
+
+    with profiler.stage("display", width * height):
+        ...
+
+Profiling is off unless the environment variable BOXWRAP_PROFILE is set
+to the JSON file for the report, or to 1 for the default file.  When it
+is off, start returns NULL, whose stages do nothing, so instrumented
+code costs about one method call per stage.
+
+Nothing in here needs NumPy, so the GIMP plugin can use it on its own.
+"""
+
+import collections
+import json
+import os
+import time
+
+
+# Turns profiling on, see the module documentation
+ENVIRONMENT_VARIABLE = "BOXWRAP_PROFILE"  # type: str
+
+
+class _Stage:
+    """Context guard that measures one call of a stage."""
+
+    def __init__(self,
+                 profiler,  # type: Profiler
+                 name,      # type: str
+                 pixels     # type: int
+                 ):
+        # type: (...) -> None
+        self.profiler = profiler
+        self.name = name
+        self.pixels = pixels
+        self.start = 0.0  # type: float
+
+    def __enter__(self):
+        # type: () -> None
+        self.start = time.time()
+
+    def __exit__(self, exception_type, value, traceback):
+        self.profiler.record(self.name, time.time() - self.start,
+                             self.pixels)
+        return False
+
+
+class _NullStage:
+    """Context guard that does nothing."""
+
+    def __enter__(self):
+        # type: () -> None
+        pass
+
+    def __exit__(self, exception_type, value, traceback):
+        return False
+
+
+class Profiler:
+    """Adds up the time, the calls, and the pixels of the stages of one
+    procedure in the order they first ran."""
+
+    enabled = True  # type: bool
+
+    def __init__(self,
+                 procedure,  # type: str
+                 path=None   # type: Optional[str]
+                 ):
+        # type: (...) -> None
+        self.procedure = procedure  # type: str
+        self.path = path            # type: Optional[str]
+        self.started = time.time()  # type: float
+        self.seconds = None         # type: Optional[float]
+        # Name -> [calls, seconds, pixels]
+        self.stages = \
+            collections.OrderedDict()  # type: Dict[str, List[Any]]
+
+    def stage(self,
+              name,      # type: str
+              pixels=0   # type: int
+              ):
+        # type: (...) -> _Stage
+        """Returns a context guard that measures one call of a stage."""
+
+        return _Stage(self, name, pixels)
+
+    def record(self,
+               name,     # type: str
+               seconds,  # type: float
+               pixels=0  # type: int
+               ):
+        # type: (...) -> None
+        """Adds one call of a stage."""
+
+        totals = self.stages.get(name)
+        if totals is None:
+            totals = self.stages[name] = [0, 0.0, 0]
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += pixels
+
+    def finish(self):
+        # type: () -> None
+        """Stops the clock of the whole procedure."""
+
+        self.seconds = time.time() - self.started
+
+    def as_dict(self):
+        # type: () -> Dict[str, Any]
+        """Returns the report in a form that JSON can store."""
+
+        return {
+            "procedure": self.procedure,
+            "started": self.started,
+            "seconds": self.seconds,
+            "stages": [{"name": name, "calls": calls, "seconds": seconds,
+                        "pixels": pixels}
+                       for name, (calls, seconds, pixels)
+                       in self.stages.items()],
+        }
+
+    def report(self):
+        # type: () -> str
+        """Returns the report as a table for people."""
+
+        lines = ["%s: %.3fs" % (self.procedure, self.seconds or 0.0),
+                 "%-40s %6s %9s %12s" % ("stage", "calls", "seconds",
+                                         "pixels")]  # type: List[str]
+        lines.extend("%-40s %6d %9.3f %12d" % (name, calls, seconds, pixels)
+                     for name, (calls, seconds, pixels)
+                     in self.stages.items())
+        return "\n".join(lines)
+
+    def write(self):
+        # type: () -> None
+        """Writes the report to the JSON file of the profiler."""
+
+        if self.path:
+            with open(self.path, "w") as output:
+                json.dump(self.as_dict(), output, indent=2)
+
+
+class _NullProfiler:
+    """Stands in for a Profiler when profiling is off."""
+
+    enabled = False  # type: bool
+    _stage = _NullStage()
+
+    def stage(self, name, pixels=0):
+        # type: (str, int) -> _NullStage
+        return self._stage
+
+    def record(self, name, seconds, pixels=0):
+        # type: (str, float, int) -> None
+        pass
+
+
+NULL = _NullProfiler()  # type: _NullProfiler
+
+
+def start(procedure,            # type: str
+          default_path=None     # type: Optional[str]
+          ):
+    # type: (...) -> Union[Profiler, _NullProfiler]
+    """Returns a new Profiler for a procedure if profiling is turned on,
+    otherwise NULL.  default_path is the JSON file if the environment
+    variable is just 1."""
+
+    setting = os.environ.get(ENVIRONMENT_VARIABLE, "")  # type: str
+    if setting in ("", "0"):
+        return NULL
+    return Profiler(procedure, default_path if setting == "1" else setting)
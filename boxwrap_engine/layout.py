@@ -0,0 +1,475 @@
+"""Layout of the template and of the wrap images.
+
+Nothing in here depends on GIMP, so the same coordinates can be shared
+by the GIMP plugin and by the headless render engine.
+"""
+
+
+# The resolution of the images unless another one is asked for
+DPI = 300.0  # type: float
+
+# The dimensions in the "Create wraps from template..." dialog in the
+# order of WrapLayout.from_mm
+PARAMETERS = ("width", "height", "depth", "thickness", "flap_size",
+              "inside_size", "crop_mark_size",
+              "crop_mark_distance")  # type: Tuple[str, ...]
+
+# The defaults of the "Create wraps from template..." dialog in mm
+DEFAULTS = {
+    "thickness": 2.0,
+    "flap_size": 10.0,
+    "inside_size": 15.0,
+    "crop_mark_size": 5.0,
+    "crop_mark_distance": 2.0,
+}  # type: Dict[str, float]
+
+
+class Corner:
+    """Enumerates four corners and the center of a rectangle."""
+
+    TOP_LEFT = 1                # type: int
+    TOP_RIGHT = 2               # type: int
+    BOTTOM_LEFT = 3             # type: int
+    BOTTOM_RIGHT = 4            # type: int
+    CENTER = 5                  # type: int
+
+
+class Direction:
+    """Enumerates the four principal directions on a page."""
+
+    LEFT = 1                    # type: int
+    RIGHT = 2                   # type: int
+    UP = 3                      # type: int
+    DOWN = 4                    # type: int
+
+
+class TemplateSizeError(ValueError):
+    """Raised when a template does not match the box dimensions."""
+
+
+def mm_to_px(mm,       # type: float
+             dpi=DPI   # type: float
+             ):
+    # type: (...) -> int
+    """Converts millimeters to pixels."""
+
+    return int(round(mm / 25.4 * dpi))
+
+
+def px_to_mm(px,       # type: float
+             dpi=DPI   # type: float
+             ):
+    # type: (...) -> float
+    """Converts pixels to millimeters."""
+
+    return (px * 25.4) / dpi
+
+
+def rotated_size(width,   # type: int
+                 height,  # type: int
+                 angle    # type: int
+                 ):
+    # type: (...) -> Tuple[int, int]
+    """Returns the size of a rectangle after rotating it by a multiple of
+    90 degrees."""
+
+    if angle in (90, 270):
+        return height, width
+    return width, height
+
+
+def place_rectangle(width,   # type: int
+                    height,  # type: int
+                    corner,  # type: Corner
+                    x,       # type: int
+                    y        # type: int
+                    ):
+    # type: (...) -> Tuple[int, int]
+    """Returns the top left position of a rectangle whose corner is at
+    the position (x, y)."""
+
+    if corner == Corner.TOP_LEFT:
+        return x, y
+    elif corner == Corner.TOP_RIGHT:
+        return x - width, y
+    elif corner == Corner.BOTTOM_LEFT:
+        return x, y - height
+    elif corner == Corner.BOTTOM_RIGHT:
+        return x - width, y - height
+    elif corner == Corner.CENTER:
+        return x - width // 2, y - height // 2
+    raise ValueError("Invalid corner %s" % repr(corner))
+
+
+def clip_rectangle(x,              # type: int
+                   y,              # type: int
+                   width,          # type: int
+                   height,         # type: int
+                   bounds_width,   # type: int
+                   bounds_height   # type: int
+                   ):
+    # type: (...) -> Tuple[int, int, int, int]
+    """Clips a rectangle to the bounds of an image of the given size.
+    Returns (x, y, width, height) with a width and height of zero if
+    nothing is left."""
+
+    left = max(x, 0)                            # type: int
+    top = max(y, 0)                             # type: int
+    right = min(x + width, bounds_width)        # type: int
+    bottom = min(y + height, bounds_height)     # type: int
+    return left, top, max(right - left, 0), max(bottom - top, 0)
+
+
+def mark_rectangle(direction,  # type: Direction
+                   x0,         # type: int
+                   y0,         # type: int
+                   size,       # type: int
+                   distance    # type: int
+                   ):
+    # type: (...) -> Tuple[int, int, int, int]
+    """Returns the rectangle (x, y, width, height) of one stroke of a
+    mark for cutting or folding."""
+
+    if direction == Direction.UP:
+        return x0 - 1, y0 - distance - size, 2, size
+    elif direction == Direction.DOWN:
+        return x0 - 1, y0 + distance, 2, size
+    elif direction == Direction.LEFT:
+        return x0 - distance - size, y0 - 1, size, 2
+    elif direction == Direction.RIGHT:
+        return x0 + distance, y0 - 1, size, 2
+    raise ValueError("Invalid direction %s" % repr(direction))
+
+
+def template_coordinates(box_width,   # type: int
+                         box_height,  # type: int
+                         box_depth    # type: int
+                         ):
+    """Calculates a few important coordinates in the template image given
+    the box size."""
+
+    # The template layout looks like this:
+    #
+    #    x0         x1         x2        x3         x4
+    #
+    # y0 o          +----------+                       -
+    #               |          |                       ^
+    #               |   TOP    |                       | depth
+    #               |          |                       v
+    # y1 +----------+----------+---------+----------+  -
+    #    |          |          |         |          |  ^
+    # y2 |---LEFT---|--FRONT---|--RIGHT--|---BACK---|  | height
+    #    |          |          |         |          |  v
+    # y3 +----------+----------+---------+----------+  -
+    #               |          |                       ^
+    #               |  BOTTOM  |                       | depth
+    #               |          |                       v
+    # y4            +----------+                       -
+    #
+    #     |<------->|<-------->|<------->|<-------->|
+    #        depth     width      depth     width
+
+    x0 = 0                      # type: int
+    x1 = x0 + box_depth         # type: int
+    x2 = x1 + box_width         # type: int
+    x3 = x2 + box_depth         # type: int
+    x4 = x3 + box_width         # type: int
+
+    y0 = 0                      # type: int
+    y1 = y0 + box_depth         # type: int
+    y2 = y1 + box_height // 2   # type: int
+    y3 = y1 + box_height        # type: int
+    y4 = y3 + box_depth         # type: int
+
+    return ((x0, x1, x2, x3, x4), (y0, y1, y2, y3, y4))
+
+
+def wrap_coordinates(box_width,            # type: int
+                     box_height,           # type: int
+                     box_depth,            # type: int
+                     thickness,            # type: int
+                     inside_size,          # type: int
+                     flap_size,            # type: int
+                     crop_mark_size,       # type: int
+                     crop_mark_distance    # type: int
+                     ):
+    """Calculates a few important coordinates in the wrap image
+    given the box size and a few other dimensions."""
+
+    # The wrap layout looks like this:
+    #     0   x1      x2 x3       x4  x5           x6  x7      x8 x9      x10 x11
+    #
+    # 0   o                       |   |            |   |
+    #
+    # y1                      --  +---+------------+---+  --
+    #                             |   |            |   |
+    #                             |   |  inside    |   |
+    #                             |   |            |   |
+    # y2                          +...+............+...+
+    #                             |   |            |   |
+    # y3                          +...+............+...+
+    #                             | f |            | f |
+    #                             | l |   front    | l |
+    #         |                   | a |   /back    | a |                   |
+    #                             | p |            | p |
+    # y4  --  +--------+-+--------+---+------------+---+--------+-+--------+  --
+    # y5      |........|.|............|            |............|.|........|
+    #         | inside | | left/right | top/bottom | left/right | | inside |
+    # y6      |........|.|............|            |............|.|........|
+    # y7  --  +--------+-+--------+---+------------+---+--------+-+--------+  --
+    #                             | f |            | f |
+    #         |                   | l |   front    | l |                   |
+    #                             | a |   /back    | a |
+    #                             | p |            | p |
+    # y8                          +...+............+...+
+    #                             |   |            |   |
+    # y9                          +...+............+...+
+    #                             |   |            |   |
+    #                             |   |  inside    |   |
+    #                             |   |            |   |
+    # y10                     --  +---+------------+---+  --
+    #
+    # y11                         |   |            |   |
+
+    half_box_height = box_height // 2                # type: int
+
+    x1 = crop_mark_size + crop_mark_distance         # type: int
+    x2 = x1 + inside_size                            # type: int
+    x3 = x2 + thickness                              # type: int
+    x5 = x3 + half_box_height                        # type: int
+    x4 = x5 - flap_size                              # type: int
+    x6 = x5 + box_width                              # type: int
+    x7 = x6 + flap_size                              # type: int
+    x8 = x6 + half_box_height                        # type: int
+    x9 = x8 + thickness                              # type: int
+    x10 = x9 + inside_size                           # type: int
+    x11 = x10 + crop_mark_distance + crop_mark_size  # type: int
+
+    y1 = crop_mark_size + crop_mark_distance         # type: int
+    y2 = y1 + inside_size                            # type: int
+    y3 = y2 + thickness                              # type: int
+    y4 = y3 + half_box_height                        # type: int
+    y5 = y4 + flap_size                              # type: int
+    y7 = y4 + box_depth                              # type: int
+    y6 = y7 - flap_size                              # type: int
+    y8 = y7 + half_box_height                        # type: int
+    y9 = y8 + thickness                              # type: int
+    y10 = y9 + inside_size                           # type: int
+    y11 = y10 + crop_mark_distance + crop_mark_size  # type: int
+
+    return ((0, x1, x2, x3, x4, x5, x6, x7, x8, x9, x10, x11),
+            (0, y1, y2, y3, y4, y5, y6, y7, y8, y9, y10, y11))
+
+
+class WrapLayout:
+    """Collects everything needed to turn a template into the two wraps.
+
+    All dimensions are in pixels at the resolution dpi, which only
+    matters when converting back to millimeters.  The copy definitions
+    describe where
+    from and where to we want to copy.  Each one looks like this:
+    (src_x, src_y, src_width, src_height,
+     dst_x, dst_y, dst_corner, rotation_angle)
+    """
+
+    def __init__(self,
+                 box_width,           # type: int
+                 box_height,          # type: int
+                 box_depth,           # type: int
+                 thickness,           # type: int
+                 flap_size,           # type: int
+                 inside_size,         # type: int
+                 crop_mark_size,      # type: int
+                 crop_mark_distance,  # type: int
+                 dpi=DPI,             # type: float
+                 bleed=0,             # type: int
+                 bleed_mode="mirror"  # type: str
+                 ):
+        # type: (...) -> None
+        if bleed > crop_mark_distance:
+            raise ValueError("The bleed must not be wider than the "
+                             "distance of the crop marks")
+        self.dpi = dpi                                # type: float
+        self.box_width = box_width                    # type: int
+        self.box_height = box_height                  # type: int
+        self.box_depth = box_depth                    # type: int
+        self.thickness = thickness                    # type: int
+        self.flap_size = flap_size                    # type: int
+        self.inside_size = inside_size                # type: int
+        self.crop_mark_size = crop_mark_size          # type: int
+        self.crop_mark_distance = crop_mark_distance  # type: int
+        # Extends the picture beyond its outer edges, see bleed.py
+        self.bleed = bleed                            # type: int
+        self.bleed_mode = bleed_mode                  # type: str
+
+        half_box_height = box_height // 2  # type: int
+        half_box_height_plus_extra = \
+            half_box_height + thickness + inside_size  # type: int
+        self.half_box_height = half_box_height
+        self.half_box_height_plus_extra = half_box_height_plus_extra
+
+        # Coordinates in the source image
+        src_xs, src_ys = template_coordinates(
+            box_width, box_height, box_depth)  # type: int, int
+        self.src_xs = src_xs
+        self.src_ys = src_ys
+        self.src_width = src_xs[-1] - src_xs[0]   # type: int
+        self.src_height = src_ys[-1] - src_ys[0]  # type: int
+
+        # Coordinates in the destination images
+        dst_xs, dst_ys = wrap_coordinates(
+            box_width, box_height, box_depth,
+            thickness, inside_size, flap_size,
+            crop_mark_size, crop_mark_distance)
+        self.dst_xs = dst_xs
+        self.dst_ys = dst_ys
+        self.dst_width = dst_xs[-1] - dst_xs[0]   # type: int
+        self.dst_height = dst_ys[-1] - dst_ys[0]  # type: int
+
+        self.copy_definitions_top = (
+            # Top
+            (src_xs[1], src_ys[0], box_width, box_depth,
+             dst_xs[5], dst_ys[4], Corner.TOP_LEFT, 0),
+            # Left
+            (src_xs[0], src_ys[1], box_depth, half_box_height_plus_extra,
+             dst_xs[5], dst_ys[4], Corner.TOP_RIGHT, 90),
+            # Front
+            (src_xs[1], src_ys[1], box_width, half_box_height_plus_extra,
+             dst_xs[5], dst_ys[7], Corner.TOP_LEFT, 0),
+            # Right
+            (src_xs[2], src_ys[1], box_depth, half_box_height_plus_extra,
+             dst_xs[6], dst_ys[4], Corner.TOP_LEFT, 270),
+            # Back
+            (src_xs[3], src_ys[1], box_width, half_box_height_plus_extra,
+             dst_xs[5], dst_ys[4], Corner.BOTTOM_LEFT, 180),
+        )
+
+        self.copy_definitions_bottom = (
+            # Left
+            (src_xs[0], src_ys[3] - half_box_height_plus_extra, box_depth,
+             half_box_height_plus_extra, dst_xs[5], dst_ys[4],
+             Corner.TOP_RIGHT, 270),
+            # Front
+            (src_xs[1], src_ys[3] - half_box_height_plus_extra, box_width,
+             half_box_height_plus_extra, dst_xs[5], dst_ys[1],
+             Corner.TOP_LEFT, 0),
+            # Right
+            (src_xs[2], src_ys[3] - half_box_height_plus_extra, box_depth,
+             half_box_height_plus_extra, dst_xs[6], dst_ys[4],
+             Corner.TOP_LEFT, 90),
+            # Back
+            (src_xs[3], src_ys[3] - half_box_height_plus_extra, box_width,
+             half_box_height_plus_extra, dst_xs[5], dst_ys[10],
+             Corner.BOTTOM_LEFT, 180),
+            # Bottom
+            (src_xs[1], src_ys[3], box_width, box_depth,
+             dst_xs[5], dst_ys[4], Corner.TOP_LEFT, 0),
+        )
+
+        # Strips from the sides of the wrap itself that become the flaps
+        # on the front and the back.  The source coordinates refer to the
+        # wrap image, not to the template.
+        self.flap_definitions = (
+            (dst_xs[1], dst_ys[4], half_box_height_plus_extra, flap_size,
+             dst_xs[5], dst_ys[4], Corner.BOTTOM_RIGHT, 90),
+            (dst_xs[1], dst_ys[6], half_box_height_plus_extra, flap_size,
+             dst_xs[5], dst_ys[7], Corner.TOP_RIGHT, 270),
+            (dst_xs[6], dst_ys[4], half_box_height_plus_extra, flap_size,
+             dst_xs[6], dst_ys[4], Corner.BOTTOM_LEFT, 270),
+            (dst_xs[6], dst_ys[6], half_box_height_plus_extra, flap_size,
+             dst_xs[6], dst_ys[7], Corner.TOP_LEFT, 90),
+        )
+
+        # Marks for cutting and folding as (directions, x, y)
+        self.mark_definitions = (
+            ((Direction.UP, Direction.LEFT), dst_xs[4], dst_ys[1]),
+            ((Direction.UP,), dst_xs[5], dst_ys[1]),
+            ((Direction.UP,), dst_xs[6], dst_ys[1]),
+            ((Direction.UP, Direction.RIGHT), dst_xs[7], dst_ys[1]),
+            ((Direction.UP, Direction.LEFT), dst_xs[1], dst_ys[4]),
+            ((Direction.UP, Direction.RIGHT), dst_xs[10], dst_ys[4]),
+            ((Direction.DOWN, Direction.LEFT), dst_xs[1], dst_ys[7]),
+            ((Direction.DOWN, Direction.RIGHT), dst_xs[10], dst_ys[7]),
+            ((Direction.DOWN, Direction.LEFT), dst_xs[4], dst_ys[10]),
+            ((Direction.DOWN,), dst_xs[5], dst_ys[10]),
+            ((Direction.DOWN,), dst_xs[6], dst_ys[10]),
+            ((Direction.DOWN, Direction.RIGHT), dst_xs[7], dst_ys[10]),
+        )
+
+        if bleed:
+            # Fail here and not later in a worker if the bleed does not
+            # fit.  The plans are built from the layout, hence the import.
+            from boxwrap_engine.bleed import bleed_fills
+            from boxwrap_engine.plan import compile_plans
+            for operations in compile_plans(self):
+                bleed_fills(self, operations)
+
+    @classmethod
+    def from_mm(cls,
+                box_width_mm,           # type: float
+                box_height_mm,          # type: float
+                box_depth_mm,           # type: float
+                thickness_mm,           # type: float
+                flap_size_mm,           # type: float
+                inside_size_mm,         # type: float
+                crop_mark_size_mm,      # type: float
+                crop_mark_distance_mm,  # type: float
+                dpi=DPI,                # type: float
+                bleed_mm=0.0,           # type: float
+                bleed_mode="mirror"     # type: str
+                ):
+        # type: (...) -> WrapLayout
+        """Creates the layout from the dimensions in the wraps dialog."""
+
+        return cls(mm_to_px(box_width_mm, dpi),
+                   mm_to_px(box_height_mm, dpi),
+                   mm_to_px(box_depth_mm, dpi),
+                   mm_to_px(thickness_mm, dpi),
+                   mm_to_px(flap_size_mm, dpi),
+                   mm_to_px(inside_size_mm, dpi),
+                   mm_to_px(crop_mark_size_mm, dpi),
+                   mm_to_px(crop_mark_distance_mm, dpi),
+                   dpi, mm_to_px(bleed_mm, dpi), bleed_mode)
+
+    def at_resolution(self, dpi):
+        # type: (float) -> WrapLayout
+        """Returns the same layout at another resolution."""
+
+        return WrapLayout.from_mm(
+            *[px_to_mm(px, self.dpi) for px in self.key()[:8]], dpi=dpi,
+            bleed_mm=px_to_mm(self.bleed, self.dpi),
+            bleed_mode=self.bleed_mode)
+
+    def key(self):
+        # type: () -> Tuple[Any, ...]
+        """Returns the dimensions in pixels that define the layout, and
+        the bleed if there is one."""
+
+        key = (self.box_width, self.box_height, self.box_depth,
+               self.thickness, self.flap_size, self.inside_size,
+               self.crop_mark_size, self.crop_mark_distance)
+        if self.bleed:
+            return key + (self.bleed, self.bleed_mode)
+        return key
+
+    def check_template_size(self,
+                            width,  # type: int
+                            height  # type: int
+                            ):
+        # type: (...) -> None
+        """Raises a TemplateSizeError if a template image of the given
+        size does not fit the box."""
+
+        if width != self.src_width or height != self.src_height:
+            raise TemplateSizeError(
+                "Template image has the wrong size. "
+                "Expected %dpx x %dpx (%dmm x %dmm) "
+                "but got %dpx x %dpx (%dmm x %dmm)."
+                % (self.src_width,
+                   self.src_height,
+                   px_to_mm(self.src_width, self.dpi),
+                   px_to_mm(self.src_height, self.dpi),
+                   width,
+                   height,
+                   px_to_mm(width, self.dpi),
+                   px_to_mm(height, self.dpi)))
@@ -0,0 +1,304 @@
+"""Memory mapped reading of uncompressed template files.
+
+Big templates are often stored without compression as TIFF, PPM/PAM, or
+raw pixel files.  Such files do not have to be decoded at all.  They are
+mapped into memory and only the pages that the render plan actually
+reads are loaded from disk, so the empty corners of the template cost
+neither time nor memory.
+
+Images with contiguous rows are returned as read-only NumPy memory maps
+of shape (height, width, channels).  Tiled TIFF files and TIFF files
+with scattered strips are returned as a TiledImage, which assembles the
+rectangles that are sliced out of it from the tiles.
+
+Only 8 bit gray, gray with alpha, RGB, and RGB with alpha are supported.
+Everything else is left to Pillow.
+"""
+
+import os
+import struct
+
+import numpy
+
+
+class TiledImage:
+    """Read-only image made of equally sized tiles in a file.
+
+    Slicing it with two slices, like an array, returns the pixels of
+    that rectangle as an array.  Only the tiles that overlap the
+    rectangle are read.
+    """
+
+    def __init__(self,
+                 data,         # type: numpy.ndarray
+                 width,        # type: int
+                 height,       # type: int
+                 channels,     # type: int
+                 tile_width,   # type: int
+                 tile_height,  # type: int
+                 offsets       # type: List[int]
+                 ):
+        # type: (...) -> None
+        self.data = data                # type: numpy.ndarray
+        self.shape = (height, width, channels)  # type: Tuple[int, int, int]
+        self.dtype = numpy.dtype(numpy.uint8)
+        self.ndim = 3                   # type: int
+        self.tile_width = tile_width    # type: int
+        self.tile_height = tile_height  # type: int
+        self.tiles_across = \
+            (width + tile_width - 1) // tile_width  # type: int
+        self.offsets = offsets          # type: List[int]
+
+    def _tile(self, row, column):
+        # type: (int, int) -> numpy.ndarray
+        """Returns one tile as an array, including any padding."""
+
+        start = self.offsets[row * self.tiles_across + column]  # type: int
+        size = self.tile_width * self.tile_height * self.shape[2]
+        tile = self.data[start:start + size]
+        if len(tile) < size:
+            # The last strip of a TIFF file may be shorter
+            rows = len(tile) // (self.tile_width * self.shape[2])
+            tile = tile[:rows * self.tile_width * self.shape[2]]
+            return tile.reshape(rows, self.tile_width, self.shape[2])
+        return tile.reshape(self.tile_height, self.tile_width,
+                            self.shape[2])
+
+    def __getitem__(self, key):
+        # type: (Tuple[slice, slice]) -> numpy.ndarray
+        if not isinstance(key, tuple) or len(key) != 2 or \
+           not all(isinstance(k, slice) for k in key):
+            raise TypeError("A TiledImage can only be sliced by rows and "
+                            "columns")
+        top, bottom, step_y = key[0].indices(self.shape[0])
+        left, right, step_x = key[1].indices(self.shape[1])
+        if step_y != 1 or step_x != 1:
+            raise TypeError("A TiledImage cannot be sliced with steps")
+        bottom, right = max(bottom, top), max(right, left)
+
+        pixels = numpy.empty((bottom - top, right - left, self.shape[2]),
+                             dtype=numpy.uint8)
+        for row in range(top // self.tile_height,
+                         (bottom + self.tile_height - 1)
+                         // self.tile_height):
+            y0 = row * self.tile_height  # type: int
+            for column in range(left // self.tile_width,
+                                (right + self.tile_width - 1)
+                                // self.tile_width):
+                x0 = column * self.tile_width  # type: int
+                tile = self._tile(row, column)
+                ys = slice(max(top, y0), min(bottom, y0 + tile.shape[0]))
+                xs = slice(max(left, x0), min(right, x0 + tile.shape[1]))
+                pixels[ys.start - top:ys.stop - top,
+                       xs.start - left:xs.stop - left] = \
+                    tile[ys.start - y0:ys.stop - y0,
+                         xs.start - x0:xs.stop - x0]
+        return pixels
+
+    def __array__(self, dtype=None):
+        # type: (Optional[numpy.dtype]) -> numpy.ndarray
+        """Reads the whole image."""
+
+        pixels = self[:, :]
+        return pixels if dtype is None else pixels.astype(dtype)
+
+
+def _map(path,    # type: str
+         offset,  # type: int
+         shape    # type: Tuple[int, ...]
+         ):
+    # type: (...) -> numpy.ndarray
+    """Maps the pixels of an image file as a read-only array."""
+
+    return numpy.memmap(path, dtype=numpy.uint8, mode="r", offset=offset,
+                        shape=shape)
+
+
+def _read_pnm_token(data,   # type: bytes
+                    index   # type: int
+                    ):
+    # type: (...) -> Tuple[bytes, int]
+    """Returns the next token of a PNM header and the index after it."""
+
+    while True:
+        while data[index:index + 1].isspace():
+            index += 1
+        if data[index:index + 1] != b"#":
+            break
+        while data[index:index + 1] not in (b"\n", b"\r", b""):
+            index += 1
+    start = index  # type: int
+    while data[index:index + 1] and not data[index:index + 1].isspace():
+        index += 1
+    return data[start:index], index
+
+
+def open_pnm(path):
+    # type: (str) -> Optional[numpy.ndarray]
+    """Maps a binary PGM (P5), PPM (P6), or PAM (P7) file.  Returns None
+    for other variants."""
+
+    with open(path, "rb") as image_file:
+        header = image_file.read(4096)  # type: bytes
+
+    magic = header[:2]  # type: bytes
+    if magic in (b"P5", b"P6"):
+        values = []  # type: List[int]
+        index = 2  # type: int
+        for _ in range(3):
+            token, index = _read_pnm_token(header, index)
+            if not token.isdigit():
+                return None
+            values.append(int(token))
+        width, height, maxval = values
+        channels = 1 if magic == b"P5" else 3  # type: int
+        # Exactly one whitespace character ends the header
+        offset = index + 1  # type: int
+    elif magic == b"P7":
+        end = header.find(b"ENDHDR")  # type: int
+        if end < 0:
+            return None
+        fields = {}  # type: Dict[bytes, bytes]
+        for line in header[2:end].splitlines():
+            parts = line.split(None, 1)
+            if parts and not parts[0].startswith(b"#"):
+                fields[parts[0]] = parts[1].strip() if len(parts) > 1 \
+                    else b""
+        try:
+            width = int(fields[b"WIDTH"])
+            height = int(fields[b"HEIGHT"])
+            channels = int(fields[b"DEPTH"])
+            maxval = int(fields[b"MAXVAL"])
+        except (KeyError, ValueError):
+            return None
+        offset = header.index(b"\n", end) + 1
+    else:
+        return None
+
+    if maxval != 255 or channels not in (1, 2, 3, 4):
+        return None
+    return _map(path, offset, (height, width, channels))
+
+
+# TIFF field types and their sizes in bytes
+_TIFF_TYPES = {
+    1: ("B", 1),
+    3: ("H", 2),
+    4: ("I", 4),
+}  # type: Dict[int, Tuple[str, int]]
+
+
+def _read_tiff_directory(data):
+    # type: (numpy.ndarray) -> Optional[Tuple[str, Dict[int, List[int]]]]
+    """Reads the byte order and the integer fields of the first image
+    file directory of a TIFF file."""
+
+    if data[:4].tobytes() == b"II*\x00":
+        order = "<"  # type: str
+    elif data[:4].tobytes() == b"MM\x00*":
+        order = ">"
+    else:
+        return None
+
+    def unpack(fmt, offset, count=1):
+        # type: (str, int, int) -> Tuple[int, ...]
+        size = struct.calcsize(order + fmt * count)  # type: int
+        return struct.unpack(order + fmt * count,
+                             data[offset:offset + size].tobytes())
+
+    directory = unpack("I", 4)[0]  # type: int
+    fields = {}  # type: Dict[int, List[int]]
+    for entry in range(unpack("H", directory)[0]):
+        position = directory + 2 + 12 * entry  # type: int
+        tag, kind, count = unpack("HHI", position)
+        if kind not in _TIFF_TYPES:
+            continue
+        fmt, size = _TIFF_TYPES[kind]
+        offset = position + 8  # type: int
+        if size * count > 4:
+            offset = unpack("I", offset)[0]
+        fields[tag] = list(unpack(fmt, offset, count))
+    return order, fields
+
+
+def open_tiff(path):
+    # type: (str) -> Optional[Union[numpy.ndarray, TiledImage]]
+    """Maps an uncompressed 8 bit TIFF file with strips or tiles.  Returns
+    None for compressed files and other variants."""
+
+    data = numpy.memmap(path, dtype=numpy.uint8, mode="r")
+    directory = _read_tiff_directory(data)
+    if directory is None:
+        return None
+    fields = directory[1]
+
+    def field(tag, default=None):
+        # type: (int, Optional[int]) -> Optional[int]
+        return fields[tag][0] if tag in fields else default
+
+    width, height = field(256), field(257)
+    channels = field(277, 1)  # type: int
+    photometric = field(262)  # type: Optional[int]
+    if width is None or height is None or field(259, 1) != 1 or \
+       field(284, 1) != 1 or \
+       any(bits != 8 for bits in fields.get(258, [8])) or \
+       (photometric, channels) not in ((1, 1), (1, 2), (2, 3), (2, 4)) or \
+       field(338, 2) == 1:
+        # Compressed, planar, not 8 bits, not gray or RGB, or with
+        # premultiplied alpha
+        return None
+
+    if 324 in fields:
+        tile_width, tile_height = field(322), field(323)
+        offsets = fields[324]  # type: List[int]
+    else:
+        tile_width, tile_height = width, field(278, height)
+        offsets = fields.get(273, [])
+    if not tile_width or not tile_height or len(offsets) != \
+            ((width + tile_width - 1) // tile_width) * \
+            ((height + tile_height - 1) // tile_height):
+        return None
+
+    row_size = width * channels  # type: int
+    if tile_width == width and all(
+            offsets[i + 1] == offsets[i] + tile_height * row_size
+            for i in range(len(offsets) - 1)):
+        # All rows follow each other, so no copy is ever needed
+        return _map(path, offsets[0], (height, width, channels))
+    return TiledImage(data, width, height, channels, tile_width,
+                      tile_height, offsets)
+
+
+def open_raw(path,    # type: str
+             width,   # type: int
+             height   # type: int
+             ):
+    # type: (...) -> Optional[numpy.ndarray]
+    """Maps a file of raw 8 bit pixels without any header.  The number
+    of channels follows from the size of the file."""
+
+    pixels = width * height  # type: int
+    size = os.path.getsize(path)  # type: int
+    if pixels == 0 or size % pixels or size // pixels not in (1, 2, 3, 4):
+        return None
+    return _map(path, 0, (height, width, size // pixels))
+
+
+def open_template(path,       # type: str
+                  size=None   # type: Optional[Tuple[int, int]]
+                  ):
+    # type: (...) -> Optional[Union[numpy.ndarray, TiledImage]]
+    """Maps a template file if it is stored without compression.
+
+    Raw files need the size (width, height) of the template.  Returns
+    None if the file has to be decoded.
+    """
+
+    extension = os.path.splitext(path)[1].lower()  # type: str
+    if extension in (".tif", ".tiff"):
+        return open_tiff(path)
+    if extension in (".pgm", ".ppm", ".pnm", ".pam"):
+        return open_pnm(path)
+    if extension == ".raw" and size is not None:
+        return open_raw(path, size[0], size[1])
+    return None
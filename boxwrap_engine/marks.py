@@ -0,0 +1,98 @@
+"""Marks for cutting and folding as vector graphics.
+
+All marks of a wrap are collected in one place so that a backend can
+draw them in a single operation and exporters can write them as real
+vector lines instead of rasterized rectangles.
+"""
+
+from boxwrap_engine import plan
+from boxwrap_engine.layout import Direction, mark_rectangle, px_to_mm
+
+
+def mark_rectangles(layout):
+    # type: (WrapLayout) -> List[Tuple[int, int, int, int]]
+    """Returns the rectangles (x, y, width, height) of all strokes of all
+    marks of a wrap.  The rectangles are not clipped to the wrap."""
+
+    return [mark_rectangle(direction, x, y,
+                           layout.crop_mark_size, layout.crop_mark_distance)
+            for directions, x, y in layout.mark_definitions
+            for direction in directions]
+
+
+def mark_lines(layout):
+    # type: (WrapLayout) -> List[Tuple[float, float, float, float]]
+    """Returns the center lines (x1, y1, x2, y2) of all strokes of all
+    marks of a wrap.  Each stroke is 2px wide."""
+
+    lines = []  # type: List[Tuple[float, float, float, float]]
+    for directions, x, y in layout.mark_definitions:
+        for direction in directions:  # type: Direction
+            left, top, width, height = mark_rectangle(
+                direction, x, y,
+                layout.crop_mark_size, layout.crop_mark_distance)
+            if direction in (Direction.UP, Direction.DOWN):
+                lines.append((x, top, x, top + height))
+            else:
+                lines.append((left, y, left + width, y))
+    return lines
+
+
+def drawn_last(layout,     # type: WrapLayout
+               operations  # type: List[Copy]
+               ):
+    # type: (...) -> bool
+    """Checks if the marks must be drawn after the copies of a render
+    plan and the bleed because one of them draws over a mark or copies
+    one from the wrap.
+
+    This only happens in unusual layouts, e.g. with flaps that are wider
+    than the box is deep, or with a bleed next to the fold marks at the
+    inner corners.  Otherwise the marks can be drawn first.
+    """
+
+    areas = [plan.destination_rectangle(copy) for copy in operations]
+    areas.extend((copy.src_x, copy.src_y, copy.src_width, copy.src_height)
+                 for copy in operations if copy.source == plan.WRAP)
+    if layout.bleed:
+        # The bleed needs NumPy, which the plug-in can do without
+        from boxwrap_engine import bleed
+        for fill in bleed.bleed_fills(layout, operations):
+            areas.append((fill.dst_x, fill.dst_y, fill.width, fill.height))
+            areas.append(bleed.source_rectangle(fill))
+    return any(plan.intersects(rectangle, area)
+               for rectangle in mark_rectangles(layout)
+               for area in areas)
+
+
+def rectangle_points(x,       # type: int
+                     y,       # type: int
+                     width,   # type: int
+                     height   # type: int
+                     ):
+    # type: (...) -> List[float]
+    """Returns the control points of a closed bezier stroke around a
+    rectangle, in the format of gimp_vectors_stroke_new_from_points."""
+
+    points = []  # type: List[float]
+    for corner_x, corner_y in ((x, y), (x + width, y),
+                               (x + width, y + height), (x, y + height)):
+        # Incoming handle, anchor and outgoing handle are all the same
+        points.extend((corner_x, corner_y) * 3)
+    return points
+
+
+def marks_svg(layout):
+    # type: (WrapLayout) -> str
+    """Returns an SVG document with the marks of a wrap in their physical
+    size."""
+
+    paths = "".join("M%s %sL%s %s" % line for line in mark_lines(layout))
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '
+            'width="%.3fmm" height="%.3fmm" viewBox="0 0 %d %d">\n'
+            '<path d="%s" fill="none" stroke="#000000" stroke-width="2"/>\n'
+            '</svg>\n'
+            % (px_to_mm(layout.dst_width, layout.dpi),
+               px_to_mm(layout.dst_height, layout.dpi),
+               layout.dst_width, layout.dst_height, paths))
@@ -0,0 +1,256 @@
+"""Print-ready PDF export of the wraps.
+
+Both wraps go into one PDF file, one page each, in their physical size.
+The pixels of a page are one image that is compressed and written band
+by band, so a page is never in memory as a whole.  The marks for cutting
+and folding are drawn on top as vector lines, and the guides of the
+wrap are added as thin lines in an optional layer that is shown on
+screen but not printed.
+
+Only the standard library is needed.  Bands given as NumPy arrays are
+compressed better because each row is stored as its difference to the
+row above, like the PNG filter "Up".
+"""
+
+import os
+import zlib
+
+from boxwrap_engine import marks
+
+try:
+    import numpy
+except ImportError:
+    # Inside GIMP NumPy may be missing, the bands are raw bytes then
+    numpy = None
+
+
+# Points per inch, the unit of length in PDF files
+POINTS_PER_INCH = 72.0  # type: float
+
+# Color of the guides as RGB from 0 to 1
+GUIDE_COLOR = (0.0, 0.6, 1.0)  # type: Tuple[float, float, float]
+
+_CATALOG, _PAGES, _GUIDES = 1, 2, 3  # type: int, int, int
+
+
+def _number(value):
+    # type: (float) -> str
+    """Formats a number for a PDF file."""
+
+    return ("%.4f" % value).rstrip("0").rstrip(".")
+
+
+class PdfWriter:
+    """Writes a PDF file with one image per page, a band at a time.
+
+    For each page call begin_page, write all rows from top to bottom,
+    and then call end_page.  Used as a context manager the writer is
+    closed at the end, or aborted if there was an error.
+    """
+
+    def __init__(self,
+                 path,     # type: str
+                 level=6   # type: int
+                 ):
+        # type: (...) -> None
+        self.level = level            # type: int
+        self.path = path              # type: str
+        self.file = open(path, "wb")
+        self.offsets = {}             # type: Dict[int, int]
+        self.next_object = _GUIDES + 1  # type: int
+        self.pages = []               # type: List[int]
+        self.layout = None            # type: Optional[WrapLayout]
+        self.rows = 0                 # type: int
+        self.previous_row = None      # type: Optional[numpy.ndarray]
+        self.compressor = None
+        self.image = 0                # type: int
+        self.length = 0               # type: int
+        self.image_start = 0          # type: int
+        self.file.write(b"%PDF-1.5\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self):
+        # type: () -> PdfWriter
+        return self
+
+    def __exit__(self, exception_type, value, traceback):
+        if exception_type is None:
+            try:
+                self.close()
+            except BaseException:
+                self.abort()
+                raise
+        else:
+            self.abort()
+        return False
+
+    def abort(self):
+        # type: () -> None
+        """Stops writing and removes the file, also after close."""
+
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _new_object(self):
+        # type: () -> int
+        """Reserves the number of a new object."""
+
+        number = self.next_object  # type: int
+        self.next_object += 1
+        return number
+
+    def _begin_object(self, number):
+        # type: (int) -> None
+        """Starts writing an object."""
+
+        self.offsets[number] = self.file.tell()
+        self.file.write(("%d 0 obj\n" % number).encode("ascii"))
+
+    def _object(self,
+                number,  # type: int
+                body     # type: str
+                ):
+        # type: (...) -> None
+        """Writes a whole object that is not a stream."""
+
+        self._begin_object(number)
+        self.file.write(body.encode("ascii"))
+        self.file.write(b"\nendobj\n")
+
+    def _stream(self,
+                number,  # type: int
+                data     # type: bytes
+                ):
+        # type: (...) -> None
+        """Writes a compressed stream object."""
+
+        data = zlib.compress(data, self.level)
+        self._begin_object(number)
+        self.file.write(("<< /Length %d /Filter /FlateDecode >>\nstream\n"
+                         % len(data)).encode("ascii"))
+        self.file.write(data)
+        self.file.write(b"\nendstream\nendobj\n")
+
+    def begin_page(self, layout):
+        # type: (WrapLayout) -> None
+        """Starts a page with the size of a wrap."""
+
+        self.layout = layout
+        self.rows = 0
+        self.previous_row = None
+        self.compressor = zlib.compressobj(self.level)
+        self.image = self._new_object()
+        self.length = self._new_object()
+        self._begin_object(self.image)
+        self.file.write((
+            "<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+            "/ColorSpace /DeviceRGB /BitsPerComponent 8 "
+            "/Filter /FlateDecode /DecodeParms << /Predictor 15 "
+            "/Colors 3 /Columns %d >> /Length %d 0 R >>\nstream\n"
+            % (layout.dst_width, layout.dst_height, layout.dst_width,
+               self.length)).encode("ascii"))
+        self.image_start = self.file.tell()
+
+    def write(self, band):
+        # type: (Union[numpy.ndarray, bytes]) -> None
+        """Writes the next rows of the page, given as an array of shape
+        (rows, width, 3) or as raw RGB bytes."""
+
+        row_size = self.layout.dst_width * 3  # type: int
+        if isinstance(band, bytes):
+            # Without NumPy every row is stored as it is
+            rows = len(band) // row_size  # type: int
+            data = b"".join(b"\x00" + band[i * row_size:(i + 1) * row_size]
+                            for i in range(rows))  # type: bytes
+        else:
+            band = band.reshape(band.shape[0], row_size)
+            rows = band.shape[0]
+            above = numpy.empty_like(band)
+            above[0] = 0 if self.previous_row is None else self.previous_row
+            above[1:] = band[:-1]
+            filtered = numpy.empty((rows, row_size + 1), dtype=numpy.uint8)
+            filtered[:, 0] = 2
+            numpy.subtract(band, above, out=filtered[:, 1:])
+            self.previous_row = band[-1].copy()
+            data = filtered.tobytes()
+        compressed = self.compressor.compress(data)  # type: bytes
+        if compressed:
+            self.file.write(compressed)
+        self.rows += rows
+
+    def end_page(self):
+        # type: () -> None
+        """Finishes the image of the page and draws the marks and the
+        guides on top of it."""
+
+        layout = self.layout  # type: WrapLayout
+        if self.rows != layout.dst_height:
+            raise ValueError("Wrote %d of %d rows"
+                             % (self.rows, layout.dst_height))
+        self.file.write(self.compressor.flush())
+        length = self.file.tell() - self.image_start  # type: int
+        self.file.write(b"\nendstream\nendobj\n")
+        self._object(self.length, "%d" % length)
+
+        scale = POINTS_PER_INCH / layout.dpi  # type: float
+        width = layout.dst_width * scale      # type: float
+        height = layout.dst_height * scale    # type: float
+        commands = [
+            "q %s 0 0 %s 0 0 cm /Wrap Do Q"
+            % (_number(width), _number(height)),
+            # Everything else is drawn in pixels from the top left corner
+            "q %s 0 0 %s 0 %s cm"
+            % (_number(scale), _number(-scale), _number(height)),
+            "/OC /Guides BDC %s %s %s RG 1 w"
+            % tuple(_number(c) for c in GUIDE_COLOR),
+        ]  # type: List[str]
+        commands.extend("%d 0 m %d %d l" % (x, x, layout.dst_height)
+                        for x in layout.dst_xs)
+        commands.extend("0 %d m %d %d l" % (y, layout.dst_width, y)
+                        for y in layout.dst_ys)
+        commands.append("S EMC 0 G 2 w 0 J")
+        commands.extend("%s %s m %s %s l" % tuple(_number(v) for v in line)
+                        for line in marks.mark_lines(layout))
+        commands.append("S Q")
+
+        content = self._new_object()  # type: int
+        self._stream(content, "\n".join(commands).encode("ascii"))
+        page = self._new_object()  # type: int
+        self._object(page, (
+            "<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %s %s] "
+            "/Resources << /XObject << /Wrap %d 0 R >> "
+            "/Properties << /Guides %d 0 R >> >> /Contents %d 0 R >>"
+            % (_PAGES, _number(width), _number(height), self.image,
+               _GUIDES, content)))
+        self.pages.append(page)
+        self.layout = None
+
+    def close(self):
+        # type: () -> None
+        """Writes the page tree, the cross reference table, and finishes
+        the file."""
+
+        self._object(_GUIDES, "<< /Type /OCG /Name (Guides) /Usage << "
+                     "/Print << /PrintState /OFF >> >> >>")
+        self._object(_PAGES, "<< /Type /Pages /Kids [%s] /Count %d >>"
+                     % (" ".join("%d 0 R" % page for page in self.pages),
+                        len(self.pages)))
+        self._object(_CATALOG, "<< /Type /Catalog /Pages %d 0 R "
+                     "/OCProperties << /OCGs [%d 0 R] /D << /Order "
+                     "[%d 0 R] /AS [<< /Event /Print /Category [/Print] "
+                     "/OCGs [%d 0 R] >>] >> >> >>"
+                     % (_PAGES, _GUIDES, _GUIDES, _GUIDES))
+
+        xref = self.file.tell()  # type: int
+        self.file.write(("xref\n0 %d\n0000000000 65535 f \n"
+                         % self.next_object).encode("ascii"))
+        for number in range(1, self.next_object):
+            self.file.write(("%010d 00000 n \n"
+                             % self.offsets[number]).encode("ascii"))
+        self.file.write(("trailer\n<< /Size %d /Root %d 0 R >>\n"
+                         "startxref\n%d\n%%%%EOF\n"
+                         % (self.next_object, _CATALOG, xref))
+                        .encode("ascii"))
+        self.file.close()
@@ -0,0 +1,305 @@
+"""Compiles the copy definitions of a wrap into an optimized render plan.
+
+A render plan is a list of Copy operations.  Each one moves a rectangle
+from the template or from the wrap itself to the wrap while rotating it
+by a multiple of 90 degrees.  All rectangles in a plan are already
+clipped to the images and the destination is always given by its top
+left corner, so a backend can run the operations without any further
+checks.
+
+The optimizer resolves the flaps, which the definitions copy back out of
+the half finished wrap, to copies straight from the template.  It then
+merges neighbouring copies that share a rotation, such as the top and
+the front face of the top wrap, into a single transfer.
+
+Usage: python -m boxwrap_engine.plan WIDTH HEIGHT DEPTH [THICKNESS
+       FLAP_SIZE INSIDE_SIZE CROP_MARK_SIZE CROP_MARK_DISTANCE]
+"""
+
+import collections
+import sys
+
+from boxwrap_engine.layout import DEFAULTS, PARAMETERS, WrapLayout, \
+    clip_rectangle, place_rectangle, rotated_size
+
+
+# Where a copy takes its pixels from
+TEMPLATE = "template"  # type: str
+WRAP = "wrap"          # type: str
+
+Copy = collections.namedtuple(
+    "Copy", ("source", "src_x", "src_y", "src_width", "src_height",
+             "dst_x", "dst_y", "angle"))
+
+
+def destination_rectangle(copy):
+    # type: (Copy) -> Tuple[int, int, int, int]
+    """Returns the rectangle (x, y, width, height) a copy writes to."""
+
+    width, height = rotated_size(copy.src_width, copy.src_height, copy.angle)
+    return copy.dst_x, copy.dst_y, width, height
+
+
+def contains(outer,  # type: Tuple[int, int, int, int]
+              inner   # type: Tuple[int, int, int, int]
+              ):
+    # type: (...) -> bool
+    """Checks if the rectangle outer contains the rectangle inner."""
+
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and \
+        inner[0] + inner[2] <= outer[0] + outer[2] and \
+        inner[1] + inner[3] <= outer[1] + outer[3]
+
+
+def intersects(a,  # type: Tuple[int, int, int, int]
+                b   # type: Tuple[int, int, int, int]
+                ):
+    # type: (...) -> bool
+    """Checks if two rectangles overlap."""
+
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and \
+        a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+def _map_to_destination(copy,  # type: Copy
+                        u,     # type: int
+                        v      # type: int
+                        ):
+    # type: (...) -> Tuple[int, int]
+    """Returns where the pixel (u, v), relative to the top left corner of
+    the source rectangle, ends up in the destination."""
+
+    width, height = copy.src_width, copy.src_height
+    if copy.angle == 90:
+        u, v = height - 1 - v, u
+    elif copy.angle == 180:
+        u, v = width - 1 - u, height - 1 - v
+    elif copy.angle == 270:
+        u, v = v, width - 1 - u
+    return copy.dst_x + u, copy.dst_y + v
+
+
+def source_rectangle(copy,    # type: Copy
+                      x,       # type: int
+                      y,       # type: int
+                      width,   # type: int
+                      height   # type: int
+                      ):
+    # type: (...) -> Tuple[int, int, int, int]
+    """Returns the part of the source rectangle of a copy that ends up in
+    the given part of its destination rectangle."""
+
+    src_width, src_height = copy.src_width, copy.src_height
+    a0, b0 = x - copy.dst_x, y - copy.dst_y
+    a1, b1 = a0 + width, b0 + height
+    if copy.angle == 90:
+        u0, u1, v0, v1 = b0, b1, src_height - a1, src_height - a0
+    elif copy.angle == 180:
+        u0, u1 = src_width - a1, src_width - a0
+        v0, v1 = src_height - b1, src_height - b0
+    elif copy.angle == 270:
+        u0, u1, v0, v1 = src_width - b1, src_width - b0, a0, a1
+    else:
+        u0, u1, v0, v1 = a0, a1, b0, b1
+    return copy.src_x + u0, copy.src_y + v0, u1 - u0, v1 - v0
+
+
+def resolve_definition(source,        # type: str
+                       definition,
+                       src_size,      # type: Tuple[int, int]
+                       dst_size       # type: Tuple[int, int]
+                       ):
+    # type: (...) -> Optional[Copy]
+    """Turns a copy definition into a Copy that is clipped to both images.
+
+    Just like a selection in GIMP the source rectangle is clipped to the
+    source image first.  The rotated region is then placed by its corner
+    and clipped to the destination image.  Returns None if nothing is
+    left to copy.
+    """
+
+    src_x, src_y, src_width, src_height, dst_x, dst_y, dst_corner, angle = \
+        definition
+    src_x, src_y, src_width, src_height = clip_rectangle(
+        src_x, src_y, src_width, src_height, src_size[0], src_size[1])
+    if src_width == 0 or src_height == 0:
+        return None
+
+    width, height = rotated_size(src_width, src_height, angle)
+    left, top = place_rectangle(width, height, dst_corner, dst_x, dst_y)
+    x, y, w, h = clip_rectangle(left, top, width, height,
+                                dst_size[0], dst_size[1])
+    if w == 0 or h == 0:
+        return None
+
+    placed = Copy(source, src_x, src_y, src_width, src_height,
+                  left, top, angle % 360)
+    src_x, src_y, src_width, src_height = source_rectangle(
+        placed, x, y, w, h)
+    return Copy(source, src_x, src_y, src_width, src_height, x, y,
+                angle % 360)
+
+
+def _resolve_flap(flap,   # type: Copy
+                  faces   # type: List[Copy]
+                  ):
+    # type: (...) -> Copy
+    """Rewrites a copy from the wrap into a copy from the template if its
+    source lies within a single face."""
+
+    src = (flap.src_x, flap.src_y, flap.src_width, flap.src_height)
+    writers = [face for face in faces
+               if intersects(destination_rectangle(face), src)]
+    if len(writers) != 1 or \
+       not contains(destination_rectangle(writers[0]), src):
+        return flap
+
+    face = writers[0]  # type: Copy
+    src_x, src_y, src_width, src_height = source_rectangle(face, *src)
+    return Copy(TEMPLATE, src_x, src_y, src_width, src_height,
+                flap.dst_x, flap.dst_y, (face.angle + flap.angle) % 360)
+
+
+def _merge(a,  # type: Copy
+           b   # type: Copy
+           ):
+    # type: (...) -> Optional[Copy]
+    """Merges two copies into one if their sources are neighbours and
+    they end up next to each other in the same way."""
+
+    if a.source != b.source or a.angle != b.angle:
+        return None
+
+    if a.src_x == b.src_x and a.src_width == b.src_width and \
+       (a.src_y + a.src_height == b.src_y or
+            b.src_y + b.src_height == a.src_y):
+        src_x, src_width = a.src_x, a.src_width
+        src_y = min(a.src_y, b.src_y)
+        src_height = a.src_height + b.src_height
+    elif a.src_y == b.src_y and a.src_height == b.src_height and \
+            (a.src_x + a.src_width == b.src_x or
+             b.src_x + b.src_width == a.src_x):
+        src_y, src_height = a.src_y, a.src_height
+        src_x = min(a.src_x, b.src_x)
+        src_width = a.src_width + b.src_width
+    else:
+        return None
+
+    # Position the merged copy so that a stays where it is and check that
+    # b does not move either
+    merged = Copy(a.source, src_x, src_y, src_width, src_height,
+                  0, 0, a.angle)
+    ax, ay = _map_to_destination(merged, a.src_x - src_x, a.src_y - src_y)
+    wanted_ax, wanted_ay = _map_to_destination(a, 0, 0)
+    merged = merged._replace(dst_x=wanted_ax - ax, dst_y=wanted_ay - ay)
+    if _map_to_destination(merged, b.src_x - src_x, b.src_y - src_y) != \
+       _map_to_destination(b, 0, 0):
+        return None
+    return merged
+
+
+def _merge_all(copies):
+    # type: (List[Copy]) -> List[Copy]
+    """Merges neighbouring copies until no more copies can be merged.
+
+    Copies are only merged when no other copy writes to the same area,
+    so the order of the plan does not matter for them.
+    """
+
+    copies = list(copies)
+    merged_any = True  # type: bool
+    while merged_any:
+        merged_any = False
+        for i in range(len(copies)):
+            for j in range(i + 1, len(copies)):
+                merged = _merge(copies[i], copies[j])
+                if merged is None:
+                    continue
+                others = copies[:i] + copies[i + 1:j] + copies[j + 1:]
+                area = destination_rectangle(merged)
+                if any(intersects(area, destination_rectangle(c))
+                       for c in others):
+                    continue
+                copies = [merged] + others
+                merged_any = True
+                break
+            if merged_any:
+                break
+    return copies
+
+
+def compile_plan(layout,            # type: WrapLayout
+                 copy_definitions,
+                 optimize=True      # type: bool
+                 ):
+    # type: (...) -> List[Copy]
+    """Compiles the faces of one wrap and its flaps into a render plan.
+
+    Without optimization the plan does exactly what the definitions say,
+    in the same order.
+    """
+
+    src_size = (layout.src_width, layout.src_height)
+    dst_size = (layout.dst_width, layout.dst_height)
+
+    faces = [resolve_definition(TEMPLATE, d, src_size, dst_size)
+             for d in copy_definitions]
+    faces = [copy for copy in faces if copy is not None]
+    flaps = [resolve_definition(WRAP, d, dst_size, dst_size)
+             for d in layout.flap_definitions]
+    flaps = [copy for copy in flaps if copy is not None]
+    if not optimize:
+        return faces + flaps
+
+    flaps = [_resolve_flap(flap, faces) for flap in flaps]
+    from_template = [c for c in faces + flaps if c.source == TEMPLATE]
+    from_wrap = [c for c in flaps if c.source == WRAP]
+    return _merge_all(from_template) + from_wrap
+
+
+def compile_plans(layout,        # type: WrapLayout
+                  optimize=True  # type: bool
+                  ):
+    # type: (...) -> Tuple[List[Copy], List[Copy]]
+    """Compiles the render plans of the top and the bottom wrap."""
+
+    return (compile_plan(layout, layout.copy_definitions_top, optimize),
+            compile_plan(layout, layout.copy_definitions_bottom, optimize))
+
+
+def format_plan(plan):
+    # type: (List[Copy]) -> str
+    """Describes a render plan, one line per pixel transfer."""
+
+    lines = []  # type: List[str]
+    pixels = 0  # type: int
+    for copy in plan:
+        lines.append("%-8s %5d,%5d %5dx%-5d -> %5d,%5d  rotate %3d"
+                     % (copy.source, copy.src_x, copy.src_y,
+                        copy.src_width, copy.src_height,
+                        copy.dst_x, copy.dst_y, copy.angle))
+        pixels += copy.src_width * copy.src_height
+    lines.append("%d transfers, %d pixels" % (len(plan), pixels))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    # type: (Optional[List[str]]) -> int
+    """Prints the optimized render plans for a box."""
+
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) not in (3, 8):
+        sys.stderr.write(__doc__.split("Usage: ")[-1])
+        return 2
+
+    dimensions = [float(value) for value in argv] + \
+        [DEFAULTS[key] for key in PARAMETERS[len(argv):]]
+    layout = WrapLayout.from_mm(*dimensions)  # type: WrapLayout
+    top, bottom = compile_plans(layout)
+    sys.stdout.write("Top wrap:\n%s\n\nBottom wrap:\n%s\n"
+                     % (format_plan(top), format_plan(bottom)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""Fast low resolution previews of the wraps.
+
+A preview downsamples the template to a low resolution and renders the
+wraps from that, which takes a fraction of a second even for large
+boxes.  The full resolution render only needs to run once the preview
+looks right.
+"""
+
+import numpy
+
+from boxwrap_engine import render
+
+
+# Resolution of the previews unless another one is asked for
+PREVIEW_DPI = 60.0  # type: float
+
+# Rows of the template that are read at a time while downsampling
+BAND_HEIGHT = 256  # type: int
+
+
+def _sample_positions(full,    # type: Tuple[int, ...]
+                      small    # type: Tuple[int, ...]
+                      ):
+    # type: (...) -> numpy.ndarray
+    """Returns for each small pixel the position of the full pixel at its
+    center.
+
+    Both arguments are the coordinates of the face edges along one axis.
+    Each stretch between two edges is scaled on its own, so the edges of
+    the faces stay exactly where the layout expects them.
+    """
+
+    positions = []  # type: List[numpy.ndarray]
+    for i in range(len(small) - 1):
+        count = small[i + 1] - small[i]  # type: int
+        if count <= 0:
+            continue
+        scale = float(full[i + 1] - full[i]) / count  # type: float
+        centers = (numpy.arange(count) + 0.5) * scale
+        positions.append(full[i] + numpy.minimum(
+            centers.astype(numpy.intp), max(full[i + 1] - full[i] - 1, 0)))
+    return numpy.concatenate(positions)
+
+
+def downsample_template(template,       # type: numpy.ndarray
+                        layout,         # type: WrapLayout
+                        preview_layout  # type: WrapLayout
+                        ):
+    # type: (...) -> numpy.ndarray
+    """Downsamples a template that fits layout so that it fits
+    preview_layout.
+
+    The template is read in bands of rows, so it may also be a memory
+    map or a TiledImage that is never loaded as a whole.
+    """
+
+    layout.check_template_size(template.shape[1], template.shape[0])
+    xs = _sample_positions(layout.src_xs, preview_layout.src_xs)
+    ys = _sample_positions(layout.src_ys, preview_layout.src_ys)
+    left, right = int(xs[0]), int(xs[-1]) + 1  # type: int, int
+    columns = xs - left
+    pixels = numpy.empty((len(ys), len(xs)) + tuple(template.shape[2:]),
+                         dtype=template.dtype)
+    start = 0  # type: int
+    while start < len(ys):
+        # The positions only grow, so each band holds a run of them
+        top = int(ys[start])  # type: int
+        stop = int(numpy.searchsorted(ys, top + BAND_HEIGHT))  # type: int
+        band = template[top:int(ys[stop - 1]) + 1, left:right]
+        pixels[start:stop] = band[(ys[start:stop] - top)[:, numpy.newaxis],
+                                  columns]
+        start = stop
+    return pixels
+
+
+def render_preview(template,        # type: numpy.ndarray
+                   layout,          # type: WrapLayout
+                   dpi=PREVIEW_DPI  # type: float
+                   ):
+    # type: (...) -> Tuple[numpy.ndarray, numpy.ndarray]
+    """Renders the top and the bottom wrap of a full resolution template
+    at a lower resolution."""
+
+    preview_layout = layout.at_resolution(dpi)  # type: WrapLayout
+    return render.render_wraps(
+        downsample_template(template, layout, preview_layout),
+        preview_layout)
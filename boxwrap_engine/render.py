@@ -0,0 +1,229 @@
+"""Headless render engine that creates the wraps with NumPy.
+
+The engine does the same thing as the GIMP plugin, but it works on
+arrays of shape (height, width, channels) instead of going through the
+procedural database.  Each step mirrors one of the PDB operations of the
+plugin so that both produce the same pixels.
+"""
+
+import collections
+
+import numpy
+
+from boxwrap_engine import bleed, marks, plan
+from boxwrap_engine.layout import clip_rectangle
+
+
+WHITE = 255  # type: int
+BLACK = 0    # type: int
+
+# An overlay is as large as a wrap, so only the most recently used ones
+# are kept
+OVERLAY_CACHE_SIZE = 2  # type: int
+_overlays = \
+    collections.OrderedDict()  # type: Dict[Tuple[int, ...], numpy.ndarray]
+
+
+def flatten(pixels,  # type: numpy.ndarray
+            ):
+    # type: (...) -> numpy.ndarray
+    """Composites an image onto a white background and returns it as an
+    RGB array.
+
+    The image may be gray, gray with alpha, RGB or RGB with alpha, given
+    as an array of shape (height, width) or (height, width, channels).
+    """
+
+    pixels = numpy.asarray(pixels, dtype=numpy.uint8)
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, numpy.newaxis]
+    channels = pixels.shape[2]  # type: int
+
+    if channels in (2, 4):
+        color = pixels[:, :, :channels - 1].astype(numpy.uint32)
+        alpha = pixels[:, :, channels - 1:].astype(numpy.uint32)
+        color = (color * alpha + WHITE * (255 - alpha) + 127) // 255
+        pixels = color.astype(numpy.uint8)
+    if pixels.shape[2] == 1:
+        pixels = numpy.repeat(pixels, 3, axis=2)
+    return numpy.ascontiguousarray(pixels)
+
+
+def flatten_used(template,  # type: numpy.ndarray
+                 layout     # type: WrapLayout
+                 ):
+    # type: (...) -> numpy.ndarray
+    """Flattens only the parts of a template that the render plans of a
+    layout read.
+
+    An RGB array is returned as it is, so a memory mapped template is
+    never read as a whole.  Otherwise the result is a new RGB array in
+    which everything that is never read, like the empty corners, stays
+    black and is never touched.
+    """
+
+    if isinstance(template, numpy.ndarray) and \
+       template.dtype == numpy.uint8 and template.ndim == 3 and \
+       template.shape[2] == 3:
+        return template
+
+    # Pages of zeros are only allocated once they are written to
+    flat = numpy.zeros((template.shape[0], template.shape[1], 3),
+                       dtype=numpy.uint8)
+    for operations in plan.compile_plans(layout):
+        for copy in operations:
+            if copy.source != plan.TEMPLATE:
+                continue
+            rows = slice(copy.src_y, copy.src_y + copy.src_height)
+            columns = slice(copy.src_x, copy.src_x + copy.src_width)
+            flat[rows, columns] = flatten(template[rows, columns])
+    return flat
+
+
+def new_wrap(width,   # type: int
+             height   # type: int
+             ):
+    # type: (...) -> numpy.ndarray
+    """Creates an empty white RGB wrap image."""
+
+    return numpy.full((height, width, 3), WHITE, dtype=numpy.uint8)
+
+
+def rotate(pixels,  # type: numpy.ndarray
+           angle    # type: int
+           ):
+    # type: (...) -> numpy.ndarray
+    """Rotates an image clockwise by a multiple of 90 degrees, just like
+    gimp_drawable_transform_rotate_simple does."""
+
+    return numpy.rot90(pixels, -(angle // 90) % 4)
+
+
+def execute_copy(template,  # type: numpy.ndarray
+                 dst,       # type: numpy.ndarray
+                 copy       # type: Copy
+                 ):
+    # type: (...) -> None
+    """Runs one operation of a render plan."""
+
+    src = template if copy.source == plan.TEMPLATE else dst
+    region = src[copy.src_y:copy.src_y + copy.src_height,
+                 copy.src_x:copy.src_x + copy.src_width]
+    if src is dst:
+        region = region.copy()
+    x, y, width, height = plan.destination_rectangle(copy)
+    dst[y:y + height, x:x + width] = rotate(region, copy.angle)
+
+
+def execute_plan(template,   # type: numpy.ndarray
+                 dst,        # type: numpy.ndarray
+                 operations  # type: List[Copy]
+                 ):
+    # type: (...) -> None
+    """Runs all operations of a render plan."""
+
+    for copy in operations:
+        execute_copy(template, dst, copy)
+
+
+def copy_and_rotate_rectangle(src,         # type: numpy.ndarray
+                              src_x,       # type: int
+                              src_y,       # type: int
+                              src_width,   # type: int
+                              src_height,  # type: int
+                              dst,         # type: numpy.ndarray
+                              dst_x,       # type: int
+                              dst_y,       # type: int
+                              dst_corner,  # type: Corner
+                              angle        # type: int
+                              ):
+    # type: (...) -> None
+    """Copies a rectangular region from one image to another while also
+    rotating it.
+
+    Like a selection in GIMP the source rectangle is clipped to the
+    source image first and the rotated region is then clipped to the
+    destination image.  Source and destination may be the same array.
+    """
+
+    copy = plan.resolve_definition(
+        plan.TEMPLATE if src is not dst else plan.WRAP,
+        (src_x, src_y, src_width, src_height, dst_x, dst_y, dst_corner,
+         angle),
+        (src.shape[1], src.shape[0]),
+        (dst.shape[1], dst.shape[0]))  # type: Optional[Copy]
+    if copy is not None:
+        execute_copy(src, dst, copy)
+
+
+def draw_marks(dst,        # type: numpy.ndarray
+               rectangles  # type: List[Tuple[int, int, int, int]]
+               ):
+    # type: (...) -> None
+    """Draws the strokes of the marks where one must cut or fold the
+    paper."""
+
+    for x, y, width, height in rectangles:
+        x, y, width, height = clip_rectangle(
+            x, y, width, height, dst.shape[1], dst.shape[0])
+        dst[y:y + height, x:x + width] = BLACK
+
+
+def wrap_overlay(layout):
+    # type: (WrapLayout) -> numpy.ndarray
+    """Returns the parts that both wraps of a layout have in common: the
+    white background and the marks for cutting and folding.
+
+    The overlay is cached per layout and is read-only, so callers must
+    copy it.
+    """
+
+    key = layout.key()  # type: Tuple[int, ...]
+    overlay = _overlays.pop(key, None)  # type: Optional[numpy.ndarray]
+    if overlay is None:
+        overlay = new_wrap(layout.dst_width, layout.dst_height)
+        draw_marks(overlay, marks.mark_rectangles(layout))
+        overlay.setflags(write=False)
+    _overlays[key] = overlay
+    while len(_overlays) > OVERLAY_CACHE_SIZE:
+        _overlays.popitem(last=False)
+    return overlay
+
+
+def render_wrap(template,             # type: numpy.ndarray
+                layout,               # type: WrapLayout
+                copy_definitions
+                ):
+    # type: (...) -> numpy.ndarray
+    """Copies regions from a flattened template to a new wrap image."""
+
+    operations = plan.compile_plan(layout, copy_definitions)
+    fills = bleed.bleed_fills(layout, operations)  # type: List[Fill]
+    if marks.drawn_last(layout, operations):
+        dst = new_wrap(layout.dst_width, layout.dst_height)
+        execute_plan(template, dst, operations)
+        bleed.apply_fills(dst, fills)
+        draw_marks(dst, marks.mark_rectangles(layout))
+        return dst
+
+    # Move and rotate the faces and the flaps into position on top of
+    # the background and the marks
+    dst = wrap_overlay(layout).copy()
+    execute_plan(template, dst, operations)
+    bleed.apply_fills(dst, fills)
+    return dst
+
+
+def render_wraps(template,  # type: numpy.ndarray
+                 layout     # type: WrapLayout
+                 ):
+    # type: (...) -> Tuple[numpy.ndarray, numpy.ndarray]
+    """Creates the top and the bottom wrap from a template image.
+
+    Raises a TemplateSizeError if the template does not fit the box.
+    """
+
+    layout.check_template_size(template.shape[1], template.shape[0])
+    template = flatten_used(template, layout)
+    return (render_wrap(template, layout, layout.copy_definitions_top),
+            render_wrap(template, layout, layout.copy_definitions_bottom))
@@ -0,0 +1,564 @@
+"""Local render service for wraps over HTTP or a Unix socket.
+
+Clients upload a template with the dimensions of the box and get the
+finished wraps back:
+
+    POST /jobs?width=75&height=104&depth=100&thickness=2&flap_size=10
+              &inside_size=15[&crop_mark_size=5&crop_mark_distance=2]
+              [&dpi=300&format=png|tif|pdf]
+         with the template image as the body
+         -> 202 {"id": ..., "files": [...]}
+    GET  /jobs/ID             state of a job
+    GET  /jobs/ID/FILE        waits for the job and streams a wrap
+    DELETE /jobs/ID           removes a job and its files
+    GET  /metrics             queue depth, throughput, and latencies
+
+The size of the upload and of the template are checked before a job is
+queued, so bad requests fail right away without waiting for a worker.
+The jobs are rendered by batch.run_job on a pool of worker processes,
+and at most as many jobs as there are workers run at the same time.
+
+This module needs Python 3.
+
+Usage: python -m boxwrap_engine.service [--port PORT | --unix PATH]
+       [--workers N] [--directory DIRECTORY]
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+import urllib.parse
+import uuid
+
+from PIL import Image
+
+from boxwrap_engine import batch
+from boxwrap_engine.layout import DEFAULTS, DPI, PARAMETERS, \
+    TemplateSizeError, WrapLayout
+
+
+# Jobs that may wait for a worker before new ones are turned away
+MAX_QUEUE = 64  # type: int
+
+# Largest template upload in bytes
+MAX_UPLOAD = 512 * 1024 * 1024  # type: int
+
+# Seconds that finished jobs and their files are kept
+KEEP_SECONDS = 3600.0  # type: float
+
+# Number of finished jobs the latency metrics are taken from
+LATENCY_WINDOW = 1000  # type: int
+
+_CHUNK_SIZE = 1 << 20  # type: int
+
+# Extensions of uploaded templates by their format where the first one
+# that Pillow knows would not do.  mapped.open_template maps these.
+_EXTENSIONS = {"TIFF": ".tif", "PPM": ".pnm"}  # type: Dict[str, str]
+
+_REASONS = {
+    200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found",
+    405: "Method Not Allowed", 409: "Conflict", 411: "Length Required",
+    413: "Payload Too Large", 415: "Unsupported Media Type",
+    422: "Unprocessable Entity", 500: "Internal Server Error",
+    503: "Service Unavailable",
+}  # type: Dict[int, str]
+
+
+class HttpError(Exception):
+    """Ends a request with an error status and a message."""
+
+    def __init__(self, status, message):
+        # type: (int, str) -> None
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class Job:
+    """A template waiting for, or rendered by, a worker."""
+
+    def __init__(self,
+                 directory,  # type: str
+                 job,        # type: Dict[str, Any]
+                 options     # type: Dict[str, Any]
+                 ):
+        # type: (...) -> None
+        self.id = os.path.basename(directory)  # type: str
+        self.directory = directory  # type: str
+        self.job = job              # type: Dict[str, Any]
+        self.options = options      # type: Dict[str, Any]
+        self.state = "queued"       # type: str
+        self.submitted = time.time()  # type: float
+        self.started = None         # type: Optional[float]
+        self.finished = None        # type: Optional[float]
+        self.result = None          # type: Optional[Dict[str, Any]]
+        self.done = asyncio.Event()
+
+    def files(self):
+        # type: () -> List[str]
+        """Returns the names of the files the job will write."""
+
+        if self.options["format"] == "pdf":
+            return ["wrap.pdf"]
+        return ["wrap_%s.%s" % (part, self.options["format"])
+                for part in ("top", "bottom")]
+
+    def describe(self):
+        # type: () -> Dict[str, Any]
+        """Returns the state of the job for clients."""
+
+        description = {
+            "id": self.id,
+            "state": self.state,
+            "files": ["/jobs/%s/%s" % (self.id, name)
+                      for name in self.files()],
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+        }  # type: Dict[str, Any]
+        if self.result is not None:
+            description["error"] = self.result["error"]
+            description["timings"] = self.result["timings"]
+        return description
+
+
+def parse_job(query):
+    # type: (Dict[str, str]) -> Tuple[Dict[str, Any], Dict[str, Any]]
+    """Reads the dimensions and the options of a job from the query of a
+    request.  Raises an HttpError if they are missing or invalid."""
+
+    job = {"name": "wrap"}  # type: Dict[str, Any]
+    for key in PARAMETERS + ("dpi",):  # type: str
+        value = query.get(key)
+        if value is None:
+            if key == "dpi":
+                value = DPI
+            elif key in DEFAULTS:
+                value = DEFAULTS[key]
+            else:
+                raise HttpError(400, "%s is missing" % key)
+        try:
+            job[key] = float(value)
+        except ValueError:
+            raise HttpError(400, "%s is not a number: %r" % (key, value))
+        if not math.isfinite(job[key]):
+            raise HttpError(400, "%s must be finite" % key)
+        if key == "crop_mark_distance":
+            if job[key] < 0:
+                raise HttpError(400, "%s must not be negative" % key)
+        elif job[key] <= 0:
+            raise HttpError(400, "%s must be positive" % key)
+
+    options = {"format": query.get("format", "png")}  # type: Dict[str, Any]
+    if options["format"] not in ("png", "tif", "pdf"):
+        raise HttpError(400, "format must be png, tif, or pdf")
+    return job, options
+
+
+def check_template(path,   # type: str
+                   layout  # type: WrapLayout
+                   ):
+    # type: (...) -> str
+    """Checks that an uploaded file is an image of the right size and
+    returns the file extension of its format.  Only the header of the
+    file is read."""
+
+    try:
+        with Image.open(path) as image:
+            size = image.size  # type: Tuple[int, int]
+            image_format = image.format  # type: str
+    except (IOError, OSError, SyntaxError):
+        raise HttpError(415, "The template is not an image that can be "
+                        "read")
+    try:
+        layout.check_template_size(*size)
+    except TemplateSizeError as error:
+        raise HttpError(422, str(error))
+    if image_format in _EXTENSIONS:
+        return _EXTENSIONS[image_format]
+    for extension, name in Image.registered_extensions().items():
+        if name == image_format:
+            return extension
+    return ""
+
+
+class Service:
+    """Queues jobs from requests and renders them on worker processes."""
+
+    def __init__(self,
+                 directory,               # type: str
+                 workers=None,            # type: Optional[int]
+                 max_queue=MAX_QUEUE,     # type: int
+                 max_upload=MAX_UPLOAD,   # type: int
+                 keep=KEEP_SECONDS        # type: float
+                 ):
+        # type: (...) -> None
+        self.directory = directory    # type: str
+        self.workers = workers or os.cpu_count() or 1  # type: int
+        self.max_queue = max_queue    # type: int
+        self.max_upload = max_upload  # type: int
+        self.keep = keep              # type: float
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+        self.slots = asyncio.Semaphore(self.workers)
+        self.jobs = collections.OrderedDict()  # type: Dict[str, Job]
+        self.started = time.time()  # type: float
+        self.completed = 0          # type: int
+        self.failed = 0             # type: int
+        self.rejected = 0           # type: int
+        self.latencies = collections.deque(
+            maxlen=LATENCY_WINDOW)  # type: Deque[Tuple[float, float]]
+
+    def start_workers(self):
+        # type: () -> None
+        """Starts the worker processes.  This must happen before the
+        server opens its socket, or forked workers would inherit it and
+        the sockets of the clients, which then never see the end of a
+        response."""
+
+        futures = [self.pool.submit(os.getpid) for _ in range(self.workers)]
+        for future in futures:
+            future.result()
+
+    def queued(self):
+        # type: () -> int
+        return sum(1 for job in self.jobs.values() if job.state == "queued")
+
+    def running(self):
+        # type: () -> int
+        return sum(1 for job in self.jobs.values() if job.state == "running")
+
+    async def render(self, job):
+        # type: (Job) -> None
+        """Waits for a free worker and renders a job on it."""
+
+        async with self.slots:
+            job.state = "running"
+            job.started = time.time()
+            loop = asyncio.get_running_loop()
+            try:
+                job.result = await loop.run_in_executor(
+                    self.pool, batch.run_job, job.job, job.directory,
+                    job.options)
+            except Exception as error:
+                # The worker process itself failed
+                job.result = {"error": "%s: %s" % (type(error).__name__,
+                                                   error), "timings": {}}
+        job.finished = time.time()
+        if job.result["error"] is None:
+            job.state = "done"
+            self.completed += 1
+        else:
+            job.state = "failed"
+            self.failed += 1
+        self.latencies.append((job.started - job.submitted,
+                               job.finished - job.started))
+        job.done.set()
+
+    def remove(self, job):
+        # type: (Job) -> None
+        """Forgets a job and removes its files."""
+
+        self.jobs.pop(job.id, None)
+        shutil.rmtree(job.directory, ignore_errors=True)
+
+    async def clean_up(self):
+        # type: () -> None
+        """Removes finished jobs that are older than the time to keep
+        them, forever."""
+
+        while True:
+            await asyncio.sleep(min(self.keep, 60.0))
+            now = time.time()  # type: float
+            for job in list(self.jobs.values()):
+                if job.finished is not None and \
+                   now - job.finished > self.keep:
+                    self.remove(job)
+
+    def metrics(self):
+        # type: () -> Dict[str, Any]
+        """Returns the queue depth, the counts, and the latencies."""
+
+        def statistics(values):
+            # type: (List[float]) -> Dict[str, Optional[float]]
+            values = sorted(values)
+            if not values:
+                return {"mean": None, "p50": None, "p95": None, "max": None}
+            return {
+                "mean": sum(values) / len(values),
+                "p50": values[len(values) // 2],
+                "p95": values[min(len(values) - 1,
+                                  int(len(values) * 0.95))],
+                "max": values[-1],
+            }
+
+        uptime = time.time() - self.started  # type: float
+        return {
+            "workers": self.workers,
+            "queued": self.queued(),
+            "running": self.running(),
+            "max_queue": self.max_queue,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "uptime": uptime,
+            "jobs_per_minute": 60.0 * (self.completed + self.failed) /
+            uptime if uptime else 0.0,
+            "queue_seconds": statistics([l[0] for l in self.latencies]),
+            "render_seconds": statistics([l[1] for l in self.latencies]),
+        }
+
+    async def submit(self,
+                     query,    # type: Dict[str, str]
+                     headers,  # type: Dict[str, str]
+                     reader    # type: asyncio.StreamReader
+                     ):
+        # type: (...) -> Job
+        """Checks a new job, stores its template, and queues it."""
+
+        job, options = parse_job(query)
+        try:
+            layout = WrapLayout.from_mm(*[job[key] for key in PARAMETERS],
+                                        dpi=job["dpi"])  # type: WrapLayout
+        except (ValueError, OverflowError) as error:
+            raise HttpError(422, "The box cannot be laid out: %s" % error)
+        if "content-length" not in headers:
+            raise HttpError(411, "The upload needs a Content-Length")
+        try:
+            length = int(headers["content-length"])  # type: int
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise HttpError(400, "The Content-Length is not a number")
+        if length > self.max_upload:
+            raise HttpError(413, "The template is larger than %d bytes"
+                            % self.max_upload)
+        if self.queued() >= self.max_queue:
+            raise HttpError(503, "The queue is full")
+
+        directory = os.path.join(self.directory, uuid.uuid4().hex)
+        os.makedirs(directory)
+        path = os.path.join(directory, "template")  # type: str
+        loop = asyncio.get_running_loop()
+        try:
+            with open(path, "wb") as template:
+                while length > 0:
+                    data = await reader.read(min(length, _CHUNK_SIZE))
+                    if not data:
+                        raise HttpError(400, "The upload ended early")
+                    # Writing to a slow disk must not hold up the other
+                    # connections
+                    await loop.run_in_executor(None, template.write, data)
+                    length -= len(data)
+            # The body has no file name.  The extension of its format lets
+            # the worker map uncompressed TIFF and PNM templates.
+            job["template"] = path + check_template(path, layout)
+            os.rename(path, job["template"])
+        except Exception:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+
+        queued = Job(directory, job, options)
+        self.jobs[queued.id] = queued
+        loop.create_task(self.render(queued))
+        return queued
+
+    async def handle(self, reader, writer):
+        # type: (asyncio.StreamReader, asyncio.StreamWriter) -> None
+        """Answers one request on a connection."""
+
+        try:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError):
+                return
+            lines = head.decode("latin-1").split("\r\n")
+            try:
+                method, target, _ = lines[0].split(" ", 2)
+            except ValueError:
+                await _respond(writer, 400, {"error": "Bad request line"})
+                return
+            headers = dict((name.strip().lower(), value.strip())
+                           for name, _, value in
+                           (line.partition(":") for line in lines[1:]
+                            if line))  # type: Dict[str, str]
+            url = urllib.parse.urlsplit(target)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            parts = [part for part in url.path.split("/") if part]
+            try:
+                await self.route(method, parts, query, headers, reader,
+                                 writer)
+            except HttpError as error:
+                if error.status in (400, 413, 422, 415, 503):
+                    self.rejected += 1
+                await _respond(writer, error.status, {"error": str(error)})
+            except Exception as error:
+                await _respond(writer, 500, {
+                    "error": "%s: %s" % (type(error).__name__, error)})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def route(self,
+                    method,   # type: str
+                    parts,    # type: List[str]
+                    query,    # type: Dict[str, str]
+                    headers,  # type: Dict[str, str]
+                    reader,   # type: asyncio.StreamReader
+                    writer    # type: asyncio.StreamWriter
+                    ):
+        # type: (...) -> None
+        """Answers a request by its method and path."""
+
+        if parts == ["metrics"] and method == "GET":
+            await _respond(writer, 200, self.metrics())
+        elif parts == ["jobs"] and method == "POST":
+            job = await self.submit(query, headers, reader)
+            await _respond(writer, 202, job.describe())
+        elif len(parts) in (2, 3) and parts[0] == "jobs":
+            job = self.jobs.get(parts[1])
+            if job is None:
+                raise HttpError(404, "There is no job %s" % parts[1])
+            if len(parts) == 2 and method == "GET":
+                await _respond(writer, 200, job.describe())
+            elif len(parts) == 2 and method == "DELETE":
+                if job.finished is None:
+                    raise HttpError(409, "The job is not finished yet")
+                self.remove(job)
+                await _respond(writer, 200, {"id": job.id,
+                                             "state": "removed"})
+            elif len(parts) == 3 and method == "GET":
+                if parts[2] not in job.files():
+                    raise HttpError(404, "The job has no file %s"
+                                    % parts[2])
+                await job.done.wait()
+                if job.state != "done":
+                    raise HttpError(409, job.result["error"])
+                await _send_file(writer,
+                                 os.path.join(job.directory, parts[2]))
+            else:
+                raise HttpError(405, "%s is not allowed here" % method)
+        else:
+            raise HttpError(404, "Not found")
+
+
+async def _respond(writer,  # type: asyncio.StreamWriter
+                   status,  # type: int
+                   body     # type: Dict[str, Any]
+                   ):
+    # type: (...) -> None
+    """Sends a JSON response."""
+
+    data = json.dumps(body, indent=2).encode("utf-8")  # type: bytes
+    writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n"
+                  "Content-Length: %d\r\nConnection: close\r\n\r\n"
+                  % (status, _REASONS.get(status, ""), len(data)))
+                 .encode("latin-1") + data)
+    await writer.drain()
+
+
+async def _send_file(writer,  # type: asyncio.StreamWriter
+                     path     # type: str
+                     ):
+    # type: (...) -> None
+    """Streams a file in chunks."""
+
+    content_type = {".png": "image/png", ".tif": "image/tiff",
+                    ".pdf": "application/pdf"}.get(
+        os.path.splitext(path)[1], "application/octet-stream")  # type: str
+    writer.write(("HTTP/1.1 200 OK\r\nContent-Type: %s\r\n"
+                  "Content-Length: %d\r\nConnection: close\r\n\r\n"
+                  % (content_type, os.path.getsize(path)))
+                 .encode("latin-1"))
+    with open(path, "rb") as data:
+        while True:
+            chunk = data.read(_CHUNK_SIZE)  # type: bytes
+            if not chunk:
+                break
+            writer.write(chunk)
+            await writer.drain()
+
+
+async def serve(service,       # type: Service
+                host=None,     # type: Optional[str]
+                port=None,     # type: Optional[int]
+                unix=None      # type: Optional[str]
+                ):
+    # type: (...) -> None
+    """Answers requests on a TCP port or a Unix socket until cancelled."""
+
+    service.start_workers()
+    if unix:
+        server = await asyncio.start_unix_server(service.handle, unix)
+    else:
+        server = await asyncio.start_server(service.handle, host, port)
+    cleaner = asyncio.get_running_loop().create_task(service.clean_up())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        cleaner.cancel()
+        service.pool.shutdown()
+
+
+def main(argv=None):
+    # type: (Optional[List[str]]) -> int
+    """Runs the service."""
+
+    parser = argparse.ArgumentParser(
+        description="Render wraps for uploaded templates over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8080,
+                        help="port to listen on (default: %(default)d)")
+    parser.add_argument("--unix", metavar="PATH", default=None,
+                        help="listen on this Unix socket instead")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes, and jobs rendered at the "
+                        "same time (default: number of cores)")
+    parser.add_argument("--max-queue", type=int, default=MAX_QUEUE,
+                        help="jobs that may wait for a worker "
+                        "(default: %(default)d)")
+    parser.add_argument("--max-upload", type=float,
+                        default=MAX_UPLOAD / (1024 * 1024), metavar="MB",
+                        help="largest template upload (default: "
+                        "%(default)g MB)")
+    parser.add_argument("--keep", type=float, default=KEEP_SECONDS,
+                        metavar="SECONDS",
+                        help="how long finished wraps are kept "
+                        "(default: %(default)g)")
+    parser.add_argument("--directory", default=None,
+                        help="directory for the jobs (default: a "
+                        "temporary one)")
+    args = parser.parse_args(argv)
+
+    directory = args.directory or tempfile.mkdtemp(prefix="boxwrap-")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    async def run():
+        # The service needs the running loop for its semaphore and events
+        service = Service(directory, args.workers, args.max_queue,
+                          int(args.max_upload * 1024 * 1024), args.keep)
+        await serve(service, args.host, args.port, args.unix)
+
+    sys.stdout.write("Serving on %s, jobs in %s\n" % (
+        args.unix or "http://%s:%d" % (args.host, args.port), directory))
+    sys.stdout.flush()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
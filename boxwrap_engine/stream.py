@@ -0,0 +1,230 @@
+"""Streaming renderer that writes a wrap to a file in horizontal bands.
+
+Only one band of the wrap is in memory at a time.  For each band the
+render plan tells which parts of the template are needed, so the
+template is only read and flattened where a copy actually touches the
+band.  Together with a lazily loaded template the peak memory depends on
+the band height and not on the size of the page.
+"""
+
+from boxwrap_engine import bleed, marks, pdf, plan, render, writers
+
+
+# Rows per band if nothing else is asked for
+BAND_HEIGHT = 256  # type: int
+
+
+def _intersection(a,  # type: Tuple[int, int, int, int]
+                  b   # type: Tuple[int, int, int, int]
+                  ):
+    # type: (...) -> Tuple[int, int, int, int]
+    """Returns the overlap of two rectangles, which may be empty."""
+
+    left = max(a[0], b[0])                          # type: int
+    top = max(a[1], b[1])                           # type: int
+    right = min(a[0] + a[2], b[0] + b[2])           # type: int
+    bottom = min(a[1] + a[3], b[1] + b[3])          # type: int
+    return left, top, max(right - left, 0), max(bottom - top, 0)
+
+
+def render_region(template,     # type: numpy.ndarray
+                  layout,       # type: WrapLayout
+                  operations,   # type: List[Copy]
+                  marks_first,  # type: bool
+                  marks_last,   # type: bool
+                  x,            # type: int
+                  y,            # type: int
+                  width,        # type: int
+                  height,       # type: int
+                  fills=None    # type: Optional[List[Fill]]
+                  ):
+    # type: (...) -> numpy.ndarray
+    """Renders a rectangular part of a wrap.
+
+    The template may be any array-like object that supports slicing, e.g.
+    a memory map.  Only the parts of it that end up in the region are
+    read and flattened.  Copies from the wrap itself are rendered from
+    the operations that come before them, and the bleed from all of
+    them.  Unless other fills are given the bleed of the layout is
+    drawn.
+    """
+
+    if fills is None:
+        fills = bleed.bleed_fills(layout, operations)
+
+    region = render.new_wrap(width, height)
+    area = (x, y, width, height)  # type: Tuple[int, int, int, int]
+    rectangles = [(left - x, top - y, w, h) for left, top, w, h
+                  in marks.mark_rectangles(layout)]
+
+    if marks_first:
+        render.draw_marks(region, rectangles)
+
+    for index, copy in enumerate(operations):
+        dst_x, dst_y, w, h = _intersection(
+            plan.destination_rectangle(copy), area)
+        if w == 0 or h == 0:
+            continue
+        src_x, src_y, src_width, src_height = plan.source_rectangle(
+            copy, dst_x, dst_y, w, h)
+        if copy.source == plan.TEMPLATE:
+            pixels = render.flatten(template[src_y:src_y + src_height,
+                                             src_x:src_x + src_width])
+        else:
+            pixels = render_region(template, layout, operations[:index],
+                                   marks_first, False,
+                                   src_x, src_y, src_width, src_height, [])
+        region[dst_y - y:dst_y - y + h, dst_x - x:dst_x - x + w] = \
+            render.rotate(pixels, copy.angle)
+
+    for fill in fills:
+        part = bleed.clip_fill(fill, area)  # type: Optional[Fill]
+        if part is None:
+            continue
+        src_x, src_y, src_width, src_height = bleed.source_rectangle(part)
+        pixels = render_region(template, layout, operations, False, False,
+                               src_x, src_y, src_width, src_height, [])
+        region[part.dst_y - y:part.dst_y - y + part.height,
+               part.dst_x - x:part.dst_x - x + part.width] = \
+            bleed.fill_pixels(pixels, part, src_x, src_y)
+
+    if marks_last:
+        render.draw_marks(region, rectangles)
+    return region
+
+
+def update_wrap(template,    # type: numpy.ndarray
+                layout,      # type: WrapLayout
+                operations,  # type: List[Copy]
+                wrap,        # type: numpy.ndarray
+                rectangles   # type: List[Tuple[int, int, int, int]]
+                ):
+    # type: (...) -> None
+    """Draws the given rectangles of a finished wrap again from the
+    template.  Everything outside of them stays as it is."""
+
+    marks_last = marks.drawn_last(layout, operations)  # type: bool
+    fills = bleed.bleed_fills(layout, operations)  # type: List[Fill]
+    for rectangle in rectangles:
+        x, y, width, height = _intersection(
+            rectangle, (0, 0, layout.dst_width, layout.dst_height))
+        if width == 0 or height == 0:
+            continue
+        wrap[y:y + height, x:x + width] = render_region(
+            template, layout, operations, not marks_last, marks_last,
+            x, y, width, height, fills)
+
+
+def render_to_file(template,                 # type: numpy.ndarray
+                   layout,                   # type: WrapLayout
+                   copy_definitions,
+                   path,                     # type: str
+                   band_height=BAND_HEIGHT,  # type: int
+                   level=6,                  # type: int
+                   pool=None,                # type: Optional[ThreadPool]
+                   threads=1                 # type: int
+                   ):
+    # type: (...) -> None
+    """Renders one wrap band by band into a PNG or TIFF file.  The bands
+    are compressed on the pool of threads if one is given, threads is
+    its size.
+
+    Raises a TemplateSizeError if the template does not fit the box.
+    """
+
+    layout.check_template_size(template.shape[1], template.shape[0])
+    operations = plan.compile_plan(layout, copy_definitions)
+    marks_last = marks.drawn_last(layout, operations)  # type: bool
+    fills = bleed.bleed_fills(layout, operations)  # type: List[Fill]
+
+    with writers.open_writer(path, layout.dst_width, layout.dst_height,
+                             level, layout.dpi, pool,
+                             threads=threads) as writer:
+        for y in range(0, layout.dst_height, band_height):
+            writer.write(render_region(
+                template, layout, operations, not marks_last, marks_last,
+                0, y, layout.dst_width,
+                min(band_height, layout.dst_height - y), fills))
+
+
+def render_wraps_to_files(template,                 # type: numpy.ndarray
+                          layout,                   # type: WrapLayout
+                          top_path,                 # type: str
+                          bottom_path,              # type: str
+                          band_height=BAND_HEIGHT,  # type: int
+                          level=6,                  # type: int
+                          threads=1,                # type: Optional[int]
+                          convert=None  # type: Optional[CmykConverter]
+                          ):
+    # type: (...) -> None
+    """Renders the top and the bottom wrap band by band into files.
+
+    With more than one thread the bands of both wraps are rendered in
+    turns and compressed at the same time on a shared pool.  None means
+    one thread per core.  With a CmykConverter the bands are converted
+    to CMYK before they are written.  If anything fails, neither file is
+    left.
+    """
+
+    layout.check_template_size(template.shape[1], template.shape[0])
+    pool = writers.open_pool(threads)
+    outputs = []  # type: List[Tuple[Any, List[Copy], bool, List[Fill]]]
+    try:
+        for copy_definitions, path in ((layout.copy_definitions_top,
+                                        top_path),
+                                       (layout.copy_definitions_bottom,
+                                        bottom_path)):
+            operations = plan.compile_plan(layout, copy_definitions)
+            outputs.append((writers.open_writer(
+                path, layout.dst_width, layout.dst_height, level,
+                layout.dpi, pool, convert and convert.profile,
+                writers.pool_size(threads)), operations,
+                marks.drawn_last(layout, operations),
+                bleed.bleed_fills(layout, operations)))
+        for y in range(0, layout.dst_height, band_height):
+            for writer, operations, marks_last, fills in outputs:
+                band = render_region(
+                    template, layout, operations, not marks_last,
+                    marks_last, 0, y, layout.dst_width,
+                    min(band_height, layout.dst_height - y), fills)
+                writer.write(convert(band) if convert else band)
+        for writer, _, _, _ in outputs:
+            writer.close()
+    except BaseException:
+        for writer, _, _, _ in outputs:
+            writer.abort()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def render_wraps_to_pdf(template,                 # type: numpy.ndarray
+                        layout,                   # type: WrapLayout
+                        path,                     # type: str
+                        band_height=BAND_HEIGHT,  # type: int
+                        level=6                   # type: int
+                        ):
+    # type: (...) -> None
+    """Renders the top and the bottom wrap band by band into the two
+    pages of a PDF file.
+
+    The marks are left out of the pixels because the PDF file has them
+    as vector graphics.  Raises a TemplateSizeError if the template does
+    not fit the box.
+    """
+
+    layout.check_template_size(template.shape[1], template.shape[0])
+    with pdf.PdfWriter(path, level) as writer:
+        for copy_definitions in (layout.copy_definitions_top,
+                                 layout.copy_definitions_bottom):
+            operations = plan.compile_plan(layout, copy_definitions)
+            fills = bleed.bleed_fills(layout, operations)  # type: List[Fill]
+            writer.begin_page(layout)
+            for y in range(0, layout.dst_height, band_height):
+                writer.write(render_region(
+                    template, layout, operations, False, False,
+                    0, y, layout.dst_width,
+                    min(band_height, layout.dst_height - y), fills))
+            writer.end_page()
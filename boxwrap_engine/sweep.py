@@ -0,0 +1,409 @@
+"""Renders the wraps of one box for many cardboard thicknesses, flap
+sizes and inside sizes, to compare test prints with new board stock.
+
+The template only depends on the width, the height and the depth of the
+box, so all variants read the same faces.  Faces flattens the parts of
+the template that any of the variants read once, and rotates them once
+for every angle they are read at.  Each variant then only copies
+contiguous blocks of pixels into its wraps.  The variants are written as
+separate files or one below the other on a contact sheet, each with a
+caption.
+
+Usage: python -m boxwrap_engine.sweep TEMPLATE WIDTH HEIGHT DEPTH
+       [--thickness MM,...] [--flap-size MM,...] [--inside-size MM,...]
+       [-o DIRECTORY] [--sheet]
+"""
+
+import argparse
+import collections
+import itertools
+import os
+import sys
+import time
+
+import numpy
+from PIL import Image, ImageDraw, ImageFont
+
+from boxwrap_engine import bleed, imagefile, marks, plan, preview, render, \
+    writers
+from boxwrap_engine.layout import DEFAULTS, DPI, WrapLayout, mm_to_px
+
+
+# One setting of the sweep, the sizes in mm
+Variant = collections.namedtuple(
+    "Variant", ("thickness", "flap_size", "inside_size", "layout"))
+
+# Height of the caption above each variant on a contact sheet and the
+# space around the wraps, in mm
+CAPTION = 6.0  # type: float
+GAP = 4.0      # type: float
+
+
+def _union(a,  # type: Tuple[int, int, int, int]
+           b   # type: Tuple[int, int, int, int]
+           ):
+    # type: (...) -> Tuple[int, int, int, int]
+    """Returns the bounding box of two rectangles."""
+
+    left = min(a[0], b[0])                         # type: int
+    top = min(a[1], b[1])                          # type: int
+    right = max(a[0] + a[2], b[0] + b[2])          # type: int
+    bottom = max(a[1] + a[3], b[1] + b[3])         # type: int
+    return left, top, right - left, bottom - top
+
+
+def _clusters(rectangles):
+    # type: (List[Tuple[int, int, int, int]]) -> List[Tuple[int, ...]]
+    """Returns the bounding boxes of the groups of rectangles that
+    overlap.  The faces of a template only touch, so every face and the
+    strips read from it for the flaps end up in a group of their own."""
+
+    boxes = []  # type: List[Tuple[int, int, int, int]]
+    for rectangle in rectangles:
+        overlapping = [box for box in boxes
+                       if plan.intersects(box, rectangle)]
+        while overlapping:
+            for box in overlapping:
+                boxes.remove(box)
+                rectangle = _union(box, rectangle)
+            overlapping = [box for box in boxes
+                           if plan.intersects(box, rectangle)]
+        boxes.append(rectangle)
+    return boxes
+
+
+def _rotated_rectangle(rectangle,  # type: Tuple[int, int, int, int]
+                       width,      # type: int
+                       height,     # type: int
+                       angle       # type: int
+                       ):
+    # type: (...) -> Tuple[int, int, int, int]
+    """Returns where a rectangle of an image of the given size ends up
+    when the image is rotated clockwise by angle."""
+
+    x, y, w, h = rectangle
+    if angle == 90:
+        return height - y - h, x, h, w
+    if angle == 180:
+        return width - x - w, height - y - h, w, h
+    if angle == 270:
+        return y, width - x - w, h, w
+    return rectangle
+
+
+class Faces:
+    """The parts of a template that a set of render plans read, flattened
+    once and rotated once for every angle they are read at."""
+
+    def __init__(self,
+                 template,  # type: numpy.ndarray
+                 plans      # type: List[List[Copy]]
+                 ):
+        # type: (...) -> None
+        rectangles = {}  # type: Dict[int, List[Tuple[int, int, int, int]]]
+        for operations in plans:
+            for copy in operations:
+                if copy.source == plan.TEMPLATE:
+                    rectangles.setdefault(copy.angle, []).append(
+                        (copy.src_x, copy.src_y, copy.src_width,
+                         copy.src_height))
+
+        if isinstance(template, numpy.ndarray) and \
+           template.dtype == numpy.uint8 and template.ndim == 3 and \
+           template.shape[2] == 3:
+            flat = template
+        else:
+            # Like render.flatten_used, but every pixel is only flattened
+            # once although the variants read overlapping rectangles
+            flat = numpy.zeros((template.shape[0], template.shape[1], 3),
+                               dtype=numpy.uint8)
+            for x, y, width, height in _clusters(
+                    sum(rectangles.values(), [])):
+                flat[y:y + height, x:x + width] = render.flatten(
+                    template[y:y + height, x:x + width])
+
+        # Angle -> the blocks read at that angle and their rotated pixels
+        self.blocks = {}  # type: Dict[int, List[Tuple[Any, numpy.ndarray]]]
+        for angle, found in rectangles.items():
+            self.blocks[angle] = [
+                (box, numpy.ascontiguousarray(render.rotate(
+                    flat[box[1]:box[1] + box[3], box[0]:box[0] + box[2]],
+                    angle)))
+                for box in _clusters(found)]
+
+    def pixels(self, copy):
+        # type: (Copy) -> numpy.ndarray
+        """Returns the rotated pixels of a copy from the template."""
+
+        source = (copy.src_x, copy.src_y, copy.src_width,
+                  copy.src_height)  # type: Tuple[int, int, int, int]
+        for box, pixels in self.blocks[copy.angle]:
+            if plan.contains(box, source):
+                x, y, width, height = _rotated_rectangle(
+                    (source[0] - box[0], source[1] - box[1], source[2],
+                     source[3]), box[2], box[3], copy.angle)
+                return pixels[y:y + height, x:x + width]
+        raise ValueError("The faces were extracted for other plans")
+
+
+def render_wrap(faces,      # type: Faces
+                layout,     # type: WrapLayout
+                operations  # type: List[Copy]
+                ):
+    # type: (...) -> numpy.ndarray
+    """Renders one wrap of a variant from the shared faces, the same way
+    as render.render_wrap does from a template."""
+
+    marks_last = marks.drawn_last(layout, operations)  # type: bool
+    if marks_last:
+        dst = render.new_wrap(layout.dst_width, layout.dst_height)
+    else:
+        dst = render.wrap_overlay(layout).copy()
+    for copy in operations:
+        if copy.source == plan.TEMPLATE:
+            x, y, width, height = plan.destination_rectangle(copy)
+            dst[y:y + height, x:x + width] = faces.pixels(copy)
+        else:
+            render.execute_copy(None, dst, copy)
+    bleed.apply_fills(dst, bleed.bleed_fills(layout, operations))
+    if marks_last:
+        render.draw_marks(dst, marks.mark_rectangles(layout))
+    return dst
+
+
+def make_variants(width,                  # type: float
+                  height,                 # type: float
+                  depth,                  # type: float
+                  thicknesses,            # type: List[float]
+                  flap_sizes,             # type: List[float]
+                  inside_sizes,           # type: List[float]
+                  crop_mark_size=DEFAULTS["crop_mark_size"],  # type: float
+                  crop_mark_distance=DEFAULTS["crop_mark_distance"],
+                  dpi=DPI,                # type: float
+                  bleed_mm=0.0,           # type: float
+                  bleed_mode=bleed.MODES[0]  # type: str
+                  ):
+    # type: (...) -> List[Variant]
+    """Returns every combination of the thicknesses, the flap sizes and
+    the inside sizes of one box, in this order."""
+
+    return [Variant(thickness, flap_size, inside_size, WrapLayout.from_mm(
+        width, height, depth, thickness, flap_size, inside_size,
+        crop_mark_size, crop_mark_distance, dpi, bleed_mm, bleed_mode))
+        for thickness, flap_size, inside_size in itertools.product(
+            thicknesses, flap_sizes, inside_sizes)]
+
+
+def variant_name(variant):
+    # type: (Variant) -> str
+    """Returns the part of the file names that tells the variants
+    apart."""
+
+    return "t%g-f%g-i%g" % (variant.thickness, variant.flap_size,
+                            variant.inside_size)
+
+
+def at_resolution(variants,  # type: List[Variant]
+                  dpi        # type: float
+                  ):
+    # type: (...) -> List[Variant]
+    """Returns the same variants at another resolution."""
+
+    return [variant._replace(layout=variant.layout.at_resolution(dpi))
+            for variant in variants]
+
+
+def sweep(template,         # type: numpy.ndarray
+          variants,         # type: List[Variant]
+          preview_dpi=None  # type: Optional[float]
+          ):
+    # type: (...) -> Iterator[Tuple[Variant, numpy.ndarray, numpy.ndarray]]
+    """Renders the top and the bottom wrap of every variant, one variant
+    at a time.  With a preview resolution the variants are rendered from
+    a template that is downsampled once.
+
+    Raises a TemplateSizeError if the template does not fit the box.
+    """
+
+    layout = variants[0].layout  # type: WrapLayout
+    layout.check_template_size(template.shape[1], template.shape[0])
+    if preview_dpi:
+        template = preview.downsample_template(
+            template, layout, layout.at_resolution(preview_dpi))
+        variants = at_resolution(variants, preview_dpi)
+
+    plans = [plan.compile_plans(variant.layout) for variant in variants]
+    faces = Faces(template, sum((list(p) for p in plans), []))
+    for variant, (top, bottom) in zip(variants, plans):
+        yield (variant, render_wrap(faces, variant.layout, top),
+               render_wrap(faces, variant.layout, bottom))
+
+
+def _font(size):
+    # type: (int) -> ImageFont.ImageFont
+    """Returns the font of the captions in a size in px if Pillow can
+    scale its default font."""
+
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        # Pillow before 10.1 only has a small bitmap font
+        return ImageFont.load_default()
+
+
+def caption(variant):
+    # type: (Variant) -> str
+    """Returns the caption of a variant on a contact sheet."""
+
+    return "thickness %g mm, flaps %g mm, inside %g mm" % (
+        variant.thickness, variant.flap_size, variant.inside_size)
+
+
+def write_sheet(path,             # type: str
+                wraps,            # type: Iterator[Tuple[Variant, Any, Any]]
+                variants,         # type: List[Variant]
+                dpi,              # type: float
+                level=6           # type: int
+                ):
+    # type: (...) -> None
+    """Places the top and the bottom wrap of every variant next to each
+    other and the variants below each other on one contact sheet, each
+    with a caption, and writes it to a PNG or TIFF file.
+
+    The sheet is laid out from the variants at the resolution dpi before
+    the wraps come in, so only the sheet and one variant are in memory.
+    """
+
+    caption_height = mm_to_px(CAPTION, dpi)  # type: int
+    gap = mm_to_px(GAP, dpi)                 # type: int
+    width = gap + max(2 * v.layout.dst_width + gap
+                      for v in variants) + gap  # type: int
+    height = gap + sum(caption_height + v.layout.dst_height + gap
+                       for v in variants)  # type: int
+    sheet = render.new_wrap(width, height)
+    font = _font(caption_height * 3 // 4)
+
+    y = gap  # type: int
+    for variant, top, bottom in wraps:
+        label = Image.new("RGB", (width - 2 * gap, caption_height), "white")
+        ImageDraw.Draw(label).text((0, 0), caption(variant), fill="black",
+                                   font=font)
+        sheet[y:y + caption_height, gap:width - gap] = numpy.asarray(label)
+        y += caption_height
+        wrap_height, wrap_width = top.shape[:2]
+        sheet[y:y + wrap_height, gap:gap + wrap_width] = top
+        sheet[y:y + wrap_height,
+              2 * gap + wrap_width:2 * gap + 2 * wrap_width] = bottom
+        y += wrap_height + gap
+
+    with writers.open_writer(path, width, height, level, dpi) as writer:
+        for row in range(0, height, writers.ROWS_PER_BAND):
+            writer.write(sheet[row:row + writers.ROWS_PER_BAND])
+
+
+def _sizes(text):
+    # type: (str) -> List[float]
+    """Reads a comma separated list of sizes in mm."""
+
+    try:
+        sizes = [float(size) for size in text.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "%r is not a list of sizes in mm like 1.5,2,2.5" % text)
+    if any(size < 0 for size in sizes):
+        raise argparse.ArgumentTypeError("Sizes must not be negative")
+    return sizes
+
+
+def main(argv=None):
+    # type: (Optional[List[str]]) -> int
+    """Runs the command line tool."""
+
+    parser = argparse.ArgumentParser(
+        description="Render the wraps of one template for several "
+        "cardboard thicknesses, flap sizes, and inside sizes.")
+    parser.add_argument("template", help="template image")
+    parser.add_argument("width", type=float, help="box width in mm")
+    parser.add_argument("height", type=float, help="box height in mm")
+    parser.add_argument("depth", type=float, help="box depth in mm")
+    for name in ("thickness", "flap_size", "inside_size"):
+        parser.add_argument("--" + name.replace("_", "-"), type=_sizes,
+                            default=[DEFAULTS[name]], metavar="MM,...",
+                            help="%s in mm, one variant per value "
+                            "(default: %g)" % (name.replace("_", " "),
+                                               DEFAULTS[name]))
+    parser.add_argument("--crop-mark-size", type=float,
+                        default=DEFAULTS["crop_mark_size"],
+                        help="size of the crop marks in mm "
+                        "(default: %(default)g)")
+    parser.add_argument("--crop-mark-distance", type=float,
+                        default=DEFAULTS["crop_mark_distance"],
+                        help="distance between the crop marks and the "
+                        "wrap in mm (default: %(default)g)")
+    parser.add_argument("--dpi", type=float, default=DPI,
+                        help="resolution of the template "
+                        "(default: %(default)g)")
+    parser.add_argument("--bleed", type=float, default=0.0, metavar="MM",
+                        help="extend the picture beyond the outer edges "
+                        "(default: no bleed)")
+    parser.add_argument("--bleed-mode", choices=bleed.MODES,
+                        default=bleed.MODES[0],
+                        help="how the bleed is filled "
+                        "(default: %(default)s)")
+    parser.add_argument("--preview", type=float, metavar="DPI",
+                        default=None,
+                        help="render the variants at this lower resolution")
+    parser.add_argument("-o", "--output", default=".",
+                        help="directory for the wraps (default: the "
+                        "current directory)")
+    parser.add_argument("--name", default=None,
+                        help="start of the file names (default: the name "
+                        "of the template)")
+    parser.add_argument("-f", "--format", choices=("png", "tif"),
+                        default="png", help="file format of the wraps")
+    parser.add_argument("--level", type=int, choices=range(10), default=6,
+                        metavar="0-9", help="compression level "
+                        "(default: %(default)d)")
+    parser.add_argument("--sheet", action="store_true",
+                        help="put all variants on one contact sheet "
+                        "instead of separate files")
+    args = parser.parse_args(argv)
+
+    name = args.name or os.path.splitext(
+        os.path.basename(args.template))[0]  # type: str
+    try:
+        variants = make_variants(
+            args.width, args.height, args.depth, args.thickness,
+            args.flap_size, args.inside_size, args.crop_mark_size,
+            args.crop_mark_distance, args.dpi, args.bleed, args.bleed_mode)
+        layout = variants[0].layout  # type: WrapLayout
+        template = imagefile.load_template(
+            args.template, (layout.src_width, layout.src_height))
+        wraps = sweep(template, variants, args.preview)
+        if not os.path.isdir(args.output):
+            os.makedirs(args.output)
+        dpi = args.preview or args.dpi  # type: float
+        start = time.time()  # type: float
+        if args.sheet:
+            path = os.path.join(args.output, "%s_sweep.%s"
+                                % (name, args.format))  # type: str
+            write_sheet(path, wraps, at_resolution(variants, dpi)
+                        if args.preview else variants, dpi, args.level)
+            sys.stdout.write("%d variants  %s\n" % (len(variants), path))
+        else:
+            for variant, top, bottom in wraps:
+                paths = [os.path.join(args.output, "%s_%s_%s.%s" % (
+                    name, variant_name(variant), part, args.format))
+                    for part in ("top", "bottom")]  # type: List[str]
+                writers.write_images(paths, [top, bottom], args.level, dpi)
+                sys.stdout.write("%-24s %s\n" % (variant_name(variant),
+                                                 paths[0]))
+        sys.stdout.write("%.2fs\n" % (time.time() - start))
+    except (IOError, ValueError) as error:
+        sys.stderr.write("%s\n" % error)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,319 @@
+"""Watches a folder and renders the wraps again whenever a template
+changes.
+
+The dimensions of a box are read from a sidecar file next to its
+template, catan.json for catan.png, with the same keys as an entry of a
+JSON manifest:
+
+    {"width": 75, "height": 104, "depth": 100, "dpi": 300}
+
+or from the text chunk "boxwrap" of a PNG template, or the description
+of a TIFF template, with the same JSON.  Templates without dimensions
+are skipped.
+
+The folder is polled, which costs one stat per file and works on every
+system and on network shares.  A template is rendered once neither it
+nor its sidecar file changed for the settle time, so a burst of saves
+leads to one render of the last version.  Templates that change while
+they are rendered are rendered again afterwards.  Different templates
+are rendered in parallel on a pool of worker processes.
+
+Usage: python -m boxwrap_engine.watch FOLDER [-o DIRECTORY] [-j JOBS]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from PIL import Image
+
+from boxwrap_engine import batch
+
+
+# File extensions of templates
+TEMPLATE_EXTENSIONS = (".png", ".tif", ".tiff", ".jpg", ".jpeg", ".ppm",
+                       ".pnm", ".pam")  # type: Tuple[str, ...]
+
+# Seconds between two looks at the folder
+INTERVAL = 0.5  # type: float
+
+# Seconds a template must stay unchanged before it is rendered
+SETTLE = 2.0  # type: float
+
+
+def _signature(path):
+    # type: (str) -> Optional[Tuple[int, int]]
+    """Returns the modification time and the size of a file, or None if
+    there is no such file."""
+
+    try:
+        status = os.stat(path)
+    except OSError:
+        return None
+    return status.st_mtime_ns, status.st_size
+
+
+def read_dimensions(template):
+    # type: (str) -> Optional[Dict[str, Any]]
+    """Returns the manifest entry of a template from its sidecar file or
+    its embedded metadata, or None if it has neither.
+
+    Raises a ValueError if the dimensions cannot be read.
+    """
+
+    sidecar = os.path.splitext(template)[0] + ".json"  # type: str
+    if os.path.exists(sidecar):
+        with open(sidecar) as data:
+            entry = json.load(data)
+    else:
+        with Image.open(template) as image:
+            text = image.info.get("boxwrap")  # type: Optional[str]
+            if text is None and hasattr(image, "tag_v2"):
+                text = image.tag_v2.get(270)
+        if not text:
+            return None
+        try:
+            entry = json.loads(text)
+        except ValueError:
+            # Some other description
+            return None
+    if not isinstance(entry, dict):
+        raise batch.ManifestError("%s does not hold an object"
+                                  % os.path.basename(sidecar))
+    return entry
+
+
+def output_name(path,       # type: str
+                templates,  # type: Iterable[str]
+                name=None   # type: Optional[str]
+                ):
+    # type: (...) -> str
+    """Returns the name of the wraps of a template, by default its file
+    name without the extension.
+
+    Templates with the same name but different extensions, catan.png and
+    catan.tif, share the sidecar file, so the extension is added to the
+    name of each to keep their wraps apart: catan_png and catan_tif.
+    """
+
+    stem, extension = os.path.splitext(os.path.basename(path))
+    if any(other != path and os.path.splitext(
+            os.path.basename(other))[0].lower() == stem.lower()
+           for other in templates):
+        return "%s_%s" % (name or stem, extension[1:].lower())
+    return name or stem
+
+
+class Watcher:
+    """Keeps track of the templates in a folder and of their renders."""
+
+    def __init__(self,
+                 folder,             # type: str
+                 directory,          # type: str
+                 options=None,       # type: Optional[Dict[str, Any]]
+                 settle=SETTLE       # type: float
+                 ):
+        # type: (...) -> None
+        self.folder = os.path.abspath(folder)  # type: str
+        self.directory = directory             # type: str
+        self.options = options or {}           # type: Dict[str, Any]
+        self.settle = settle                   # type: float
+        # Template -> the signatures of the template and of its sidecar
+        # file when they were last seen, and the time they last changed
+        self.seen = {}  # type: Dict[str, Tuple[Any, float]]
+        # Template -> the signatures that were rendered last
+        self.rendered = {}  # type: Dict[str, Any]
+        # Template -> the signatures being rendered, and the result
+        self.running = {}  # type: Dict[str, Tuple[Any, Any]]
+
+    def templates(self):
+        # type: () -> Dict[str, Any]
+        """Returns the templates in the folder and their signatures."""
+
+        found = {}  # type: Dict[str, Any]
+        for entry in os.scandir(self.folder):
+            if not entry.name.lower().endswith(TEMPLATE_EXTENSIONS) or \
+               entry.name.startswith(".") or not entry.is_file():
+                continue
+            path = entry.path  # type: str
+            found[path] = (_signature(path), _signature(
+                os.path.splitext(path)[0] + ".json"))
+        return found
+
+    def skip_unchanged(self):
+        # type: () -> None
+        """Marks templates whose wraps are newer than the template and
+        its sidecar file as rendered."""
+
+        suffix = self.options.get("format", "png")  # type: str
+        templates = self.templates()  # type: Dict[str, Any]
+        for path, signatures in templates.items():
+            name = output_name(path, templates)  # type: str
+            if suffix == "pdf":
+                wrap = "%s.pdf" % name  # type: str
+            else:
+                wrap = "%s_bottom.%s" % (name, suffix)
+            rendered = _signature(os.path.join(self.directory, wrap))
+            if rendered is not None and all(
+                    s is None or s[0] <= rendered[0] for s in signatures):
+                self.rendered[path] = signatures
+
+    def ready(self, now):
+        # type: (float) -> List[Tuple[str, Any]]
+        """Looks at the folder and returns the templates that changed and
+        then settled, with their signatures."""
+
+        templates = self.templates()
+        for path in list(self.seen):
+            if path not in templates:
+                del self.seen[path]
+                self.rendered.pop(path, None)
+        settled = []  # type: List[Tuple[str, Any]]
+        for path, signatures in templates.items():
+            seen = self.seen.get(path)
+            if seen is None or seen[0] != signatures:
+                # Changed since the last look, wait for it to settle
+                self.seen[path] = (signatures, now)
+            elif now - seen[1] >= self.settle and \
+                    self.rendered.get(path) != signatures and \
+                    path not in self.running:
+                settled.append((path, signatures))
+        return settled
+
+    def job(self, path):
+        # type: (str) -> Optional[Dict[str, Any]]
+        """Returns the job for a template, or None if it has no
+        dimensions.  Raises a ValueError if they are invalid."""
+
+        entry = read_dimensions(path)
+        if entry is None:
+            return None
+        entry = dict(entry, template=os.path.basename(path))
+        entry["name"] = output_name(path, self.templates(),
+                                    entry.get("name"))
+        return batch.make_job(entry, self.folder, 1)
+
+
+def _report(path, result):
+    # type: (str, Dict[str, Any]) -> None
+    if result["error"] is None:
+        sys.stdout.write("ok      %-30s %6.2fs\n"
+                         % (result["name"], result["timings"]["total"]))
+    else:
+        sys.stdout.write("FAILED  %-30s %s\n"
+                         % (os.path.basename(path), result["error"]))
+    sys.stdout.flush()
+
+
+def watch(folder,              # type: str
+          directory,           # type: str
+          processes=None,      # type: Optional[int]
+          options=None,        # type: Optional[Dict[str, Any]]
+          interval=INTERVAL,   # type: float
+          settle=SETTLE,       # type: float
+          once=False           # type: bool
+          ):
+    # type: (...) -> None
+    """Renders the templates in a folder whenever they change, until
+    interrupted.  With once, returns when all templates are rendered."""
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    watcher = Watcher(folder, directory, options, settle)
+    watcher.skip_unchanged()
+    pool = multiprocessing.Pool(processes)
+    try:
+        while True:
+            now = time.time()  # type: float
+            for path, signatures in watcher.ready(now):
+                try:
+                    job = watcher.job(path)
+                except (IOError, ValueError) as error:
+                    _report(path, {"error": str(error)})
+                    watcher.rendered[path] = signatures
+                    continue
+                if job is None:
+                    # Not a template, or its sidecar file is still missing
+                    watcher.rendered[path] = signatures
+                    continue
+                watcher.running[path] = (signatures, pool.apply_async(
+                    batch.run_job, (job, directory, options)))
+
+            for path, (signatures, result) in list(watcher.running.items()):
+                if result.ready():
+                    del watcher.running[path]
+                    # A newer version has a newer signature, so it is
+                    # rendered again in one of the next rounds
+                    watcher.rendered[path] = signatures
+                    _report(path, result.get())
+
+            if once and not watcher.running and all(
+                    watcher.rendered.get(path) == signatures
+                    for path, (signatures, _) in watcher.seen.items()):
+                return
+            time.sleep(interval)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main(argv=None):
+    # type: (Optional[List[str]]) -> int
+    """Runs the command line tool."""
+
+    parser = argparse.ArgumentParser(
+        description="Render the wraps of all templates in a folder again "
+        "whenever they change.")
+    parser.add_argument("folder", help="folder with the templates")
+    parser.add_argument("-o", "--output", default=None,
+                        help="directory for the wraps (default: FOLDER/"
+                        "wraps)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of worker processes "
+                        "(default: number of cores)")
+    parser.add_argument("-f", "--format", choices=("png", "tif", "pdf"),
+                        default=batch.OPTIONS["format"],
+                        help="file format of the wraps")
+    parser.add_argument("--level", type=int, choices=range(10),
+                        default=batch.OPTIONS["level"], metavar="0-9",
+                        help="compression level (default: %(default)d)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only draw the parts of the wraps again that "
+                        "depend on faces that changed")
+    parser.add_argument("--interval", type=float, default=INTERVAL,
+                        help="seconds between two looks at the folder "
+                        "(default: %(default)g)")
+    parser.add_argument("--settle", type=float, default=SETTLE,
+                        help="seconds a template must stay unchanged "
+                        "before it is rendered (default: %(default)g)")
+    parser.add_argument("--once", action="store_true",
+                        help="render what changed since the last run and "
+                        "stop")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.folder):
+        sys.stderr.write("%s is not a folder\n" % args.folder)
+        return 2
+    output = args.output or os.path.join(args.folder, "wraps")  # type: str
+    if os.path.abspath(output) == os.path.abspath(args.folder):
+        # The wraps would be taken for templates
+        sys.stderr.write("The wraps need a folder of their own\n")
+        return 2
+    options = {
+        "format": args.format,
+        "level": args.level,
+        "incremental": args.incremental,
+    }  # type: Dict[str, Any]
+    try:
+        watch(args.folder, output, args.jobs, options, args.interval,
+              args.settle, args.once)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,479 @@
+"""Image writers that take the pixels in horizontal bands.
+
+Unlike Pillow these writers never need the whole image in memory.  The
+rows are written in order from top to bottom, a band at a time, and
+only the bands that are being compressed are kept.
+
+Each band is compressed on its own, so the bands can be compressed at
+the same time on a pool of threads.  zlib does not hold the global
+interpreter lock while it compresses, so threads are enough.  Several
+writers may share one pool.
+
+A writer that fails or is aborted removes its file, so a partial image
+is never left behind.
+"""
+
+import multiprocessing
+import os
+import struct
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from boxwrap_engine.layout import DPI
+
+
+# Rows per band when a whole image is written at once
+ROWS_PER_BAND = 256  # type: int
+
+# Classic TIFF files have 32 bit offsets, so larger ones are BigTIFF
+TIFF_LIMIT = 1 << 32  # type: int
+
+# TIFF field types and how their values are packed
+_SHORT, _LONG, _RATIONAL, _UNDEFINED, _LONG8 = 3, 4, 5, 7, 16
+_TIFF_FORMATS = {_SHORT: "H", _LONG: "I", _RATIONAL: "I", _UNDEFINED: "B",
+                 _LONG8: "Q"}  # type: Dict[int, str]
+
+
+class _Encoder:
+    """Compresses bands in order, either right away or on a pool of
+    threads, and hands the results back in the same order."""
+
+    def __init__(self,
+                 compress,   # type: Callable[[bytes], bytes]
+                 pool=None,  # type: Optional[ThreadPool]
+                 threads=1   # type: int
+                 ):
+        # type: (...) -> None
+        self.compress = compress
+        self.pool = pool
+        self.pending = []  # type: List[Any]
+        # Enough bands in flight to keep every thread of the pool busy
+        self.limit = 2 * threads if pool is not None else 0  # type: int
+
+    def submit(self, data):
+        # type: (bytes) -> List[bytes]
+        """Compresses a band and returns all results that are ready."""
+
+        if self.pool is None:
+            return [self.compress(data)]
+        self.pending.append(self.pool.apply_async(self.compress, (data,)))
+        done = []  # type: List[bytes]
+        while self.pending and (len(self.pending) > self.limit or
+                                self.pending[0].ready()):
+            done.append(self.pending.pop(0).get())
+        return done
+
+    def finish(self):
+        # type: () -> List[bytes]
+        """Waits for the remaining bands."""
+
+        done = [result.get() for result in self.pending]
+        self.pending = []
+        return done
+
+    def cancel(self):
+        # type: () -> None
+        """Drops the bands that are still being compressed."""
+
+        self.pending = []
+
+
+def _remove(path):
+    # type: (str) -> None
+    """Removes a file that may not exist."""
+
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _deflate_block(level):
+    # type: (int) -> Callable[[bytes], bytes]
+    """Returns a function that compresses data into raw deflate blocks
+    that end on a byte boundary, so that they can be put together into
+    one stream."""
+
+    def compress(data):
+        # type: (bytes) -> bytes
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return compress
+
+
+class _Writer:
+    """Base of the band writers.  Used as a context manager a writer is
+    closed at the end, or aborted if there was an error."""
+
+    def __init__(self,
+                 path,     # type: str
+                 encoder   # type: _Encoder
+                 ):
+        # type: (...) -> None
+        self.path = path        # type: str
+        self.encoder = encoder  # type: _Encoder
+        self.file = open(path, "wb")
+
+    def __enter__(self):
+        # type: () -> _Writer
+        return self
+
+    def __exit__(self, exception_type, value, traceback):
+        if exception_type is None:
+            try:
+                self.close()
+            except BaseException:
+                self.abort()
+                raise
+        else:
+            self.abort()
+        return False
+
+    def abort(self):
+        # type: () -> None
+        """Stops writing and removes the file, also after close."""
+
+        self.encoder.cancel()
+        self.file.close()
+        _remove(self.path)
+
+
+class PngWriter(_Writer):
+    """Writes an 8 bit RGB PNG file band by band.
+
+    Every row is stored as its difference to the row above (the PNG
+    filter "Up").  The bands are compressed as separate blocks of one
+    deflate stream, like pigz does.
+    """
+
+    def __init__(self,
+                 path,        # type: str
+                 width,       # type: int
+                 height,      # type: int
+                 level=6,     # type: int
+                 dpi=DPI,     # type: float
+                 pool=None,   # type: Optional[ThreadPool]
+                 threads=1    # type: int
+                 ):
+        # type: (...) -> None
+        _Writer.__init__(self, path,
+                         _Encoder(_deflate_block(level), pool, threads))
+        self.width = width    # type: int
+        self.height = height  # type: int
+        self.level = level    # type: int
+        self.rows = 0         # type: int
+        self.previous_row = None  # type: Optional[numpy.ndarray]
+        self.checksum = zlib.adler32(b"")  # type: int
+
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height,
+                                         8, 2, 0, 0, 0))
+        pixels_per_meter = int(round(dpi / 0.0254))  # type: int
+        self._chunk(b"pHYs", struct.pack(">IIB", pixels_per_meter,
+                                         pixels_per_meter, 1))
+
+    def _chunk(self,
+               kind,  # type: bytes
+               data   # type: bytes
+               ):
+        # type: (...) -> None
+        """Writes one chunk of the PNG file."""
+
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack(
+            ">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    def _start_stream(self):
+        # type: () -> bytes
+        """Returns the header of the zlib stream in the IDAT chunks."""
+
+        flags = 0 if self.level < 2 else 1 if self.level < 6 else \
+            2 if self.level == 6 else 3  # type: int
+        header = 0x7800 | flags << 6  # type: int
+        return struct.pack(">H", header + 31 - header % 31)
+
+    def write(self, band):
+        # type: (numpy.ndarray) -> None
+        """Writes the next rows, given as an array of shape (rows, width,
+        3)."""
+
+        import numpy
+
+        # Every row starts with the filter type, which is always Up
+        rows = band.reshape(band.shape[0], self.width * 3)
+        above = numpy.empty_like(rows)
+        above[0] = 0 if self.previous_row is None else self.previous_row
+        above[1:] = rows[:-1]
+        filtered = numpy.empty((rows.shape[0], rows.shape[1] + 1),
+                               dtype=numpy.uint8)
+        filtered[:, 0] = 2
+        numpy.subtract(rows, above, out=filtered[:, 1:])
+        self.previous_row = rows[-1].copy()
+
+        data = filtered.tobytes()  # type: bytes
+        self.checksum = zlib.adler32(data, self.checksum)
+        blocks = self.encoder.submit(data)
+        if self.rows == 0:
+            blocks.insert(0, self._start_stream())
+        for block in blocks:
+            self._chunk(b"IDAT", block)
+        self.rows += band.shape[0]
+
+    def close(self):
+        # type: () -> None
+        """Finishes the file."""
+
+        if self.rows != self.height:
+            raise ValueError("Wrote %d of %d rows" % (self.rows, self.height))
+        for block in self.encoder.finish():
+            self._chunk(b"IDAT", block)
+        # An empty final block and the checksum end the zlib stream
+        self._chunk(b"IDAT", b"\x03\x00" + struct.pack(
+            ">I", self.checksum & 0xffffffff))
+        self._chunk(b"IEND", b"")
+        self.file.close()
+
+
+class TiffWriter(_Writer):
+    """Writes an 8 bit RGB or CMYK TIFF file with one strip per band.
+
+    The strips are either uncompressed or compressed with deflate.
+    Compressed strips store each pixel as its difference to the pixel on
+    the left (the TIFF predictor 2).  The bands have three channels for
+    RGB or four for CMYK, which may come with an ICC profile.  An image
+    that may not fit into TIFF_LIMIT bytes is written as BigTIFF with 64
+    bit offsets.
+    """
+
+    def __init__(self,
+                 path,             # type: str
+                 width,            # type: int
+                 height,           # type: int
+                 level=6,          # type: int
+                 dpi=DPI,          # type: float
+                 pool=None,        # type: Optional[ThreadPool]
+                 icc_profile=None,  # type: Optional[bytes]
+                 threads=1         # type: int
+                 ):
+        # type: (...) -> None
+        _Writer.__init__(self, path, _Encoder(
+            lambda data: zlib.compress(data, level) if level > 0 else data,
+            pool, threads))
+        self.width = width    # type: int
+        self.height = height  # type: int
+        self.level = level    # type: int
+        self.dpi = dpi        # type: float
+        self.icc_profile = icc_profile  # type: Optional[bytes]
+        self.channels = 3     # type: int
+        self.rows = 0         # type: int
+        self.rows_per_strip = None  # type: Optional[int]
+        self.strip_offsets = []     # type: List[int]
+        self.strip_byte_counts = []  # type: List[int]
+        # Decide before anything is written.  Deflate may make strips
+        # slightly larger, and there may be four channels.
+        pixels = width * height * 4  # type: int
+        self.big = pixels + pixels // 100 + height * 16 + \
+            len(icc_profile or b"") + 4096 > TIFF_LIMIT  # type: bool
+
+        # The offset of the directory is filled in at the end
+        if self.big:
+            self.file.write(b"II+\x00\x08\x00\x00\x00" + b"\x00" * 8)
+        else:
+            self.file.write(b"II*\x00\x00\x00\x00\x00")
+
+    def write(self, band):
+        # type: (numpy.ndarray) -> None
+        """Writes the next rows, given as an array of shape (rows, width,
+        3) or (rows, width, 4) for CMYK.  All bands but the last must
+        have the same height."""
+
+        if self.rows_per_strip is None:
+            self.rows_per_strip = band.shape[0]
+            self.channels = band.shape[2]
+        elif band.shape[0] > self.rows_per_strip or \
+                self.rows % self.rows_per_strip:
+            raise ValueError("All bands but the last must have %d rows"
+                             % self.rows_per_strip)
+
+        if self.level > 0:
+            import numpy
+
+            differences = numpy.empty_like(band)
+            differences[:, 0] = band[:, 0]
+            numpy.subtract(band[:, 1:], band[:, :-1],
+                           out=differences[:, 1:])
+            band = differences
+        for strip in self.encoder.submit(band.tobytes()):
+            self._write_strip(strip)
+        self.rows += band.shape[0]
+
+    def _write_strip(self, data):
+        # type: (bytes) -> None
+        """Writes one finished strip."""
+
+        self.strip_offsets.append(self.file.tell())
+        self.strip_byte_counts.append(len(data))
+        self.file.write(data)
+
+    def close(self):
+        # type: () -> None
+        """Writes the image file directory and finishes the file."""
+
+        if self.rows != self.height:
+            raise ValueError("Wrote %d of %d rows" % (self.rows, self.height))
+        for strip in self.encoder.finish():
+            self._write_strip(strip)
+
+        def align():
+            # type: () -> int
+            """Moves to the next word boundary and returns the offset."""
+
+            if self.file.tell() % 2:
+                self.file.write(b"\x00")
+            return self.file.tell()
+
+        offset = _LONG8 if self.big else _LONG  # type: int
+        cmyk = self.channels == 4  # type: bool
+        resolution = [int(round(self.dpi * 100)), 100]  # type: List[int]
+        entries = [
+            (256, _LONG, [self.width]),
+            (257, _LONG, [self.height]),
+            (258, _SHORT, [8] * self.channels),
+            (259, _SHORT, [8 if self.level > 0 else 1]),
+            # Separated (CMYK) or RGB
+            (262, _SHORT, [5 if cmyk else 2]),
+            (273, offset, self.strip_offsets),
+            (277, _SHORT, [self.channels]),
+            (278, _LONG, [self.rows_per_strip or self.height]),
+            (279, offset, self.strip_byte_counts),
+            (282, _RATIONAL, resolution),
+            (283, _RATIONAL, resolution),
+            (284, _SHORT, [1]),
+            (296, _SHORT, [2]),
+        ]  # type: List[Tuple[int, int, Any]]
+        if self.level > 0:
+            entries.append((317, _SHORT, [2]))
+        if cmyk:
+            # The inks are cyan, magenta, yellow, and black
+            entries.append((332, _SHORT, [1]))
+        if self.icc_profile:
+            entries.append((34675, _UNDEFINED, self.icc_profile))
+
+        # Values that do not fit into the directory entries themselves
+        # are written before the directory, the same values only once
+        size = 8 if self.big else 4  # type: int
+        fields = []  # type: List[Tuple[int, int, int, bytes]]
+        positions = {}  # type: Dict[bytes, int]
+        for tag, kind, values in entries:
+            if kind == _UNDEFINED:
+                data = bytes(values)  # type: bytes
+            else:
+                data = struct.pack("<%d%s" % (len(values),
+                                              _TIFF_FORMATS[kind]), *values)
+            number = len(values) // 2 if kind == _RATIONAL \
+                else len(values)  # type: int
+            if len(data) > size:
+                if data not in positions:
+                    positions[data] = align()
+                    self.file.write(data)
+                data = struct.pack("<Q" if self.big else "<I",
+                                   positions[data])
+            fields.append((tag, kind, number, data.ljust(size, b"\x00")))
+
+        directory_offset = align()  # type: int
+        if self.big:
+            self.file.write(struct.pack("<Q", len(fields)))
+        else:
+            self.file.write(struct.pack("<H", len(fields)))
+        for tag, kind, number, data in fields:
+            self.file.write(struct.pack("<HHQ" if self.big else "<HHI",
+                                        tag, kind, number) + data)
+        self.file.write(b"\x00" * size)
+
+        self.file.seek(8 if self.big else 4)
+        self.file.write(struct.pack("<Q" if self.big else "<I",
+                                    directory_offset))
+        self.file.close()
+
+
+def open_writer(path,             # type: str
+                width,            # type: int
+                height,           # type: int
+                level=6,          # type: int
+                dpi=DPI,          # type: float
+                pool=None,        # type: Optional[ThreadPool]
+                icc_profile=None,  # type: Optional[bytes]
+                threads=1         # type: int
+                ):
+    # type: (...) -> Union[PngWriter, TiffWriter]
+    """Returns a band writer for a PNG or TIFF file depending on the file
+    name.  Only TIFF files take CMYK bands and an ICC profile.  threads
+    is the size of the pool."""
+
+    if path.lower().endswith((".tif", ".tiff")):
+        return TiffWriter(path, width, height, level, dpi, pool,
+                          icc_profile, threads)
+    if path.lower().endswith(".png"):
+        return PngWriter(path, width, height, level, dpi, pool, threads)
+    raise ValueError("Cannot write %s, only PNG and TIFF are supported"
+                     % path)
+
+
+def open_pool(threads):
+    # type: (Optional[int]) -> Optional[ThreadPool]
+    """Returns a pool of threads for compressing bands, or None if one
+    thread is enough.  None as the number of threads means one per
+    core."""
+
+    if threads == 1:
+        return None
+    return ThreadPool(pool_size(threads))
+
+
+def pool_size(threads):
+    # type: (Optional[int]) -> int
+    """Returns the number of threads of the pool that open_pool returns
+    for a number of threads."""
+
+    return threads or multiprocessing.cpu_count()
+
+
+def write_images(paths,          # type: List[str]
+                 images,         # type: List[numpy.ndarray]
+                 level=6,        # type: int
+                 dpi=DPI,        # type: float
+                 threads=1,      # type: Optional[int]
+                 convert=None    # type: Optional[CmykConverter]
+                 ):
+    # type: (...) -> None
+    """Writes several RGB images at the same time, e.g. the top and the
+    bottom wrap.  Their bands are compressed on a shared pool of
+    threads.  With a converter the bands are converted to CMYK before
+    they are written.  If anything fails, none of the files are left."""
+
+    pool = open_pool(threads)
+    outputs = []  # type: List[Union[PngWriter, TiffWriter]]
+    try:
+        for path, image in zip(paths, images):
+            outputs.append(open_writer(
+                path, image.shape[1], image.shape[0], level, dpi, pool,
+                convert and convert.profile, pool_size(threads)))
+        height = max(image.shape[0] for image in images)  # type: int
+        for y in range(0, height, ROWS_PER_BAND):
+            # Take turns so that all images are compressed together
+            for writer, image in zip(outputs, images):
+                if y < image.shape[0]:
+                    band = image[y:y + ROWS_PER_BAND]
+                    writer.write(convert(band) if convert else band)
+        for writer in outputs:
+            writer.close()
+    except BaseException:
+        for writer in outputs:
+            writer.abort()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
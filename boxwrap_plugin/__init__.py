@@ -0,0 +1,11 @@
+"""The GIMP plugin for the printable box wraps.
+
+boxwrap.py only registers the procedures.  Their code is in procedures,
+which is imported with the engine the first time one of them is run.
+Keep this module free of imports, boxwrap.py reads it at every start of
+GIMP.
+"""
+
+
+# File formats for saving wraps without showing them
+EXPORT_FORMATS = ("png", "tif")  # type: Tuple[str, ...]
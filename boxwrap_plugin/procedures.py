@@ -0,0 +1,1214 @@
+"""The procedures of the GIMP plugin.
+
+GIMP runs boxwrap.py at every start to register the procedures, so this
+module and the engine are only imported when one of them is run.
+"""
+
+import functools
+import json
+import os
+import shlex
+import time
+
+from gimpfu import gimp, pdb
+import gimpfu
+
+from boxwrap_engine.layout import DPI, Corner, TemplateSizeError, \
+    WrapLayout, clip_rectangle, mm_to_px, place_rectangle, rotated_size, \
+    template_coordinates
+from boxwrap_engine import cache, incremental, instrument, marks, pdf, \
+    plan
+from boxwrap_plugin import EXPORT_FORMATS
+
+try:
+    import numpy
+    from boxwrap_engine import bleed, render, stream
+except ImportError:
+    # NumPy is not part of every GIMP installation.  Without it the wraps
+    # are created through the PDB instead.
+    render = None
+
+
+# Name of the parasite that connects a wrap image to its template
+STATE_PARASITE = "boxwrap-state"  # type: str
+
+# Folder of the cache for finished wraps in the GIMP profile
+CACHE_FOLDER = "boxwrap-cache"  # type: str
+
+# Environment variable with the size limit of the cache in MB.  The
+# cache is off unless it is set to more than 0.
+CACHE_VARIABLE = "BOXWRAP_CACHE"  # type: str
+
+# File in the GIMP profile for the profiling report if BOXWRAP_PROFILE
+# is 1
+PROFILE_FILE = "boxwrap-profile.json"  # type: str
+
+# Measures the stages of the procedure that is running, see profiled
+profiler = instrument.NULL
+
+# Seconds between looking for new jobs at the end of a followed queue
+QUEUE_POLL_INTERVAL = 0.5  # type: float
+
+
+class PausedUndo:
+    """Context guard that temporarily disables the undo history."""
+
+    def __init__(self, image):
+        # type: (gimp.Image) -> None
+        self.image = image
+
+    def __enter__(self):
+        # type: () -> None
+        self.image.disable_undo()
+
+    def __exit__(self, exception_type, value, traceback):
+        self.image.enable_undo()
+        return False
+
+
+class DefaultContext:
+    """Context guard that restores the current gimp context at the end."""
+
+    def __enter__(self):
+        # type: () -> None
+        gimp.context_push()
+        pdb.gimp_context_set_defaults()
+
+    def __exit__(self, exception_type, value, traceback):
+        gimp.context_pop()
+        return False
+
+
+def profiled(procedure):
+    # type: (Callable[..., None]) -> Callable[..., None]
+    """Runs a procedure with a profiler if profiling is turned on, and
+    then shows the report in the error console and writes it to a
+    file."""
+
+    @functools.wraps(procedure)
+    def run(*args):
+        global profiler
+        profiler = instrument.start(
+            procedure.__name__, os.path.join(gimp.directory, PROFILE_FILE))
+        try:
+            procedure(*args)
+        finally:
+            if profiler.enabled:
+                profiler.finish()
+                gimp.message(profiler.report())
+                try:
+                    profiler.write()
+                except (IOError, OSError) as error:
+                    gimp.message("Cannot write the profile: %s" % error)
+            profiler = instrument.NULL
+    return run
+
+
+def copy_stage(copy):
+    # type: (Copy) -> str
+    """Returns the name of the profiling stage of a copy.  The flaps are
+    merged with the faces in the plan, so copies are told apart by their
+    source and rotation."""
+
+    return "copy from %s, %d degrees" % (copy.source, copy.angle)
+
+
+def move_drawable_to(drawable,  # type: gimp.Image
+                     corner,    # type: Corner
+                     x,         # type: int
+                     y          # type: int
+                     ):
+    # type: (...) -> None
+    """Moves a corner of a drawable to the position (x, y)."""
+
+    left, top = pdb.gimp_drawable_offsets(drawable)              # type: int, int
+    width, height = pdb.gimp_drawable_mask_bounds(drawable)[3:]  # type: int, int
+    right = left + width                                         # type: int
+    bottom = top + height                                        # type: int
+    dx, dy = 0, 0                                                # type: int
+    if corner == Corner.TOP_LEFT:
+        dx = x - left
+        dy = y - top
+    elif corner == Corner.TOP_RIGHT:
+        dx = x - right
+        dy = y - top
+    elif corner == Corner.BOTTOM_LEFT:
+        dx = x - left
+        dy = y - bottom
+    elif corner == Corner.BOTTOM_RIGHT:
+        dx = x - right
+        dy = y - bottom
+    elif corner == Corner.CENTER:
+        dx = x - (left + right) // 2
+        dy = y - (top + bottom) // 2
+    else:
+        gimp.message("Invalid corner %s" % repr(corner))
+        return
+    pdb.gimp_layer_translate(drawable, dx, dy)
+
+
+def rotate_pixels(data,    # type: bytes
+                  width,   # type: int
+                  height,  # type: int
+                  bpp,     # type: int
+                  angle    # type: int
+                  ):
+    # type: (...) -> bytes
+    """Rotates the raw pixels of a pixel region clockwise by a multiple of
+    90 degrees.
+
+    This only uses slicing of byte strings, so it does not need NumPy.
+    """
+
+    if angle not in (90, 180, 270):
+        return data
+
+    rotated = bytearray(len(data))  # type: bytearray
+    if angle == 180:
+        for k in range(bpp):  # type: int
+            rotated[k::bpp] = data[k::bpp][::-1]
+        return bytes(rotated)
+
+    # Each column of the source becomes a row of the result
+    stride = width * bpp      # type: int
+    row_size = height * bpp   # type: int
+    for row in range(width):  # type: int
+        column = row if angle == 90 else width - 1 - row  # type: int
+        start = row * row_size  # type: int
+        for k in range(bpp):
+            pixels = data[column * bpp + k::stride]  # type: bytes
+            if angle == 90:
+                pixels = pixels[::-1]
+            rotated[start + k:start + row_size:bpp] = pixels
+    return bytes(rotated)
+
+
+def flatten_copy(image):
+    # type: (gimp.Image) -> Tuple[gimp.Image, gimp.Layer]
+    """Creates a copy of an image with all visible layers composited onto
+    the background color.
+
+    The caller must delete the copy with gimp_image_delete.
+    """
+
+    duplicate = pdb.gimp_image_duplicate(image)  # type: gimp.Image
+    layer = pdb.gimp_image_flatten(duplicate)    # type: gimp.Layer
+    return duplicate, layer
+
+
+def copy_and_rotate_rectangle(src_layer,   # type: gimp.Layer
+                              src_x,       # type: int
+                              src_y,       # type: int
+                              src_width,   # type: int
+                              src_height,  # type: int
+                              dst_layer,   # type: gimp.Layer
+                              dst_x,       # type: int
+                              dst_y,       # type: int
+                              dst_corner,  # type: Corner
+                              angle,       # type: int
+                              undo=False   # type: bool
+                              ):
+    # type: (...) -> None
+    """Copies a rectangular region from one layer to another while also
+    rotating it.  With undo the copy is an undo step of the image of the
+    destination layer, see write_pixels.
+
+    The pixels are moved through pixel regions, so neither the clipboard
+    nor a floating selection is involved.  Both layers must have the
+    same number of bytes per pixel.
+    """
+
+    src_x, src_y, src_width, src_height = clip_rectangle(
+        src_x, src_y, src_width, src_height,
+        src_layer.width, src_layer.height)
+    if src_width == 0 or src_height == 0:
+        return
+
+    src_region = src_layer.get_pixel_rgn(
+        src_x, src_y, src_width, src_height, False, False)
+    data = rotate_pixels(
+        src_region[src_x:src_x + src_width, src_y:src_y + src_height],
+        src_width, src_height, src_region.bpp, angle)  # type: bytes
+
+    # Move the rotated region into position and clip it to the layer
+    width, height = rotated_size(src_width, src_height, angle)
+    left, top = place_rectangle(width, height, dst_corner, dst_x, dst_y)
+    x, y, w, h = clip_rectangle(left, top, width, height,
+                                dst_layer.width, dst_layer.height)
+    if w == 0 or h == 0:
+        return
+    if (w, h) != (width, height):
+        bpp = src_region.bpp  # type: int
+        data = b"".join(
+            data[((row - top) * width + x - left) * bpp:
+                 ((row - top) * width + x - left + w) * bpp]
+            for row in range(y, y + h))
+
+    write_pixels(dst_layer, x, y, w, h, data, undo)
+
+
+def write_pixels(layer,      # type: gimp.Layer
+                 x,          # type: int
+                 y,          # type: int
+                 width,      # type: int
+                 height,     # type: int
+                 data,       # type: bytes
+                 undo=False  # type: bool
+                 ):
+    # type: (...) -> None
+    """Writes the pixels of a rectangle of a layer.
+
+    With undo they go through the shadow tiles, which GIMP merges into
+    the layer as an undo step.  The shadow tiles only hold what was
+    written, so the rectangle is selected while they are merged and the
+    previous selection is restored afterwards.
+    """
+
+    region = layer.get_pixel_rgn(x, y, width, height,
+                                 True, undo)  # type: gimp.PixelRgn
+    region[x:x + width, y:y + height] = data
+    layer.flush()
+    if undo:
+        image = layer.image  # type: gimp.Image
+        selection = pdb.gimp_selection_save(image)  # type: gimp.Channel
+        pdb.gimp_image_select_rectangle(image, gimpfu.CHANNEL_OP_REPLACE,
+                                        x, y, width, height)
+        layer.merge_shadow(True)
+        pdb.gimp_image_select_item(image, gimpfu.CHANNEL_OP_REPLACE,
+                                   selection)
+        pdb.gimp_image_remove_channel(image, selection)
+    layer.update(x, y, width, height)
+
+
+def add_marks_path(image,   # type: gimp.Image
+                   layout   # type: WrapLayout
+                   ):
+    # type: (...) -> gimp.Vectors
+    """Adds a path named "Crop marks" with the outlines of all marks where
+    one must cut or fold the paper.
+
+    The path stays in the image, so the marks can also be exported as
+    vector graphics.
+    """
+
+    rectangles = marks.mark_rectangles(layout)
+    with profiler.stage("marks path", sum(w * h for _, _, w, h
+                                          in rectangles)):
+        vectors = pdb.gimp_vectors_new(image,
+                                       "Crop marks")  # type: gimp.Vectors
+        pdb.gimp_image_insert_vectors(image, vectors, None, 0)
+        for rectangle in rectangles:
+            points = marks.rectangle_points(*rectangle)  # type: List[float]
+            pdb.gimp_vectors_stroke_new_from_points(
+                vectors, gimpfu.VECTORS_STROKE_TYPE_BEZIER,
+                len(points), points, gimpfu.TRUE)
+    return vectors
+
+
+def fill_path(image,    # type: gimp.Image
+              layer,    # type: gimp.Layer
+              vectors   # type: gimp.Vectors
+              ):
+    # type: (...) -> None
+    """Fills the inside of a path with the foreground color."""
+
+    with profiler.stage("fill marks"):
+        pdb.gimp_context_set_antialias(gimpfu.FALSE)
+        pdb.gimp_image_select_item(image, gimpfu.CHANNEL_OP_REPLACE,
+                                   vectors)
+        pdb.gimp_edit_fill(layer, gimpfu.FOREGROUND_FILL)
+        pdb.gimp_selection_none(image)
+
+
+def new_template(box_width_mm,   # type: float
+                 box_height_mm,  # type: float
+                 box_depth_mm,   # type: float
+                 resolution=DPI  # type: float
+                 ):
+    # type: (...) -> gimp.Image
+    """Creates an empty template image given the box size without showing
+    it."""
+
+    with DefaultContext():
+        box_width = mm_to_px(box_width_mm, resolution)    # type: int
+        box_height = mm_to_px(box_height_mm, resolution)  # type: int
+        box_depth = mm_to_px(box_depth_mm, resolution)    # type: int
+
+        xs, ys = template_coordinates(box_width, box_height, box_depth)
+        image_width = xs[-1] - xs[0]   # type: int
+        image_height = ys[-1] - ys[0]  # type: int
+
+        # Create a template image with one transparent layer
+        image = gimp.Image(image_width, image_height)  # type: gimp.Image
+        pdb.gimp_image_set_resolution(image, resolution, resolution)
+
+        with PausedUndo(image):
+            layer = gimp.Layer(image,
+                               "Template",
+                               image_width,
+                               image_height,
+                               gimpfu.RGBA_IMAGE,
+                               100,
+                               gimpfu.NORMAL_MODE)  # type: gimp.Layer
+            image.add_layer(layer, 0)
+
+            # Create guides
+            with profiler.stage("guides"):
+                for x in xs:        # type: int
+                    image.add_vguide(x)
+                for y in ys:        # type: int
+                    image.add_hguide(y)
+
+            # Fill the areas where the graphics go with white
+            pdb.gimp_selection_none(image)
+            pdb.gimp_progress_pulse()
+            pdb.gimp_image_select_rectangle(image, gimpfu.CHANNEL_OP_ADD,
+                                            xs[0], ys[1],
+                                            image_width, ys[3]-ys[1])
+            pdb.gimp_progress_pulse()
+            pdb.gimp_image_select_rectangle(image, gimpfu.CHANNEL_OP_ADD,
+                                            xs[1], ys[0],
+                                            xs[2]-xs[1], image_height)
+            pdb.gimp_edit_fill(layer, gimpfu.WHITE_FILL)
+            pdb.gimp_selection_none(image)
+
+            def put_text(text, left, right, top, bottom):
+                """Puts some text in the center of a rectangle."""
+
+                pdb.gimp_progress_pulse()
+                with profiler.stage("text"):
+                    text_size = resolution / 4  # type: int
+                    text_layer = pdb.gimp_text_layer_new(
+                        image, text, "sans-serif", text_size,
+                        gimpfu.PIXELS)  # type: gimp.Layer
+                    image.add_layer(text_layer, 0)
+                    move_drawable_to(text_layer, Corner.CENTER,
+                                     (left + right) // 2,
+                                     (top + bottom) // 2)
+                    pdb.gimp_image_merge_down(image, text_layer,
+                                              gimpfu.CLIP_TO_BOTTOM_LAYER)
+
+            put_text("TOP", xs[1], xs[2], ys[0], ys[1])
+            put_text("LEFT", xs[0], xs[1], ys[1], ys[3])
+            put_text("FRONT", xs[1], xs[2], ys[1], ys[3])
+            put_text("RIGHT", xs[2], xs[3], ys[1], ys[3])
+            put_text("BACK", xs[3], xs[4], ys[1], ys[3])
+            put_text("BOTTOM", xs[1], xs[2], ys[3], ys[4])
+            put_text("Box width: %dmm (%dpx)\n"
+                     "Box height: %dmm (%dpx)\n"
+                     "Box depth: %dmm (%dpx)" %
+                     (box_width_mm, box_width,
+                      box_height_mm, box_height,
+                      box_depth_mm, box_depth),
+                     xs[0], xs[1], ys[0], ys[1])
+    return image
+
+
+def create_template(box_width_mm,   # type: float
+                    box_height_mm,  # type: float
+                    box_depth_mm,   # type: float
+                    resolution=DPI  # type: float
+                    ):
+    # type: (...) -> None
+    """Creates an empty template image given the box size."""
+
+    gimp.Display(new_template(box_width_mm, box_height_mm, box_depth_mm,
+                              resolution))
+    gimp.displays_flush()
+
+
+def read_pixels(layer):
+    # type: (gimp.Layer) -> numpy.ndarray
+    """Returns the pixels of a layer as an array of shape (height, width,
+    channels)."""
+
+    region = layer.get_pixel_rgn(0, 0, layer.width, layer.height,
+                                 False, False)   # type: gimp.PixelRgn
+    pixels = numpy.frombuffer(region[0:layer.width, 0:layer.height],
+                              dtype=numpy.uint8)
+    return pixels.reshape(layer.height, layer.width, region.bpp)
+
+
+def create_overlay(layout,     # type: WrapLayout
+                   fill_marks  # type: bool
+                   ):
+    # type: (...) -> gimp.Image
+    """Creates an image with everything that the top and the bottom wrap
+    have in common: the white background, the guides, and the marks for
+    cutting and folding.  The marks are only filled if fill_marks is set,
+    otherwise they are just a path.
+
+    The caller must delete the image with gimp_image_delete.
+    """
+
+    image = gimp.Image(layout.dst_width, layout.dst_height,
+                       gimpfu.RGB)  # type: gimp.Image
+    pdb.gimp_image_set_resolution(image, layout.dpi, layout.dpi)
+    with PausedUndo(image):
+        layer = gimp.Layer(image, "Wrap", layout.dst_width,
+                           layout.dst_height, gimpfu.RGB_IMAGE,
+                           100, gimpfu.NORMAL_MODE)  # type: gimp.Layer
+        with profiler.stage("background", layout.dst_width *
+                            layout.dst_height):
+            layer.fill(gimpfu.WHITE_FILL)
+            image.add_layer(layer, 0)
+
+        # Add guides
+        with profiler.stage("guides"):
+            for x in layout.dst_xs:  # type: int
+                image.add_vguide(x)
+            for y in layout.dst_ys:  # type: int
+                image.add_hguide(y)
+
+        # Marks for cutting and folding
+        vectors = add_marks_path(image, layout)  # type: gimp.Vectors
+        if fill_marks:
+            fill_path(image, layer, vectors)
+    return image
+
+
+def display_wrap(overlay,  # type: gimp.Image
+                 data      # type: bytes
+                 ):
+    # type: (...) -> gimp.Image
+    """Shows a finished wrap, given as raw RGB pixels, as a copy of the
+    overlay."""
+
+    with profiler.stage("display", overlay.width * overlay.height):
+        image = pdb.gimp_image_duplicate(overlay)  # type: gimp.Image
+        with PausedUndo(image):
+            layer = image.layers[0]  # type: gimp.Layer
+            region = layer.get_pixel_rgn(
+                0, 0, layer.width, layer.height,
+                True, False)  # type: gimp.PixelRgn
+            region[0:layer.width, 0:layer.height] = data
+            layer.flush()
+            layer.update(0, 0, layer.width, layer.height)
+            gimp.Display(image)
+    return image
+
+
+def draw_wraps(src_layer,     # type: gimp.Layer
+               layout,        # type: WrapLayout
+               template=None  # type: Optional[numpy.ndarray]
+               ):
+    # type: (...) -> List[gimp.Image]
+    """Creates and shows both wrap images from a flattened template.  The
+    engine reads its pixels unless they are given as template."""
+
+    images = []  # type: List[gimp.Image]
+    if render is not None:
+        # Both wraps start as a copy of the same overlay.  The engine
+        # already draws the marks.
+        overlay = create_overlay(layout, False)  # type: gimp.Image
+        pdb.gimp_progress_pulse()
+        if template is None:
+            with profiler.stage("read template",
+                                src_layer.width * src_layer.height):
+                template = read_pixels(src_layer)
+        with profiler.stage("render_wraps",
+                            2 * layout.dst_width * layout.dst_height):
+            wraps = render.render_wraps(template, layout)
+        for pixels in wraps:  # type: numpy.ndarray
+            pdb.gimp_progress_pulse()
+            images.append(display_wrap(overlay, pixels.tobytes()))
+        pdb.gimp_image_delete(overlay)
+        return images
+
+    plans = plan.compile_plans(layout)  # type: Tuple[List[Copy], ...]
+    marks_last = any(marks.drawn_last(layout, operations)
+                     for operations in plans)  # type: bool
+
+    # Both wraps start as a copy of the same overlay
+    overlay = create_overlay(layout, not marks_last)  # type: gimp.Image
+
+    for operations in plans:
+        dst_image = pdb.gimp_image_duplicate(overlay)  # type: gimp.Image
+        with PausedUndo(dst_image):
+            draw_wrap(src_layer, dst_image, operations, marks_last)
+            with profiler.stage("display",
+                                layout.dst_width * layout.dst_height):
+                gimp.Display(dst_image)
+        images.append(dst_image)
+
+    pdb.gimp_image_delete(overlay)
+    return images
+
+
+def draw_wrap(src_layer,   # type: gimp.Layer
+              dst_image,   # type: gimp.Image
+              operations,  # type: List[Copy]
+              marks_last   # type: bool
+              ):
+    # type: (...) -> None
+    """Draws one wrap through the PDB onto a copy of the overlay."""
+
+    dst_layer = dst_image.layers[0]  # type: gimp.Layer
+
+    # Move and rotate the faces and the flaps into position
+    for copy in operations:
+        pdb.gimp_progress_pulse()
+        with profiler.stage(copy_stage(copy),
+                            copy.src_width * copy.src_height):
+            copy_and_rotate_rectangle(
+                src_layer if copy.source == plan.TEMPLATE else dst_layer,
+                copy.src_x, copy.src_y,
+                copy.src_width, copy.src_height,
+                dst_layer, copy.dst_x, copy.dst_y,
+                Corner.TOP_LEFT, copy.angle)
+
+    if marks_last:
+        fill_path(dst_image, dst_layer, dst_image.vectors[0])
+
+
+def render_wrap_bands(template,    # type: numpy.ndarray
+                      layout,      # type: WrapLayout
+                      operations,  # type: List[Copy]
+                      layer        # type: gimp.Layer
+                      ):
+    # type: (...) -> None
+    """Renders one wrap with the engine into a layer, a band at a time,
+    so that the wrap is never in memory twice."""
+
+    marks_last = marks.drawn_last(layout, operations)  # type: bool
+    fills = bleed.bleed_fills(layout, operations)  # type: List[Fill]
+    region = layer.get_pixel_rgn(0, 0, layer.width, layer.height,
+                                 True, False)  # type: gimp.PixelRgn
+    for y in range(0, layout.dst_height, stream.BAND_HEIGHT):
+        pdb.gimp_progress_pulse()
+        rows = min(stream.BAND_HEIGHT, layout.dst_height - y)  # type: int
+        region[0:layout.dst_width, y:y + rows] = stream.render_region(
+            template, layout, operations, not marks_last, marks_last,
+            0, y, layout.dst_width, rows, fills).tobytes()
+    layer.flush()
+
+
+def region_reader(layer):
+    # type: (gimp.Layer) -> Callable[[int, int, int, int], bytes]
+    """Returns a function that reads a rectangle of a layer as bytes."""
+
+    region = layer.get_pixel_rgn(0, 0, layer.width, layer.height,
+                                 False, False)  # type: gimp.PixelRgn
+
+    def read(x, y, width, height):
+        # type: (int, int, int, int) -> bytes
+        if width == 0 or height == 0:
+            return b""
+        return region[x:x + width, y:y + height]
+    return read
+
+
+def pixel_reader(pixels):
+    # type: (numpy.ndarray) -> Callable[[int, int, int, int], bytes]
+    """Returns a function that reads a rectangle of pixels that were read
+    already as bytes, like region_reader."""
+
+    def read(x, y, width, height):
+        # type: (int, int, int, int) -> bytes
+        return numpy.ascontiguousarray(
+            pixels[y:y + height, x:x + width]).tobytes()
+    return read
+
+
+def find_wraps(template_id):
+    # type: (int) -> Dict[str, Tuple[gimp.Image, Dict[str, Any]]]
+    """Returns the open wrap images that were created from a template
+    image together with their states, by the names "top" and "bottom"."""
+
+    wraps = {}  # type: Dict[str, Tuple[gimp.Image, Dict[str, Any]]]
+    for image in gimp.image_list():  # type: gimp.Image
+        parasite = image.parasite_find(STATE_PARASITE)
+        if parasite is None:
+            continue
+        state = incremental.load_state(parasite.data)
+        if state is not None and state.get("template") == template_id:
+            wraps[state.get("wrap")] = (image, state)
+    return wraps
+
+
+def attach_state(images,     # type: List[gimp.Image]
+                 src_image,  # type: gimp.Image
+                 layout,     # type: WrapLayout
+                 hashes      # type: Dict[str, str]
+                 ):
+    # type: (...) -> None
+    """Remembers in the top and the bottom wrap image which template and
+    which content of its faces they show."""
+
+    for image, name in zip(images, ("top", "bottom")):
+        state = incremental.make_state(layout, hashes)
+        state["template"] = src_image.ID
+        state["wrap"] = name
+        image.attach_new_parasite(STATE_PARASITE, 0,
+                                  incremental.dump_state(state))
+
+
+def open_cache():
+    # type: () -> Optional[cache.WrapCache]
+    """Returns the cache for finished wraps in the GIMP profile, or None
+    if it is turned off."""
+
+    try:
+        size = float(os.environ.get(CACHE_VARIABLE) or 0)  # type: float
+    except ValueError:
+        gimp.message("%s must be a size in MB" % CACHE_VARIABLE)
+        return None
+    if size <= 0:
+        return None
+    try:
+        return cache.WrapCache(os.path.join(gimp.directory, CACHE_FOLDER),
+                               int(size * 1024 * 1024))
+    except (IOError, OSError) as error:
+        gimp.message("Cannot open the cache: %s" % error)
+        return None
+
+
+def cached_wraps(wrap_cache,  # type: cache.WrapCache
+                 key,         # type: str
+                 layout       # type: WrapLayout
+                 ):
+    # type: (...) -> Optional[List[gimp.Image]]
+    """Shows both wraps from the cache.  Returns None if they are not in
+    the cache."""
+
+    data = wrap_cache.get(key)  # type: Optional[List[memoryview]]
+    if data is None:
+        return None
+    overlay = create_overlay(layout, False)  # type: gimp.Image
+    # Pixel regions only take byte strings, one wrap is copied at a time
+    images = [display_wrap(overlay, pixels.tobytes())
+              for pixels in data]  # type: List[gimp.Image]
+    pdb.gimp_image_delete(overlay)
+    return images
+
+
+def update_wraps(src_image,     # type: gimp.Image
+                 wraps,         # type: Dict[str, Tuple[gimp.Image, Any]]
+                 src_layer,     # type: gimp.Layer
+                 layout,        # type: WrapLayout
+                 hashes,        # type: Dict[str, str]
+                 template=None  # type: Optional[numpy.ndarray]
+                 ):
+    # type: (...) -> bool
+    """Draws the parts of the open wraps of a template, as found by
+    find_wraps, again that depend on faces that changed since the wraps
+    were created.  template holds the pixels of src_layer if the engine
+    read them already.
+
+    Returns False if there are no wraps that can be updated, so they
+    have to be created from scratch.
+    """
+
+    if "top" not in wraps or "bottom" not in wraps:
+        return False
+    images = [wraps["top"][0], wraps["bottom"][0]]  # type: List[gimp.Image]
+    changed = incremental.changed_regions(layout, wraps["top"][1], hashes)
+    if changed is None or \
+       wraps["top"][1]["regions"] != wraps["bottom"][1]["regions"]:
+        return False
+
+    layers = [pdb.gimp_image_get_layer_by_name(image, "Wrap")
+              for image in images]  # type: List[gimp.Layer]
+    if any(layer is None or layer.width != layout.dst_width or
+           layer.height != layout.dst_height for layer in layers):
+        return False
+
+    plans = plan.compile_plans(layout)  # type: Tuple[List[Copy], ...]
+    dirty = [incremental.dirty_operations(operations, changed)
+             for operations in plans]  # type: List[List[int]]
+    if render is None and any(operations[index].source == plan.WRAP
+                              for operations, indices in zip(plans, dirty)
+                              for index in indices):
+        # Copying the flaps again would read the old wrap
+        return False
+
+    marks_last = any(marks.drawn_last(layout, operations)
+                     for operations in plans)  # type: bool
+    if template is None and render is not None:
+        template = read_pixels(src_layer)
+    for image, layer, operations, indices in zip(images, layers, plans,
+                                                 dirty):
+        if not indices:
+            continue
+        plan_marks_last = marks.drawn_last(layout, operations)  # type: bool
+        fills = None  # type: Optional[List[Fill]]
+        pdb.gimp_image_undo_group_start(image)
+        for index in indices:  # type: int
+            copy = operations[index]  # type: Copy
+            pdb.gimp_progress_pulse()
+            if template is None:
+                with profiler.stage(copy_stage(copy),
+                                    copy.src_width * copy.src_height):
+                    copy_and_rotate_rectangle(
+                        src_layer, copy.src_x, copy.src_y,
+                        copy.src_width, copy.src_height,
+                        layer, copy.dst_x, copy.dst_y,
+                        Corner.TOP_LEFT, copy.angle, undo=True)
+                continue
+            if fills is None:
+                fills = bleed.bleed_fills(layout, operations)
+            x, y, width, height = plan.destination_rectangle(copy)
+            with profiler.stage("render_region", width * height):
+                pixels = stream.render_region(
+                    template, layout, operations, not plan_marks_last,
+                    plan_marks_last, x, y, width, height,
+                    fills)  # type: numpy.ndarray
+                write_pixels(layer, x, y, width, height, pixels.tobytes(),
+                             undo=True)
+        if template is None and marks_last:
+            fill_path(image, layer,
+                      pdb.gimp_image_get_vectors_by_name(image,
+                                                         "Crop marks"))
+        pdb.gimp_image_undo_group_end(image)
+
+    attach_state(images, src_image, layout, hashes)
+    return True
+
+
+def create_wraps(src_image,             # type: gimp.Image
+                 box_width_mm,          # type: float
+                 box_height_mm,         # type: float
+                 box_depth_mm,          # type: float
+                 thickness_mm,          # type: float
+                 flap_size_mm,          # type: float
+                 inside_size_mm,        # type: float
+                 crop_mark_size_mm,     # type: float
+                 crop_mark_distance_mm,  # type: float
+                 resolution=DPI         # type: float
+                 ):
+    # type: (...) -> None
+    """Creates two wrap images from a template image."""
+
+    # Convert the dimensions from mm to px
+    layout = WrapLayout.from_mm(
+        box_width_mm, box_height_mm, box_depth_mm,
+        thickness_mm, flap_size_mm, inside_size_mm,
+        crop_mark_size_mm, crop_mark_distance_mm,
+        resolution)  # type: WrapLayout
+
+    # Make sure we have the right dimensions
+    with profiler.stage("validate template"):
+        try:
+            layout.check_template_size(src_image.width, src_image.height)
+        except TemplateSizeError as error:
+            gimp.message(str(error))
+            return
+
+    # Only wraps of this template that are still open can be updated
+    wraps = find_wraps(src_image.ID)
+    with DefaultContext():
+        # Composite the template only once for both wraps
+        with profiler.stage("flatten template",
+                            src_image.width * src_image.height):
+            flat_image, src_layer = flatten_copy(src_image)
+        template = None  # type: Optional[numpy.ndarray]
+        if render is not None:
+            # Read the pixels once for the hashes, the cache, and the
+            # engine
+            with profiler.stage("read template",
+                                src_layer.width * src_layer.height):
+                template = read_pixels(src_layer)
+            read = pixel_reader(template)
+        else:
+            read = region_reader(src_layer)
+
+        def hash_regions():
+            # type: () -> Dict[str, str]
+            with profiler.stage("hash regions",
+                                src_image.width * src_image.height):
+                return incremental.hash_regions(layout, read)
+
+        hashes = None  # type: Optional[Dict[str, str]]
+        updated = False  # type: bool
+        if "top" in wraps and "bottom" in wraps:
+            hashes = hash_regions()
+            with profiler.stage("update wraps"):
+                updated = update_wraps(src_image, wraps, src_layer,
+                                       layout, hashes, template)
+        if not updated:
+            wrap_cache = open_cache()  # type: Optional[cache.WrapCache]
+            images = None  # type: Optional[List[gimp.Image]]
+            if wrap_cache is not None:
+                # The same template may have been rendered before
+                with profiler.stage("cache lookup"):
+                    key = cache.wrap_key(
+                        read(0, 0, src_layer.width, src_layer.height),
+                        layout)  # type: str
+                    images = cached_wraps(wrap_cache, key, layout)
+            if images is None:
+                images = draw_wraps(src_layer, layout, template)
+                if wrap_cache is not None:
+                    with profiler.stage("cache store",
+                                        2 * layout.dst_width *
+                                        layout.dst_height):
+                        try:
+                            wrap_cache.put(key, [
+                                region_reader(image.layers[0])(
+                                    0, 0, layout.dst_width,
+                                    layout.dst_height)
+                                for image in images])
+                        except (IOError, OSError):
+                            # The cache only saves time, the wraps are
+                            # still fine
+                            pass
+            # The new wraps remember the faces, so that they can be
+            # updated later
+            attach_state(images, src_image, layout,
+                         hashes or hash_regions())
+        pdb.gimp_image_delete(flat_image)
+    gimp.displays_flush()
+
+
+def export_wraps(src_image,             # type: gimp.Image
+                 box_width_mm,          # type: float
+                 box_height_mm,         # type: float
+                 box_depth_mm,          # type: float
+                 thickness_mm,          # type: float
+                 flap_size_mm,          # type: float
+                 inside_size_mm,        # type: float
+                 crop_mark_size_mm,     # type: float
+                 crop_mark_distance_mm,  # type: float
+                 resolution,            # type: float
+                 directory,             # type: str
+                 file_type,             # type: int
+                 release_template       # type: bool
+                 ):
+    # type: (...) -> None
+    """Creates the two wraps of a template one after the other and saves
+    them to a directory instead of showing them.
+
+    Each wrap is deleted as soon as it is saved, so at most one wrap is
+    in memory at any time.  If release_template is set the flattened
+    copy of the template is also dropped between the two wraps.
+    """
+
+    layout = WrapLayout.from_mm(
+        box_width_mm, box_height_mm, box_depth_mm,
+        thickness_mm, flap_size_mm, inside_size_mm,
+        crop_mark_size_mm, crop_mark_distance_mm,
+        resolution)  # type: WrapLayout
+
+    # Make sure we have the right dimensions
+    try:
+        layout.check_template_size(src_image.width, src_image.height)
+    except TemplateSizeError as error:
+        gimp.message(str(error))
+        return
+    if not os.path.isdir(directory):
+        gimp.message("The folder %s does not exist." % directory)
+        return
+
+    save_wraps(src_image, layout, directory, file_type, release_template)
+
+
+def save_wraps(src_image,        # type: gimp.Image
+               layout,           # type: WrapLayout
+               directory,        # type: str
+               file_type,        # type: int
+               release_template  # type: bool
+               ):
+    # type: (...) -> List[str]
+    """Does the work of export_wraps for a template that fits the layout
+    and returns the paths of the files."""
+
+    name = os.path.splitext(os.path.basename(
+        src_image.filename or src_image.name))[0]  # type: str
+    extension = EXPORT_FORMATS[file_type]  # type: str
+    paths = []  # type: List[str]
+    plans = plan.compile_plans(layout)  # type: Tuple[List[Copy], ...]
+    marks_last = any(marks.drawn_last(layout, operations)
+                     for operations in plans)  # type: bool
+
+    with DefaultContext():
+        flat_image = None  # type: Optional[gimp.Image]
+        template = None    # type: Optional[numpy.ndarray]
+        for part, operations in zip(("top", "bottom"), plans):
+            if render is not None:
+                if template is None:
+                    # The engine has its own copy of the pixels, so the
+                    # flattened image is not needed any longer
+                    flat_image, src_layer = flatten_copy(src_image)
+                    template = read_pixels(src_layer)
+                    pdb.gimp_image_delete(flat_image)
+                    flat_image = None
+                image = create_overlay(layout, False)  # type: gimp.Image
+                with PausedUndo(image):
+                    render_wrap_bands(template, layout, operations,
+                                      image.layers[0])
+            else:
+                if flat_image is None:
+                    flat_image, src_layer = flatten_copy(src_image)
+                image = create_overlay(layout, not marks_last)
+                with PausedUndo(image):
+                    draw_wrap(src_layer, image, operations, marks_last)
+            if release_template:
+                template = None
+                if flat_image is not None:
+                    pdb.gimp_image_delete(flat_image)
+                    flat_image = None
+
+            path = os.path.join(directory, "%s_%s.%s"
+                                % (name, part, extension))  # type: str
+            pdb.gimp_file_save(image, image.layers[0], path,
+                               os.path.basename(path))
+            # Deleting the image frees its tiles before the next wrap
+            pdb.gimp_image_delete(image)
+            paths.append(path)
+        if flat_image is not None:
+            pdb.gimp_image_delete(flat_image)
+    return paths
+
+
+def read_queue(path,    # type: str
+               follow   # type: bool
+               ):
+    # type: (...) -> Iterator[str]
+    """Yields the lines of a queue file or a named pipe as they arrive.
+
+    A pipe ends when the last writer closes it.  With follow the end of a
+    regular file is not the end of the queue, new lines are waited for
+    until a line says quit.  Only complete lines are yielded, a line
+    that is still being written is kept until its end arrives.
+    """
+
+    with open(path) as queue:
+        partial = ""  # type: str
+        while True:
+            line = queue.readline()  # type: str
+            if not line:
+                if not follow:
+                    if partial:
+                        # The last line of a file needs no line break
+                        yield partial
+                    return
+                time.sleep(QUEUE_POLL_INTERVAL)
+                continue
+            partial += line
+            if partial.endswith("\n"):
+                yield partial
+                partial = ""
+
+
+def run_batch_job(words,      # type: List[str]
+                  directory,  # type: str
+                  file_type   # type: int
+                  ):
+    # type: (...) -> List[str]
+    """Runs one job of the batch runner and returns the files it wrote.
+
+    Raises an exception if the job fails.
+    """
+
+    command, arguments = words[0], words[1:]
+    if command == "template" and len(arguments) in (4, 5):
+        numbers = [float(word) for word in arguments[1:]]
+        image = new_template(*numbers)  # type: gimp.Image
+        try:
+            path = os.path.join(directory, arguments[0] + ".xcf")
+            pdb.gimp_file_save(image, image.layers[0], path,
+                               os.path.basename(path))
+        finally:
+            pdb.gimp_image_delete(image)
+        return [path]
+
+    if command == "wraps" and len(arguments) in (9, 10):
+        layout = WrapLayout.from_mm(*[float(word) for word
+                                      in arguments[1:]])  # type: WrapLayout
+        image = pdb.gimp_file_load(arguments[0], arguments[0])
+        try:
+            layout.check_template_size(image.width, image.height)
+            return save_wraps(image, layout, directory, file_type, True)
+        finally:
+            pdb.gimp_image_delete(image)
+
+    raise ValueError("Cannot understand the job %r" % " ".join(words))
+
+
+def run_batch(queue,      # type: str
+              directory,  # type: str
+              file_type,  # type: int
+              follow      # type: bool
+              ):
+    # type: (...) -> None
+    """Runs the jobs from a queue file or pipe in a GIMP that stays
+    running, so that GIMP only starts once for all of them.
+
+    Every line of the queue is a job:
+
+        template NAME WIDTH HEIGHT DEPTH [RESOLUTION]
+        wraps TEMPLATE WIDTH HEIGHT DEPTH THICKNESS FLAP_SIZE INSIDE_SIZE
+              CROP_MARK_SIZE CROP_MARK_DISTANCE [RESOLUTION]
+        quit
+
+    The dimensions are in mm as in the dialogs.  Templates are saved as
+    NAME.xcf and wraps as files named after the template.  Every image
+    is deleted after its job.  Failed jobs do not stop the runner.  The
+    results and the throughput are reported in the error console and
+    written to batch-report.json in the directory.
+    """
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    start = time.time()  # type: float
+    results = []  # type: List[Dict[str, Any]]
+    for line in read_queue(queue, follow):
+        try:
+            words = shlex.split(line, comments=True)  # type: List[str]
+        except ValueError:
+            # Reported as a job that cannot be understood
+            words = [line.strip()]
+        if not words:
+            continue
+        if words == ["quit"]:
+            break
+
+        job_start = time.time()  # type: float
+        result = {"job": line.strip(), "outputs": [],
+                  "error": None}  # type: Dict[str, Any]
+        try:
+            result["outputs"] = run_batch_job(words, directory, file_type)
+        except Exception as error:
+            result["error"] = "%s: %s" % (type(error).__name__, error)
+        result["seconds"] = time.time() - job_start
+        results.append(result)
+
+        elapsed = time.time() - start  # type: float
+        gimp.message("%s  %s  %.2fs  %.1f jobs per minute" % (
+            "ok" if result["error"] is None else
+            "FAILED (%s)" % result["error"], result["job"],
+            result["seconds"], 60.0 * len(results) / elapsed))
+
+    seconds = time.time() - start  # type: float
+    failed = sum(1 for result in results if result["error"] is not None)
+    summary = {
+        "jobs": len(results),
+        "succeeded": len(results) - failed,
+        "failed": failed,
+        "seconds": seconds,
+        "jobs_per_minute": 60.0 * len(results) / seconds if seconds else 0.0,
+        "results": results,
+    }  # type: Dict[str, Any]
+    with open(os.path.join(directory, "batch-report.json"), "w") as output:
+        json.dump(summary, output, indent=2)
+    gimp.message("%d of %d jobs succeeded in %.1fs, %.1f jobs per minute"
+                 % (summary["succeeded"], summary["jobs"], seconds,
+                    summary["jobs_per_minute"]))
+
+
+def preview_wraps(src_image,             # type: gimp.Image
+                  box_width_mm,          # type: float
+                  box_height_mm,         # type: float
+                  box_depth_mm,          # type: float
+                  thickness_mm,          # type: float
+                  flap_size_mm,          # type: float
+                  inside_size_mm,        # type: float
+                  crop_mark_size_mm,     # type: float
+                  crop_mark_distance_mm,  # type: float
+                  resolution,            # type: float
+                  preview_resolution     # type: float
+                  ):
+    # type: (...) -> None
+    """Quickly creates two low resolution wrap images from a template
+    image to check the dimensions."""
+
+    layout = WrapLayout.from_mm(
+        box_width_mm, box_height_mm, box_depth_mm,
+        thickness_mm, flap_size_mm, inside_size_mm,
+        crop_mark_size_mm, crop_mark_distance_mm,
+        resolution)  # type: WrapLayout
+
+    # Make sure we have the right dimensions
+    try:
+        layout.check_template_size(src_image.width, src_image.height)
+    except TemplateSizeError as error:
+        gimp.message(str(error))
+        return
+
+    preview = layout.at_resolution(preview_resolution)  # type: WrapLayout
+    with DefaultContext():
+        flat_image, src_layer = flatten_copy(src_image)
+        pdb.gimp_image_scale(flat_image, preview.src_width,
+                             preview.src_height)
+        draw_wraps(src_layer, preview)
+        pdb.gimp_image_delete(flat_image)
+    gimp.displays_flush()
+
+
+def clear_marks(image,      # type: gimp.Image
+                layer,      # type: gimp.Layer
+                layout,     # type: WrapLayout
+                operations  # type: List[Copy]
+                ):
+    # type: (...) -> None
+    """Paints the marks of a wrap over with the white background.
+
+    Marks that overlap a face or a flap were drawn over the picture,
+    which cannot be restored.  They stay, but they are covered by the
+    vector marks of the same size anyway.
+    """
+
+    areas = [plan.destination_rectangle(copy)
+             for copy in operations]  # type: List[Tuple[int, int, int, int]]
+    rectangles = [rectangle for rectangle in marks.mark_rectangles(layout)
+                  if not any(plan.intersects(rectangle, area)
+                             for area in areas)]
+    if not rectangles:
+        return
+    pdb.gimp_selection_none(image)
+    for x, y, width, height in rectangles:
+        pdb.gimp_image_select_rectangle(image, gimpfu.CHANNEL_OP_ADD,
+                                        x, y, width, height)
+    pdb.gimp_edit_fill(layer, gimpfu.WHITE_FILL)
+    pdb.gimp_selection_none(image)
+
+
+def export_wraps_pdf(image,  # type: gimp.Image
+                     path    # type: str
+                     ):
+    # type: (...) -> None
+    """Exports the top and the bottom wrap that belong to a wrap image as
+    the two pages of a print-ready PDF file."""
+
+    parasite = image.parasite_find(STATE_PARASITE)
+    state = None if parasite is None \
+        else incremental.load_state(parasite.data)
+    wraps = {} if state is None else find_wraps(state.get("template"))
+    if "top" not in wraps or "bottom" not in wraps:
+        gimp.message("Only wraps created with \"Create wraps from "
+                     "template...\" can be exported, and both of them "
+                     "must be open.")
+        return
+
+    layout = WrapLayout(*state["layout"], dpi=state["dpi"])
+    for name in ("top", "bottom"):
+        if (wraps[name][0].width, wraps[name][0].height) != \
+           (layout.dst_width, layout.dst_height):
+            gimp.message("The %s wrap has been resized." % name)
+            return
+
+    band_height = 256  # type: int
+    plans = plan.compile_plans(layout)  # type: Tuple[List[Copy], ...]
+    with DefaultContext(), pdf.PdfWriter(path) as writer:
+        for name, operations in zip(("top", "bottom"), plans):
+            # Export what is visible, including any changes by hand, but
+            # without the marks, which the PDF file draws as vectors
+            flat_image, layer = flatten_copy(wraps[name][0])
+            try:
+                clear_marks(flat_image, layer, layout, operations)
+                region = layer.get_pixel_rgn(
+                    0, 0, layer.width, layer.height,
+                    False, False)  # type: gimp.PixelRgn
+                writer.begin_page(layout)
+                for y in range(0, layer.height, band_height):
+                    pdb.gimp_progress_update(
+                        (y + (name == "bottom") * layer.height) /
+                        (2.0 * layer.height))
+                    rows = min(band_height, layer.height - y)  # type: int
+                    data = region[0:layer.width, y:y + rows]  # type: bytes
+                    if render is not None:
+                        data = numpy.frombuffer(data, dtype=numpy.uint8) \
+                            .reshape(rows, layer.width, 3)
+                    writer.write(data)
+                writer.end_page()
+            finally:
+                pdb.gimp_image_delete(flat_image)